@@ -0,0 +1,355 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from os import path
+from typing import Callable, List, Tuple, Union
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_images, synthetic_reactions, synthetic_poll, FakeGraphAPI, LAYOUT
+from social_poll_manager import utils
+from social_poll_manager.image_utils import compose, open_image
+from social_poll_manager.ingest import ingest_image
+from social_poll_manager.manager_core import PollManager
+from social_poll_manager.poll_data import PhaseStatus
+from social_poll_manager.poll_store import create_poll_store
+from social_poll_manager.render_cache import RenderCache
+from social_poll_manager.serialization import encode_legacy
+
+benchmarks_dir = path.dirname(path.abspath(__file__))
+repository_dir = path.dirname(benchmarks_dir)
+data_dir = path.join(benchmarks_dir, ".data")
+results_dir = path.join(benchmarks_dir, "results")
+
+
+# The timed function of a stage, or the timed function and a teardown releasing what the setup acquired
+StageFunctions = Union[Callable[[], int], Tuple[Callable[[], int], Callable[[], None]]]
+
+
+class Stage(object):
+    """
+    A benchmarked stage: setup prepares the data, and returns the function whose every call is timed as an
+    iteration, along with a teardown if the stage holds resources such as process pools. The function returns the
+    number of items it processed, used to compute the throughput.
+    """
+
+    def __init__(self, name: str, description: str, setup: Callable[[argparse.Namespace, str], StageFunctions]):
+        self.name = name
+        self.description = description
+        self.setup = setup
+
+
+def _images(args: argparse.Namespace) -> List[str]:
+    directory = path.join(data_dir, f"images-{args.images}-{args.image_size}-{args.seed}")
+    width, height = (int(x) for x in args.image_size.split("x"))
+    return synthetic_images(directory, args.images, (width, height), args.seed)
+
+
+def _poll_manager(args: argparse.Namespace, work_dir: str, poll_data_file: str, backend: str) -> PollManager:
+    return PollManager(graph_api=FakeGraphAPI(args.seed), reactions=synthetic_reactions(), layout=LAYOUT,
+                       max_posts_per_time=50, poll_name="benchmark", post_message="Phase $PHASE_NUMBER$ - Match "
+                       "$MATCH_NUMBER$ of $TOTAL_MATCHES$", page_id="page", max_participants_per_match=4,
+                       voting_duration=timedelta(0), post_interval=timedelta(0), poll_data_file=poll_data_file,
+                       poll_data_backend=backend, album_id="album", pics_dir=work_dir,
+                       graph_calls_per_second=1_000_000, render_cache_dir=path.join(work_dir, "render_cache"),
+                       render_workers=args.render_workers, max_image_dimension=2048, seed=args.seed)
+
+
+def setup_compose(args: argparse.Namespace, work_dir: str) -> Callable[[], int]:
+    images = [open_image(image_path) for image_path in _images(args)]
+    offsets = itertools.count()
+
+    def run() -> int:
+        offset = next(offsets) * 4
+        compose([images[(offset + idx) % len(images)] for idx in range(4)], LAYOUT[4], max_dimension=2048)
+        return 1
+    return run
+
+
+def setup_super_impose(args: argparse.Namespace, work_dir: str) -> Callable[[], int]:
+    images = [open_image(image_path) for image_path in _images(args)]
+    reactions = synthetic_reactions()
+    offsets = itertools.count()
+
+    def run() -> int:
+        offset = next(offsets)
+        image = images[offset % len(images)].copy()
+        reactions[offset % len(reactions)].super_impose(image)
+        return 1
+    return run
+
+
+def setup_render_match(args: argparse.Namespace, work_dir: str) -> StageFunctions:
+    poll_manager = _poll_manager(args, work_dir, path.join(work_dir, "poll_data.json"), "JSON")
+    poll_data = synthetic_poll(args.images, 1, args.seed, image_paths=_images(args))
+    poll_manager.poll_data = poll_data
+    matches = itertools.cycle(poll_data.phases[-1].matches)
+    poll_manager.render_cache.close()
+    poll_manager.render_cache = RenderCache(path.join(work_dir, "render_cache"), poll_manager.reactions, workers=1,
+                                            max_dimension=2048)
+
+    def run() -> int:
+        match = next(matches)
+        # Cold rendering, as when the match wasn't rendered ahead of time
+        image_path = poll_manager._generate_match_image(match.participants, LAYOUT[len(match.participants)])
+        os.remove(image_path)
+        return 1
+    return run, poll_manager.close
+
+
+def setup_ingest(args: argparse.Namespace, work_dir: str) -> Callable[[], int]:
+    image_paths = itertools.cycle(_images(args))
+    working_path, preview_path = path.join(work_dir, "working.jpg"), path.join(work_dir, "preview.jpg")
+
+    def run() -> int:
+        ingest_image(next(image_paths), working_path, preview_path, 2048, 320, 90)
+        return 1
+    return run
+
+
+def setup_save_state(args: argparse.Namespace, work_dir: str) -> Callable[[], int]:
+    poll_data = synthetic_poll(args.poll_images, args.phases, args.seed)
+    if args.backend == "LEGACY":
+        fpath = path.join(work_dir, "poll_data.json")
+        return lambda: utils.safe_write(fpath, encode_legacy(poll_data)) or 1
+    extension = ".sqlite" if args.backend == "SQLITE" else ".json"
+    store = create_poll_store(args.backend, path.join(work_dir, "poll_data" + extension))
+    store.save(poll_data)
+    current_phase = poll_data.phases[-1]
+    posted = itertools.cycle(current_phase.matches)
+
+    def run() -> int:
+        # The common case: a match of the current phase changed
+        store.save(poll_data, [next(posted)])
+        return 1
+    return run
+
+
+def setup_load_state(args: argparse.Namespace, work_dir: str) -> Callable[[], int]:
+    poll_data = synthetic_poll(args.poll_images, args.phases, args.seed)
+    if args.backend == "LEGACY":
+        fpath = path.join(work_dir, "poll_data.json")
+        utils.safe_write(fpath, encode_legacy(poll_data))
+        backend = "JSON"
+    else:
+        fpath = path.join(work_dir, "poll_data" + (".sqlite" if args.backend == "SQLITE" else ".json"))
+        create_poll_store(args.backend, fpath).save(poll_data)
+        backend = args.backend
+
+    def run() -> int:
+        loaded = create_poll_store(backend, fpath).load()
+        return len(loaded.phases[-1].matches)
+    return run
+
+
+def setup_generate_matches(args: argparse.Namespace, work_dir: str) -> StageFunctions:
+    poll_data_file = path.join(work_dir, "poll_data.json")
+    poll_data = synthetic_poll(args.poll_images, 1, args.seed)
+    create_poll_store("JSON", poll_data_file).save(poll_data)
+    poll_manager = _poll_manager(args, work_dir, poll_data_file, "JSON")
+    phase = poll_manager.poll_data.phases[-1]
+
+    def run() -> int:
+        phase.matches = []
+        phase.status = PhaseStatus.CREATED
+        poll_manager._generate_matches()
+        return len(phase.participants)
+    return run, poll_manager.close
+
+
+def setup_phase_transition(args: argparse.Namespace, work_dir: str) -> Callable[[], int]:
+    image_paths = _images(args)
+    runs = itertools.count()
+
+    def run() -> int:
+        run_dir = path.join(work_dir, f"run{next(runs)}")
+        os.makedirs(run_dir)
+        poll_data_file = path.join(run_dir, "poll_data.json")
+        create_poll_store("JSON", poll_data_file).save(synthetic_poll(len(image_paths), 1, args.seed, image_paths))
+        poll_manager = _poll_manager(args, run_dir, poll_data_file, "JSON")
+        # A fresh first phase, so that the whole poll is run from generation to winner
+        first_phase = poll_manager.poll_data.phases[-1]
+        first_phase.matches = []
+        first_phase.status = PhaseStatus.CREATED
+        poll_manager.start()
+        return sum(len(phase.matches) for phase in poll_manager.poll_data.phases)
+    return run
+
+
+STAGES = {stage.name: stage for stage in [
+    Stage("compose", "compose() of a 2x2 collage of decoded images", setup_compose),
+    Stage("super_impose", "Reaction.super_impose() on a decoded image", setup_super_impose),
+    Stage("render_match", "_generate_match_image() of a match not rendered ahead of time", setup_render_match),
+    Stage("ingest", "ingest_image() of a source image into its working copy and preview", setup_ingest),
+    Stage("save_state", "save of the poll data after a match changed (see --backend)", setup_save_state),
+    Stage("load_state", "load of the poll data at startup (see --backend)", setup_load_state),
+    Stage("generate_matches", "_generate_matches() of a phase with --poll-images participants",
+          setup_generate_matches),
+    Stage("phase_transition", "a whole poll of --images images against the fake Graph API, items are matches",
+          setup_phase_transition),
+]}
+
+
+def peak_rss_kb() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_stage(stage: Stage, args: argparse.Namespace) -> dict:
+    work_dir = tempfile.mkdtemp(prefix=f"benchmark-{stage.name}-")
+    teardown = None
+    try:
+        function = stage.setup(args, work_dir)
+        if isinstance(function, tuple):
+            function, teardown = function
+        setup_rss = peak_rss_kb()
+        for _ in range(args.warmup):
+            function()
+        latencies = []
+        items = 0
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            iteration_started = time.perf_counter()
+            items += function()
+            latencies.append(time.perf_counter() - iteration_started)
+        elapsed = time.perf_counter() - started
+    finally:
+        if teardown is not None:
+            teardown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    latencies = np.array(latencies) * 1000
+    return {
+        "description": stage.description,
+        "iterations": args.iterations,
+        "items_per_second": items / elapsed,
+        "latency_ms": {"mean": float(latencies.mean()), "p50": float(np.percentile(latencies, 50)),
+                       "p90": float(np.percentile(latencies, 90)), "p99": float(np.percentile(latencies, 99)),
+                       "max": float(latencies.max())},
+        "setup_rss_kb": setup_rss,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def stage_parameters(args: argparse.Namespace) -> List[str]:
+    return ["--iterations", str(args.iterations), "--warmup", str(args.warmup), "--images", str(args.images),
+            "--image-size", args.image_size, "--poll-images", str(args.poll_images), "--phases", str(args.phases),
+            "--backend", args.backend, "--seed", str(args.seed)] + \
+        (["--render-workers", str(args.render_workers)] if args.render_workers else [])
+
+
+def run_in_subprocess(stage: Stage, args: argparse.Namespace) -> dict:
+    """
+    Runs a stage in its own interpreter, so that its peak RSS isn't affected by the other stages.
+    """
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as result_file:
+        result_path = result_file.name
+    try:
+        subprocess.run([sys.executable, "-m", "benchmarks.run", "--child", stage.name, "--result-file", result_path]
+                       + stage_parameters(args), cwd=repository_dir, check=True,
+                       stdout=None if args.verbose else subprocess.DEVNULL)
+        with open(result_path, encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        os.remove(result_path)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repository_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """
+    Prints the change of every stage against the baseline.
+    :return: whether some stage regressed by more than threshold, in p50 latency or throughput
+    """
+    regressed = False
+    print(f"\nCompared with {baseline['meta']['revision']} ({baseline['meta']['timestamp']}):")
+    for name, result in results["stages"].items():
+        previous = baseline["stages"].get(name)
+        if previous is None:
+            continue
+        latency_change = result["latency_ms"]["p50"] / previous["latency_ms"]["p50"] - 1
+        throughput_change = result["items_per_second"] / previous["items_per_second"] - 1
+        rss_change = result["peak_rss_kb"] / previous["peak_rss_kb"] - 1
+        stage_regressed = latency_change > threshold or throughput_change < -threshold
+        regressed |= stage_regressed
+        print(f"{name:18} p50 {latency_change:+7.1%}  throughput {throughput_change:+7.1%}  "
+              f"peak RSS {rss_change:+7.1%}{'  REGRESSION' if stage_regressed else ''}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the hot paths of the poll manager on synthetic data.")
+    parser.add_argument("stages", nargs="*", help=f"stages to run, among {', '.join(STAGES)}. Defaults to all")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--images", type=int, default=32, help="number of synthetic image files")
+    parser.add_argument("--image-size", default="1600x1200", help="average size of the synthetic images")
+    parser.add_argument("--poll-images", type=int, default=20000,
+                        help="number of participants of the synthetic poll histories")
+    parser.add_argument("--phases", type=int, default=4, help="number of phases of the synthetic poll histories")
+    parser.add_argument("--backend", choices=["JSON", "SQLITE", "LEGACY"], default="JSON",
+                        help="poll data backend of the state stages. LEGACY is the jsonpickle format")
+    parser.add_argument("--render-workers", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="where to save the results. Defaults to benchmarks/results/<time>.json")
+    parser.add_argument("--compare", help="results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change reported as a regression")
+    parser.add_argument("--verbose", action="store_true", help="show the logs of the stages")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_stage(STAGES[args.child], args)
+        with open(args.result_file, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return
+
+    unknown = [name for name in args.stages if name not in STAGES]
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(unknown)}")
+    results = {
+        "meta": {"revision": git_revision(), "timestamp": datetime.now().isoformat(timespec="seconds"),
+                 "python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "parameters": stage_parameters(args)},
+        "stages": dict()
+    }
+    for name in args.stages or STAGES:
+        print(f"Running {name}...", flush=True)
+        result = run_in_subprocess(STAGES[name], args)
+        results["stages"][name] = result
+        latency = result["latency_ms"]
+        print(f"{name:18} {result['items_per_second']:10.1f} items/s  p50 {latency['p50']:9.2f}ms  "
+              f"p90 {latency['p90']:9.2f}ms  p99 {latency['p99']:9.2f}ms  "
+              f"peak RSS {result['peak_rss_kb'] / 1024:.0f}MB", flush=True)
+
+    output = args.output or path.join(results_dir, f"{datetime.now():%Y%m%d-%H%M%S}-{results['meta']['revision']}.json")
+    os.makedirs(path.dirname(path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=4)
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import itertools
+import json
+import os
+import random
+import re
+import threading
+from datetime import datetime, timedelta
+from os import path
+from typing import Dict, List, Tuple
+from urllib.parse import unquote
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from social_poll_manager.bracket import BracketPlanner
+from social_poll_manager.poll_data import MatchStatus, PhaseStatus, PhaseData, PollData, ImageTable
+from social_poll_manager.reaction import Reaction
+
+REACTION_NAMES = ["angry", "love", "haha", "wow"]
+LAYOUT = {4: (2, 2), 3: (1, 3), 2: (1, 2)}
+
+
+def synthetic_image(size: Tuple[int, int], seed: int) -> Image.Image:
+    """
+    A smooth gradient with some noise, which compresses about as well as a photo.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    colors = rng.random((2, 3), dtype=np.float32) * 255
+    pixels = colors[0] * x + colors[1] * y + rng.normal(0, 12, (height, width, 3)).astype(np.float32)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), "RGB")
+
+
+def synthetic_images(directory: str, count: int, size: Tuple[int, int], seed: int = 0) -> List[str]:
+    """
+    Writes count JPEG images to directory, reusing the ones already generated with the same parameters.
+    Sizes vary around the given one, as they do in real polls.
+    :return: the paths of the images
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    image_paths = []
+    for idx in range(count):
+        image_path = path.join(directory, f"{idx}.jpg")
+        image_size = (int(size[0] * rng.uniform(0.6, 1.2)), int(size[1] * rng.uniform(0.6, 1.2)))
+        if not path.exists(image_path):
+            synthetic_image(image_size, seed * 1_000_003 + idx).save(image_path, quality=90)
+        image_paths.append(image_path)
+    return image_paths
+
+
+def synthetic_reactions(names: List[str] = None) -> List[Reaction]:
+    reactions = []
+    for idx, name in enumerate(names or REACTION_NAMES):
+        image = Image.new("RGBA", (256, 256), (0, 0, 0, 0))
+        ImageDraw.Draw(image).ellipse((8, 8, 248, 248), fill=(60 * idx % 256, 120, 255 - 60 * idx % 256, 255))
+        reactions.append(Reaction(name, image, name[0]))
+    return reactions
+
+
+def synthetic_poll(images: int, phases: int, seed: int = 0, image_paths: List[str] = None) -> PollData:
+    """
+    Builds the history of a poll: phases - 1 completed phases, and a current phase with half of its matches posted.
+    :param image_paths: paths of the images, if they have to exist. Fake paths are used otherwise
+    """
+    rng = random.Random(seed)
+    poll_images = ImageTable()
+    for idx in range(images):
+        image_id = str(10_000_000_000 + idx)
+        image_path = image_paths[idx % len(image_paths)] if image_paths else f"pics/{image_id}.jpg"
+        poll_images.add(image_id, image_path, f"https://facebook.com/{image_id}")
+    poll_data = PollData(poll_images)
+    poll_data.seed = seed
+    planner = BracketPlanner(LAYOUT, 4, len(REACTION_NAMES))
+    participants = poll_images.values()
+    posted_time = datetime(2022, 1, 1)
+    for phase_number in range(1, phases + 1):
+        phase = PhaseData(participants, phase_number)
+        image_rows = phase.participants.rows
+        assignment = planner.assign(len(image_rows), seed, phase_number)
+        table = phase.matches.table
+        table.extend(assignment.match_sizes.tolist(),
+                     *assignment.columns(image_rows, [table.reaction_code(name) for name in REACTION_NAMES]))
+        current = phase_number == phases or len(phase.matches) <= 1
+        winners = []
+        for match in phase.matches:
+            if current and match.match_number > len(phase.matches) // 2:
+                break
+            match.match_status = MatchStatus.POSTED
+            match.post_id = f"{rng.randrange(10 ** 15)}"
+            match.posted_time = posted_time
+            if current:
+                continue
+            for participant in match.participants:
+                participant.reactions = rng.randrange(200)
+            match.match_status = MatchStatus.OVER
+            winners.append(max(match.participants, key=lambda participant: participant.reactions).image_data)
+        phase.status = PhaseStatus.GENERATED if current else PhaseStatus.OVER
+        poll_data.phases.append(phase)
+        posted_time += timedelta(days=1)
+        if current:
+            break
+        participants = winners
+    return poll_data
+
+
+class FakeResponse(object):
+
+    def __init__(self, body, status_code: int = 200):
+        self.status_code = status_code
+        self.text = json.dumps(body)
+        self.headers = {"X-App-Usage": json.dumps({"call_count": 1, "total_time": 1, "total_cputime": 1})}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeGraphSession(object):
+    """
+    Stands in for the http session of the Graph API: photo uploads consume the whole body and return a new id, batch
+    requests return random reaction counts.
+    """
+
+    def __init__(self, seed: int = 0):
+        self._ids = itertools.count(1)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.uploaded_bytes = 0
+
+    def post(self, url: str, data=None, files=None, headers=None, timeout=None) -> FakeResponse:
+        if url.endswith("/photos"):
+            size = 0
+            while True:
+                chunk = data.read(64 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+            with self._lock:
+                self.uploaded_bytes += size
+                return FakeResponse({"id": f"photo{next(self._ids)}"})
+        sub_responses = []
+        for sub_request in json.loads(data["batch"]):
+            if "name" in sub_request:
+                body = {"page_story_id": f"story_{sub_request['relative_url']}"}
+            else:
+                names = re.findall(r"\.as\(reactions_(\w+)\)", unquote(sub_request["relative_url"]))
+                with self._lock:
+                    body = {f"reactions_{name}": {"summary": {"total_count": self._rng.randrange(50)}}
+                            for name in names}
+            sub_responses.append({"code": 200, "body": json.dumps(body)})
+        return FakeResponse(sub_responses)
+
+
+class FakeGraphAPI(object):
+
+    def __init__(self, seed: int = 0):
+        self.version = "v2.12"
+        self.access_token = "benchmark"
+        self.timeout = 30
+        self.session = FakeGraphSession(seed)
+
+    def put_comment(self, object_id: str, message: str) -> Dict[str, str]:
+        return {"id": f"{object_id}_comment"}
+
+    def get_connections(self, object_id: str, connection_name: str, **args) -> Dict[str, list]:
+        return {"data": []}
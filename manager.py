@@ -1,52 +1,147 @@
+import argparse
+import json
+import threading
 from configparser import ConfigParser, SectionProxy
+from contextlib import nullcontext
 
-from facebook import GraphAPI
 from datetime import timedelta
-from PIL import Image
+from glob import glob
+from pathlib import Path
+from typing import TYPE_CHECKING
+import os
 from os import path
 
-from social_poll_manager.image_utils import collect_images_from_albums
-from social_poll_manager.manager_core import Reaction, PollManager
+from social_poll_manager import utils, metrics
 
-from social_poll_manager import utils
+# The modules pulling in Pillow, numpy, requests and the Facebook SDK are imported by the functions which need them,
+# so that --help and --status answer right away
+if TYPE_CHECKING:
+    from social_poll_manager.fake_graph import FakeGraphServer
+    from social_poll_manager.manager_core import PollManager
+    from social_poll_manager.reaction import Reaction
 
 logger = utils.get_logger(__name__)
 
+resources_dir = "resources"
 
-def init_reactions(config: SectionProxy) -> list[Reaction]:
+
+def init_reactions(config: SectionProxy) -> list["Reaction"]:
+    """
+    :return: the configured reactions. Their images are only decoded when first drawn
+    """
+    from social_poll_manager.reaction import Reaction
     base_dir = config.get("base_dir")
     names = config.get("names").split(",")
     emojis = config.get("emojis").split(",")
     image_names = config.get("images").split(",")
-    reactions = []
-    for (idx, image_name) in enumerate(image_names):
-        image = Image.open(path.join(base_dir, image_names[idx]))
-        reactions.append(Reaction(names[idx], image, emojis[idx]))
-    return reactions
+    return [Reaction(names[idx], path.join(base_dir, image_name), emojis[idx])
+            for (idx, image_name) in enumerate(image_names)]
 
 
-def main():
-    resources_dir = "resources"
+def poll_data_path(bot_settings: SectionProxy, state_name: str) -> tuple[str, str]:
+    """
+    :return: the backend of the poll data and the path of its file in the resources directory
+    """
+    backend = bot_settings.get("poll_data_backend", fallback="JSON")
+    return backend, path.join(resources_dir, f"{state_name}.sqlite" if backend == "SQLITE" else f"{state_name}.json")
+
+
+class SharedResources(object):
+    """
+    Resources shared by all the polls run by the same process: the http connection pool and the decoded reactions.
+    """
+
+    def __init__(self, pool_size: int = 10):
+        self.pool_size = pool_size
+        self.http_session = utils.create_http_session(pool_size=pool_size)
+        metrics.instrument_session(self.http_session)
+        self._reactions = dict()
+        self._lock = threading.Lock()
+
+    def ensure_pool_size(self, pool_size: int) -> None:
+        """
+        Grows the http connection pool, if needed, so that it can serve pool_size concurrent requests.
+        """
+        from requests.adapters import HTTPAdapter
+        with self._lock:
+            if pool_size > self.pool_size:
+                self.pool_size = pool_size
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                self.http_session.mount("https://", adapter)
+                self.http_session.mount("http://", adapter)
+
+    def get_reactions(self, config: SectionProxy) -> list["Reaction"]:
+        key = tuple(config.get(option) for option in ("base_dir", "images", "names", "emojis"))
+        with self._lock:
+            if key not in self._reactions:
+                self._reactions[key] = init_reactions(config)
+            return self._reactions[key]
+
+
+def build_poll_manager(config_path: str, shared: SharedResources, state_name: str = "poll_data",
+                       force_unattended: bool = False, fake_graph: "FakeGraphServer" = None,
+                       time_scale: float = 1, profile: bool = False, profile_memory: bool = False) -> "PollManager":
+    """
+    Builds a poll manager from a configuration file, collecting and indexing the poll images.
+    :param config_path: path of the configuration file
+    :param shared: the resources shared with the other polls of the process
+    :param state_name: base name of the files holding the state of the poll in the resources directory
+    :param force_unattended: disables the interactive mode, regardless of the configuration
+    :param fake_graph: the fake Graph API server of a dry run. The poll gets its own state files, and its images are
+    collected from the generated photos of the server, if any
+    :param time_scale: divides every duration of the poll, to simulate it faster
+    :param profile: profiles every stage of the poll, saving the profiles next to the state file
+    :param profile_memory: also samples the memory allocations of every profiled stage
+    """
+    from facebook import GraphAPI
+    from social_poll_manager.image_index import ImageIndex
+    from social_poll_manager.image_utils import collect_images_from_albums
+    from social_poll_manager.ingest import ImageIngester
+    from social_poll_manager.jpeg_encoder import JpegEncoder
+    from social_poll_manager.manager_core import PollManager
+    from social_poll_manager.profiling import StageProfiler
+    from social_poll_manager.results import ResultsExporter
+
     config = ConfigParser(allow_no_value=True)
-    config.read('config.ini', encoding='utf-8')
+    config.read(config_path, encoding='utf-8')
+    if fake_graph is not None:
+        state_name = f"dry_run_{state_name}"
 
-    reactions = init_reactions(config["reactions"])
+    reactions = shared.get_reactions(config["reactions"])
 
     fb_settings = config["facebook"]
     bot_settings = config["bot_settings"]
+    poll_data_backend, poll_data_file = poll_data_path(bot_settings, state_name)
+    profiler = None
+    if profile or profile_memory:
+        profiler = StageProfiler(f"{poll_data_file}.profile", memory=profile_memory)
+        logger.info(f"Profiling the stages of {config_path} in {profiler.output_dir}.")
 
     page_id = fb_settings.get("page_id")
     access_token = fb_settings.get("access_token")
     # If album_id is missing, posts to timeline (using page_id)
     album_id = fb_settings.get("album_id", fallback=page_id)
     winner_album_id = fb_settings.get("winner_album_id")
-    graph_api = GraphAPI(access_token=access_token, timeout=3000)
+    download_workers = bot_settings.getint("download_workers", fallback=8)
+    shared.ensure_pool_size(download_workers)
+    graph_api = GraphAPI(access_token=access_token, timeout=3000, session=shared.http_session)
 
     pics_dir = bot_settings.get("images_folder")
     images_source = bot_settings.get("images_source")
+    if fake_graph is not None and fake_graph.source_photos:
+        images_source = "ALBUM"
+        pics_dir = path.join(resources_dir, f"{state_name}_pics")
+    os.makedirs(pics_dir, exist_ok=True)
+    image_index = ImageIndex(path.join(pics_dir, ".index.json"))
     if images_source == "ALBUM":
-        source_albums_ids = bot_settings.get("source_albums_ids").split(",")
-        collect_images_from_albums(album_ids=source_albums_ids, graph_api=graph_api, target_directory=pics_dir)
+        source_albums_ids = bot_settings.get("source_albums_ids", fallback=None)
+        source_albums_ids = source_albums_ids.split(",") if source_albums_ids else ["source"]
+        if fake_graph is not None:
+            fake_graph.add_source_albums(source_albums_ids)
+        with profiler.stage("collect_images") if profiler is not None else nullcontext():
+            collect_images_from_albums(album_ids=source_albums_ids, graph_api=graph_api, target_directory=pics_dir,
+                                       workers=download_workers, session=shared.http_session,
+                                       image_index=image_index)
     layout_list = bot_settings.get("layout").split(",")
     layout = dict()
     for l_entry in layout_list:
@@ -60,19 +155,216 @@ def main():
     post_message = bot_settings.get("message")
     winner_message = bot_settings.get("winner_message")
     interactive_mode = bot_settings.getboolean("interactive_mode")
+    if interactive_mode and (force_unattended or fake_graph is not None):
+        logger.warning(f"Interactive mode is not supported when running several polls or a dry run. Disabling it "
+                       f"for {config_path}.")
+        interactive_mode = False
     max_participants_per_match = bot_settings.getint("max_participants_per_match")
+    reaction_workers = bot_settings.getint("reaction_workers", fallback=4)
+    graph_calls_per_second = bot_settings.getfloat("graph_calls_per_second", fallback=5)
+    render_workers = bot_settings.get("render_workers", fallback=None)
+    render_workers = int(render_workers) if render_workers else None
+    max_image_dimension = bot_settings.getint("max_image_dimension", fallback=None)
+    dedup_max_distance = bot_settings.get("dedup_max_distance", fallback=None)
+    dedup_max_distance = int(dedup_max_distance) if dedup_max_distance else None
+    upload_max_attempts = bot_settings.getint("upload_max_attempts", fallback=8)
+    seed = bot_settings.get("poll_seed", fallback=None)
+    seed = int(seed) if seed else None
+    vote_tracking_interval = bot_settings.get("vote_tracking_interval", fallback=None)
+    vote_tracking_interval = timedelta(seconds=utils.parse_duration(vote_tracking_interval)) \
+        if vote_tracking_interval else None
+    vote_tracking_max_interval = timedelta(seconds=utils.parse_duration(
+        bot_settings.get("vote_tracking_max_interval", fallback="30m")))
+    tie_extension = bot_settings.get("tie_extension", fallback=None)
+    tie_extension = timedelta(seconds=utils.parse_duration(tie_extension)) if tie_extension else None
+    max_tie_extensions = bot_settings.getint("max_tie_extensions", fallback=1)
+    jpeg_max_kb = bot_settings.get("jpeg_max_kb", fallback=None)
+    jpeg_min_psnr = bot_settings.get("jpeg_min_psnr", fallback=None)
+    jpeg_encoder = JpegEncoder(quality=bot_settings.getint("jpeg_quality", fallback=80),
+                               max_bytes=int(jpeg_max_kb) * 1024 if jpeg_max_kb else None,
+                               min_psnr=float(jpeg_min_psnr) if jpeg_min_psnr else None,
+                               min_quality=bot_settings.getint("jpeg_min_quality", fallback=30),
+                               progressive=bot_settings.getboolean("jpeg_progressive", fallback=False))
+    if time_scale != 1:
+        voting_duration /= time_scale
+        post_interval /= time_scale
+        vote_tracking_interval = vote_tracking_interval / time_scale if vote_tracking_interval else None
+        vote_tracking_max_interval /= time_scale
+        tie_extension = tie_extension / time_scale if tie_extension else None
+        logger.info(f"Time scaled by {time_scale}: votes last {voting_duration}, batches are posted every "
+                    f"{post_interval}.")
+    with profiler.stage("index_images") if profiler is not None else nullcontext():
+        image_index.update(pics_dir, workers=render_workers)
+    working_image_dimension = bot_settings.get("working_image_dimension", fallback=None)
+    image_ingester = None
+    if working_image_dimension:
+        image_ingester = ImageIngester(path.join(pics_dir, ".working"), max_dimension=int(working_image_dimension),
+                                       preview_dimension=bot_settings.getint("preview_dimension", fallback=320),
+                                       quality=bot_settings.getint("working_image_quality", fallback=90),
+                                       workers=render_workers)
+    results_dir = bot_settings.get("results_dir", fallback=None)
+    results_exporter = None
+    if results_dir:
+        if state_name != "poll_data":
+            results_dir = path.join(results_dir, state_name)
+        results_exporter = ResultsExporter(results_dir, bot_settings.get("results_format", fallback="CSV"))
+    render_cache_dir = path.join(resources_dir, "render_cache")
+    if state_name != "poll_data":
+        render_cache_dir = path.join(render_cache_dir, state_name)
+
+    return PollManager(graph_api=graph_api, album_id=album_id, winner_album_id=winner_album_id,
+                       pics_dir=pics_dir, reactions=reactions, layout=layout,
+                       max_posts_per_time=max_posts_per_time,
+                       voting_duration=voting_duration, poll_name=poll_name,
+                       original_urls_enabled=og_urls_enabled,
+                       poll_data_file=poll_data_file, poll_data_backend=poll_data_backend,
+                       post_interval=post_interval, post_message=post_message, winner_message=winner_message,
+                       interactive_mode=interactive_mode, page_id=page_id,
+                       max_participants_per_match=max_participants_per_match,
+                       reaction_workers=reaction_workers, graph_calls_per_second=graph_calls_per_second,
+                       render_cache_dir=render_cache_dir,
+                       render_workers=render_workers, max_image_dimension=max_image_dimension,
+                       image_index=image_index, dedup_max_distance=dedup_max_distance,
+                       upload_max_attempts=upload_max_attempts, seed=seed,
+                       vote_tracking_interval=vote_tracking_interval,
+                       vote_tracking_max_interval=vote_tracking_max_interval,
+                       tie_extension=tie_extension, max_tie_extensions=max_tie_extensions, time_scale=time_scale,
+                       jpeg_encoder=jpeg_encoder, image_ingester=image_ingester,
+                       results_exporter=results_exporter, profiler=profiler)
+
+
+def poll_configs(polls_dir: str) -> list[str]:
+    config_paths = sorted(glob(path.join(polls_dir, "*.ini")))
+    if not config_paths:
+        raise FileNotFoundError(f"No poll configuration found in {polls_dir}.")
+    return config_paths
+
+
+def poll_status(config_path: str, state_name: str = "poll_data", dry_run: bool = False) -> dict:
+    """
+    Reads the summary of a poll from its state file, without loading the poll nor its images.
+    :param config_path: path of the configuration file
+    :param state_name: base name of the files holding the state of the poll in the resources directory
+    :param dry_run: reads the state of the dry runs of the poll
+    :return: the summary of the poll, as stored in the header of its state file
+    """
+    from social_poll_manager.poll_store import read_poll_status
+    config = ConfigParser(allow_no_value=True)
+    config.read(config_path, encoding='utf-8')
+    if dry_run:
+        state_name = f"dry_run_{state_name}"
+    backend, poll_data_file = poll_data_path(config["bot_settings"], state_name)
+    status = read_poll_status(backend, poll_data_file) or dict()
+    return {"config": config_path, "poll_name": config["bot_settings"].get("poll_name"),
+            "poll_data_file": poll_data_file, **status}
+
+
+def format_poll_status(status: dict) -> str:
+    if "current_phase" not in status:
+        return f"{status['poll_name']} ({status['config']}): not started, no poll data in {status['poll_data_file']}."
+    phase = status["current_phase"]
+    return (f"{status['poll_name']} ({status['config']}): phase {phase['phase_number']} {phase['status']}, "
+            f"{phase['participants']} participants, {phase['matches_posted']}/{phase['matches']} matches posted, "
+            f"{phase['matches_over']} over. {status['images']} images, {status['phases']} phases.")
+
+
+def run_polls(polls_dir: str, workers: int = None, fake_graph: "FakeGraphServer" = None,
+              time_scale: float = 1, profile: bool = False, profile_memory: bool = False) -> None:
+    """
+    Runs every poll configured in polls_dir (one .ini file per poll) in this process. All the polls share the same
+    scheduler, http connection pool and reaction images, while each one keeps its own state file and rate limits.
+    """
+    from social_poll_manager.scheduler import Scheduler
+    config_paths = poll_configs(polls_dir)
+    logger.info(f"Starting {len(config_paths)} polls from {polls_dir}...")
+    shared = SharedResources(pool_size=max(10, len(config_paths) * 4))
+    scheduler = Scheduler(workers=workers or len(config_paths))
+    poll_managers = [build_poll_manager(config_path, shared, state_name=Path(config_path).stem,
+                                        force_unattended=True, fake_graph=fake_graph, time_scale=time_scale,
+                                        profile=profile, profile_memory=profile_memory)
+                     for config_path in config_paths]
+    for poll_manager in poll_managers:
+        poll_manager.schedule(scheduler)
+    try:
+        scheduler.run()
+    finally:
+        for poll_manager in poll_managers:
+            poll_manager.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs image polls on Facebook pages.")
+    parser.add_argument("--config", default="config.ini", help="configuration file of the poll")
+    parser.add_argument("--polls-dir", help="run every poll configured in this directory, one .ini file per poll")
+    parser.add_argument("--workers", type=int, help="number of polls jobs run concurrently with --polls-dir")
+    parser.add_argument("--metrics-port", type=int, help="serve the metrics in the Prometheus format on this port")
+    parser.add_argument("--metrics-file", help="periodically write the metrics and the recent spans to this json file")
+    parser.add_argument("--metrics-interval", type=float, default=60, help="seconds between two metrics file writes")
+    parser.add_argument("--trace", action="store_true", help="record spans around posts, reactions and phases")
+    parser.add_argument("--log-json", action="store_true", help="log json lines instead of text")
+    parser.add_argument("--status", action="store_true",
+                        help="print the current phase of the polls from their state files and exit, without running "
+                             "them (json lines with --log-json)")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile every stage of the polls with cProfile, saving the profiles next to the state "
+                             "files")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="also trace the memory allocations of every profiled stage with tracemalloc (slow)")
+    dry_run = parser.add_argument_group("dry run", "Runs the polls against a local fake Graph API, with separate "
+                                                   "state files and compressed durations.")
+    dry_run.add_argument("--dry-run", action="store_true", help="don't connect to Facebook")
+    dry_run.add_argument("--time-scale", type=float, default=3600,
+                         help="simulated seconds per real second (default: an hour per second)")
+    dry_run.add_argument("--dry-run-photos", type=int, default=0,
+                         help="collect the poll images from this many generated photos instead of the configured "
+                              "source")
+    dry_run.add_argument("--fake-latency", type=float, default=0.05, help="seconds added to every Graph call")
+    dry_run.add_argument("--fake-error-rate", type=float, default=0, help="fraction of Graph calls failing")
+    dry_run.add_argument("--fake-spam-rate", type=float, default=0, help="fraction of uploads rejected as spam")
+    dry_run.add_argument("--fake-rate-limit", type=int,
+                         help="Graph calls per minute allowed before rate limit errors")
+    args = parser.parse_args()
+
+    if args.status:
+        if args.polls_dir:
+            statuses = [poll_status(config_path, Path(config_path).stem, args.dry_run)
+                        for config_path in poll_configs(args.polls_dir)]
+        else:
+            statuses = [poll_status(args.config, dry_run=args.dry_run)]
+        for status in statuses:
+            print(json.dumps(status) if args.log_json else format_poll_status(status))
+        return
 
-    poll_manager = PollManager(graph_api=graph_api, album_id=album_id, winner_album_id=winner_album_id,
-                               pics_dir=pics_dir, reactions=reactions, layout=layout,
-                               max_posts_per_time=max_posts_per_time,
-                               voting_duration=voting_duration, poll_name=poll_name,
-                               original_urls_enabled=og_urls_enabled,
-                               poll_data_file=path.join(resources_dir, "poll_data.json"),
-                               post_interval=post_interval, post_message=post_message, winner_message= winner_message,
-                               interactive_mode=interactive_mode, page_id=page_id,
-                               max_participants_per_match=max_participants_per_match)
-
-    poll_manager.start()
+    utils.set_json_logging(args.log_json)
+    metrics.tracer.enabled = args.trace
+    exporter = None
+    if args.metrics_port is not None or args.metrics_file is not None:
+        exporter = metrics.MetricsExporter(port=args.metrics_port, json_file=args.metrics_file,
+                                           interval=args.metrics_interval)
+    fake_graph = None
+    time_scale = 1
+    if args.dry_run:
+        import facebook
+        from social_poll_manager.fake_graph import FakeGraphServer
+        time_scale = args.time_scale
+        fake_graph = FakeGraphServer(latency=args.fake_latency, latency_jitter=args.fake_latency,
+                                     error_rate=args.fake_error_rate, spam_rate=args.fake_spam_rate,
+                                     rate_limit=args.fake_rate_limit, time_scale=time_scale,
+                                     source_photos=args.dry_run_photos)
+        facebook.FACEBOOK_GRAPH_URL = fake_graph.url
+    try:
+        if args.polls_dir:
+            run_polls(args.polls_dir, args.workers, fake_graph=fake_graph, time_scale=time_scale,
+                      profile=args.profile, profile_memory=args.profile_memory)
+        else:
+            build_poll_manager(args.config, SharedResources(), fake_graph=fake_graph, time_scale=time_scale,
+                               profile=args.profile, profile_memory=args.profile_memory).start()
+    finally:
+        if exporter is not None:
+            exporter.close()
+        if fake_graph is not None:
+            logger.info(f"Dry run calls: {fake_graph.summary()}")
+            fake_graph.close()
 
 
 if __name__ == "__main__":
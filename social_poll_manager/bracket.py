@@ -0,0 +1,107 @@
+import math
+from array import array
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from social_poll_manager.utils import auto_str_and_repr
+
+
+@auto_str_and_repr
+class PhasePlan(object):
+
+    def __init__(self, phase_number: int, participants: int, match_sizes: np.ndarray):
+        self.phase_number = phase_number
+        self.participants = participants
+        self.match_sizes = match_sizes
+
+
+@auto_str_and_repr
+class MatchAssignment(object):
+    """
+    The matches of a phase, as flat arrays: the participants in match order, as indexes into the phase participants,
+    the reaction assigned to each of them, as indexes into the reaction list, and the size of every match.
+    """
+
+    def __init__(self, order: np.ndarray, reactions: np.ndarray, match_sizes: np.ndarray):
+        self.order = order
+        self.reactions = reactions
+        self.match_sizes = match_sizes
+
+    def columns(self, image_rows: array, reaction_codes: Sequence[int]) -> Tuple[array, array]:
+        """
+        Maps the assignment to the columns of a MatchTable, without going through the matches one by one.
+        :param image_rows: the image rows of the phase participants
+        :param reaction_codes: the code of every reaction in the match table, by reaction index
+        :return: the image rows and the reaction codes of the participants of all the matches, back to back
+        """
+        rows = np.frombuffer(image_rows, dtype=image_rows.typecode)[self.order] if len(image_rows) else \
+            np.zeros(0, dtype=image_rows.typecode)
+        codes = np.asarray(reaction_codes, dtype=np.uint8)[self.reactions]
+        return array(image_rows.typecode, rows.tobytes()), array("B", codes.tobytes())
+
+
+class BracketPlanner(object):
+    """
+    Plans the matches of a poll: how many participants every match has, and which participant and reaction goes
+    where. Match sizes are restricted to the ones supported by the layout and balanced, so that every match of a phase
+    has about the same number of participants and no participant wins by default. Assignments are drawn from a
+    generator seeded with the poll seed and the phase number, so every phase can be reproduced for auditing.
+    """
+
+    def __init__(self, layout: Dict[int, Tuple], max_participants_per_match: int, reactions_count: int):
+        self.sizes = sorted(size for size in layout if 2 <= size <= min(max_participants_per_match, reactions_count))
+        if not self.sizes:
+            raise ValueError(f"No match size between 2 and {max_participants_per_match} is supported by the layout "
+                             f"{layout} with {reactions_count} reactions.")
+        self.reactions_count = reactions_count
+
+    def match_sizes(self, participants: int) -> np.ndarray:
+        """
+        Splits the participants in the lowest number of matches, using at most two consecutive supported sizes.
+        :return: the size of every match, larger matches first. Empty if there are less than two participants
+        """
+        if participants < 2:
+            return np.zeros(0, dtype=np.int64)
+        min_size, max_size = self.sizes[0], self.sizes[-1]
+        for matches in range(math.ceil(participants / max_size), participants // min_size + 1):
+            target = participants / matches
+            lower = max(size for size in self.sizes if size <= target)
+            upper = min(size for size in self.sizes if size >= target)
+            if lower == upper:
+                if lower * matches == participants:
+                    return np.full(matches, lower, dtype=np.int64)
+                continue
+            # lower * (matches - larger) + upper * larger == participants
+            larger, remainder = divmod(participants - lower * matches, upper - lower)
+            if remainder == 0:
+                return np.concatenate((np.full(larger, upper, dtype=np.int64),
+                                       np.full(matches - larger, lower, dtype=np.int64)))
+        raise ValueError(f"{participants} participants can't be split in matches of sizes {self.sizes}.")
+
+    def plan(self, participants: int, phase_number: int = 1) -> List[PhasePlan]:
+        """
+        Plans every phase from the given one to the end of the poll, assuming that every match has a single winner.
+        Ties add participants to the next phase, so the actual poll can be longer.
+        """
+        phases = []
+        while participants >= 2:
+            match_sizes = self.match_sizes(participants)
+            phases.append(PhasePlan(phase_number, participants, match_sizes))
+            participants = len(match_sizes)
+            phase_number += 1
+        return phases
+
+    def assign(self, participants: int, seed: int, phase_number: int) -> MatchAssignment:
+        """
+        Draws the matches of a phase: participants are shuffled and split by the planned sizes, and every match gets
+        distinct reactions.
+        """
+        rng = np.random.default_rng([seed, phase_number])
+        match_sizes = self.match_sizes(participants)
+        order = rng.permutation(participants)
+        max_size = int(match_sizes.max(initial=0))
+        # Every row is a random permutation of the reactions, truncated to the size of its match
+        reactions = np.argsort(rng.random((len(match_sizes), self.reactions_count)), axis=1)[:, :max_size]
+        reactions = reactions[np.arange(max_size) < match_sizes[:, None]]
+        return MatchAssignment(order, reactions, match_sizes)
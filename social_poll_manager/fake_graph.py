@@ -0,0 +1,337 @@
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+from email import policy
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+from typing import Dict, List, Tuple, Union
+from urllib.parse import urlencode, urlparse, parse_qsl
+
+import numpy as np
+from PIL import Image
+
+from social_poll_manager import utils
+
+logger = utils.get_logger(__name__)
+
+Response = Tuple[int, dict]
+
+_version_pattern = re.compile(r"^v\d+\.\d+$")
+_reaction_pattern = re.compile(r"reactions\.type\((\w+)\)[^,]*?\.as\((\w+)\)")
+_batch_result_pattern = re.compile(r"\{result=(\w+):\$\.(\w+)\}")
+
+
+def _error(status: int, code: int, message: str, error_type: str = "OAuthException") -> Response:
+    return status, {"error": {"message": message, "type": error_type, "code": code, "fbtrace_id": "dryrun"}}
+
+
+def generated_photo(seed: int, size: Tuple[int, int] = (640, 480)) -> bytes:
+    """
+    Renders a JPEG from a coarse grid of random colors, smoothed to the given size: cheap to generate, and different
+    enough from the others not to be taken for a duplicate.
+    """
+    rng = np.random.default_rng(seed)
+    grid = Image.fromarray(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8), "RGB")
+    output = BytesIO()
+    grid.resize(size, Image.BICUBIC).save(output, "JPEG", quality=85)
+    return output.getvalue()
+
+
+class FakePhoto(object):
+
+    def __init__(self, photo_id: str, album_id: str, message: str, size: int = 0, seed: int = None):
+        self.photo_id = photo_id
+        self.album_id = album_id
+        self.message = message
+        self.size = size
+        self.seed = seed
+        self.created_time = time.time()
+
+
+class FakeGraphServer(object):
+    """
+    Local stand-in for the Graph API endpoints used by the polls: photo uploads, comments, page story ids, reaction
+    summaries, album photos with paging, photo images and batch requests. Reactions grow over time at a random
+    pace per post, and source albums serve generated photos.
+    Faults can be injected to exercise the retries: every call is delayed by latency seconds (plus up to
+    latency_jitter), fails with a transient error with probability error_rate, and uploads are rejected as spam with
+    probability spam_rate. With rate_limit, calls beyond rate_limit per rate_limit_window seconds are rejected with the
+    application rate limit error, and the usage headers report the calls made in the window.
+    Point facebook.FACEBOOK_GRAPH_URL to url to use it.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, page_id: str = "100000000000001",
+                 latency: float = 0, latency_jitter: float = 0, error_rate: float = 0, spam_rate: float = 0,
+                 rate_limit: int = None, rate_limit_window: float = 60, votes_per_hour: float = 20,
+                 time_scale: float = 1, source_photos: int = 0, seed: int = 0):
+        """
+        :param votes_per_hour: average votes a participant gets in an hour of simulated time
+        :param time_scale: simulated seconds per real second, used to accrue the votes
+        :param source_photos: generated photos spread across the source albums registered with add_source_albums()
+        """
+        self.page_id = page_id
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.spam_rate = spam_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.votes_per_hour = votes_per_hour
+        self.time_scale = time_scale
+        self.source_photos = source_photos
+        self.seed = seed
+        self.photos: Dict[str, FakePhoto] = dict()
+        self.albums: Dict[str, List[FakePhoto]] = dict()
+        self.comments: Dict[str, List[str]] = dict()
+        self.stats: Dict[str, int] = dict()
+        self._ids = itertools.count(10 ** 15)
+        self._calls = deque()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _FakeGraphHandler)
+        self._server.daemon_threads = True
+        self._server.fake_graph = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-graph", daemon=True)
+        self._thread.start()
+        self.url = f"http://{host}:{self._server.server_port}/"
+        logger.info(f"Fake Graph API listening on {self.url}")
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def _new_id(self) -> str:
+        with self._lock:
+            return str(next(self._ids))
+
+    def add_source_albums(self, album_ids: List[str]) -> None:
+        """
+        Fills the given albums with the generated source photos, spread evenly. Albums already filled are kept.
+        """
+        album_ids = [album_id for album_id in album_ids if album_id not in self.albums]
+        if not album_ids:
+            return
+        for idx in range(self.source_photos):
+            album_id = album_ids[idx % len(album_ids)]
+            photo = FakePhoto(self._new_id(), album_id, f"Entry {idx + 1}", seed=self.seed * 1_000_003 + idx)
+            with self._lock:
+                self.photos[photo.photo_id] = photo
+                self.albums.setdefault(album_id, []).append(photo)
+
+    def _usage_headers(self) -> Dict[str, str]:
+        with self._lock:
+            calls = len(self._calls)
+        usage = min(100, 100 * calls // self.rate_limit) if self.rate_limit else 1
+        return {"X-App-Usage": json.dumps({"call_count": usage, "total_cputime": usage // 2,
+                                           "total_time": usage // 2})}
+
+    def _inject_fault(self, upload: bool = False) -> Union[Response, None]:
+        """
+        Records a call against the rate limit, and picks the error it fails with, if any.
+        """
+        now = time.time()
+        with self._lock:
+            while self._calls and self._calls[0] <= now - self.rate_limit_window:
+                self._calls.popleft()
+            limited = self.rate_limit is not None and len(self._calls) >= self.rate_limit
+            self._calls.append(now)
+            draw = self._rng.random()
+        if limited:
+            self._count("rate_limited")
+            return _error(400, 4, "(#4) Application request limit reached")
+        if draw < self.error_rate:
+            self._count("errors")
+            return _error(500, 2, "An unexpected error has occurred. Please retry your request later.")
+        if upload and draw < self.error_rate + self.spam_rate:
+            self._count("spam")
+            return _error(400, 368, "It looks like you were misusing this feature by going too fast.")
+        return None
+
+    def _delay(self) -> None:
+        if self.latency > 0 or self.latency_jitter > 0:
+            time.sleep(self.latency + random.uniform(0, self.latency_jitter))
+
+    def _reaction_count(self, photo: FakePhoto, reaction: str) -> int:
+        # Every post gets its own pace for every reaction, so that matches have winners and ties are rare
+        pace = random.Random(f"{self.seed}/{photo.photo_id}/{reaction}").uniform(0, 2 * self.votes_per_hour)
+        elapsed_hours = (time.time() - photo.created_time) * self.time_scale / 3600
+        return int(pace * elapsed_hours)
+
+    def _photo_images(self, photo: FakePhoto) -> List[dict]:
+        return [{"height": 480, "width": 640, "source": f"{self.url}_images/{photo.photo_id}.jpg"},
+                {"height": 240, "width": 320, "source": f"{self.url}_images/{photo.photo_id}.jpg?small"}]
+
+    def get_object(self, object_id: str, params: Dict[str, str]) -> Response:
+        photo_id = object_id.split("_", 1)[1] if "_" in object_id else object_id
+        with self._lock:
+            photo = self.photos.get(photo_id)
+        if photo is None:
+            return _error(400, 100, f"Unsupported get request. Object with ID '{object_id}' does not exist.",
+                          "GraphMethodException")
+        result = {"id": object_id}
+        fields = params.get("fields", "")
+        for reaction, alias in _reaction_pattern.findall(fields):
+            result[alias] = {"data": [], "summary": {"total_count": self._reaction_count(photo, reaction.lower())}}
+        fields = _reaction_pattern.sub("", fields)
+        for field in filter(None, fields.split(",")):
+            if field == "page_story_id":
+                result[field] = f"{self.page_id}_{photo.photo_id}"
+            elif field == "images":
+                result[field] = self._photo_images(photo)
+            elif field == "name":
+                result[field] = photo.message
+        return 200, result
+
+    def get_album_photos(self, album_id: str, params: Dict[str, str], access_token: Union[str, None]) -> Response:
+        limit = int(params.get("limit", 25))
+        offset = int(params.get("after", 0))
+        with self._lock:
+            # Newest first, as the Graph API does
+            photos = list(reversed(self.albums.get(album_id, [])))[offset:offset + limit]
+            total = len(self.albums.get(album_id, []))
+        result = {"data": [{"id": photo.photo_id, "name": photo.message,
+                            "created_time": time.strftime("%Y-%m-%dT%H:%M:%S+0000",
+                                                          time.gmtime(photo.created_time))}
+                           for photo in photos]}
+        if offset + limit < total:
+            next_params = {key: value for (key, value) in params.items() if key != "after"}
+            next_params["after"] = str(offset + limit)
+            if access_token is not None:
+                next_params["access_token"] = access_token
+            result["paging"] = {"cursors": {"after": str(offset + limit)},
+                                "next": f"{self.url}{album_id}/photos?{urlencode(next_params)}"}
+        return 200, result
+
+    def put_photo(self, album_id: str, message: str, size: int) -> Response:
+        photo = FakePhoto(self._new_id(), album_id, message, size)
+        with self._lock:
+            self.photos[photo.photo_id] = photo
+            self.albums.setdefault(album_id, []).append(photo)
+        self._count("uploaded_bytes", size)
+        return 200, {"id": photo.photo_id, "post_id": f"{self.page_id}_{photo.photo_id}"}
+
+    def put_comment(self, object_id: str, message: str) -> Response:
+        with self._lock:
+            self.comments.setdefault(object_id, []).append(message)
+        return 200, {"id": f"{object_id}_{self._new_id()}"}
+
+    def handle(self, method: str, path: str, params: Dict[str, str], upload_size: int = 0) -> Response:
+        """
+        Serves a single Graph API call, either direct or from a batch.
+        :param upload_size: the size of the uploaded file, for photo uploads
+        """
+        parts = [part for part in path.split("/") if part]
+        if parts and _version_pattern.match(parts[0]):
+            parts = parts[1:]
+        self._count(f"{method} {'/'.join('{id}' if part.replace('_', '').isdigit() else part for part in parts)}")
+        fault = self._inject_fault(upload=method == "POST" and parts[-1:] == ["photos"])
+        if fault is not None:
+            return fault
+        access_token = params.pop("access_token", None)
+        if method == "GET" and len(parts) == 1:
+            return self.get_object(parts[0], params)
+        if method == "GET" and len(parts) == 2 and parts[1] == "photos":
+            return self.get_album_photos(parts[0], params, access_token)
+        if method == "POST" and len(parts) == 2 and parts[1] == "photos":
+            return self.put_photo(parts[0], params.get("message", ""), upload_size)
+        if method == "POST" and len(parts) == 2 and parts[1] == "comments":
+            return self.put_comment(parts[0], params.get("message", ""))
+        return _error(400, 100, f"Unsupported {method} request to {path}.", "GraphMethodException")
+
+    def handle_batch(self, sub_requests: List[dict]) -> List[dict]:
+        named_results: Dict[str, dict] = dict()
+
+        def resolve(match: re.Match) -> str:
+            return str(named_results.get(match.group(1), {}).get(match.group(2), ""))
+
+        responses = []
+        for sub_request in sub_requests:
+            url = urlparse(_batch_result_pattern.sub(resolve, sub_request["relative_url"]))
+            status, body = self.handle(sub_request.get("method", "GET"), url.path, dict(parse_qsl(url.query)))
+            if "name" in sub_request and status == 200:
+                named_results[sub_request["name"]] = body
+            responses.append({"code": status, "body": json.dumps(body)})
+        return responses
+
+    def photo_content(self, photo_id: str) -> Union[bytes, None]:
+        with self._lock:
+            photo = self.photos.get(photo_id)
+        if photo is None or photo.seed is None:
+            return None
+        return generated_photo(photo.seed)
+
+    def summary(self) -> str:
+        with self._lock:
+            return ", ".join(f"{name}: {count}" for (name, count) in sorted(self.stats.items()))
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class _FakeGraphHandler(BaseHTTPRequestHandler):
+    # Keeps the connections alive, as the pooled sessions expect
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def fake_graph(self) -> FakeGraphServer:
+        return self.server.fake_graph
+
+    def _send(self, status: int, body: Union[dict, list, bytes], content_type: str = "application/json",
+              headers: Dict[str, str] = None) -> None:
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+            content_type += "; charset=UTF-8"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        match = re.match(r"^/_images/(\d+)\.jpg$", url.path)
+        if match is not None:
+            content = self.fake_graph.photo_content(match.group(1))
+            if content is None:
+                self._send(404, b"", "text/plain")
+            else:
+                self._send(200, content, "image/jpeg")
+            return
+        self.fake_graph._delay()
+        status, body = self.fake_graph.handle("GET", url.path, dict(parse_qsl(url.query)))
+        self._send(status, body, headers=self.fake_graph._usage_headers())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        content_type = self.headers.get("Content-Type", "")
+        params = dict(parse_qsl(url.query))
+        upload_size = 0
+        if content_type.startswith("multipart/form-data"):
+            form = BytesParser(policy=policy.HTTP).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + body)
+            for part in form.iter_parts():
+                if part.get_filename() is not None:
+                    upload_size += len(part.get_payload(decode=True))
+                else:
+                    params[part.get_param("name", header="content-disposition")] = part.get_content()
+        else:
+            params.update(parse_qsl(body.decode("utf-8")))
+        self.fake_graph._delay()
+        if url.path.strip("/") == "" and "batch" in params:
+            status, result = 200, self.fake_graph.handle_batch(json.loads(params["batch"]))
+        else:
+            status, result = self.fake_graph.handle("POST", url.path, params, upload_size)
+        self._send(status, result, headers=self.fake_graph._usage_headers())
+
+    def log_message(self, format, *args):
+        pass
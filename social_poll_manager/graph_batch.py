@@ -0,0 +1,130 @@
+import json
+from typing import List, Dict, Union, Iterable
+from urllib.parse import urlencode
+
+import requests
+import facebook
+from facebook import GraphAPI, GraphAPIError
+
+from social_poll_manager.upload_queue import UsageTracker
+
+BatchResult = Union[dict, GraphAPIError]
+
+
+def reaction_summary_fields(reaction_names: Iterable[str]) -> str:
+    """
+    Builds a single fields expansion fetching the total count of every given reaction type. Each summary is aliased
+    as reactions_<name> in the response.
+    :param reaction_names: the reaction names, e.g. ["angry", "love"]
+    """
+    return ",".join(f"reactions.type({name.upper()}).limit(0).summary(total_count).as(reactions_{name})"
+                    for name in reaction_names)
+
+
+def parse_reaction_counts(data: dict, reaction_names: Iterable[str]) -> Dict[str, int]:
+    return {name: data[f"reactions_{name}"]["summary"]["total_count"] for name in reaction_names}
+
+
+class GraphBatcher(object):
+    """
+    Merges Graph API lookups into batch requests of up to max_batch_size sub-requests and spreads the results back to
+    the callers. Results are returned in the same order as the lookups; sub-requests that failed are returned as
+    GraphAPIError instances instead of raising, so that a single failure doesn't discard the whole batch.
+    """
+
+    def __init__(self, graph_api: GraphAPI, graph_url: str = None, session: requests.Session = None,
+                 max_batch_size: int = 50, usage_tracker: UsageTracker = None):
+        self.graph_api = graph_api
+        # Read when built rather than imported, so that it can be pointed to another server
+        self.graph_url = graph_url or facebook.FACEBOOK_GRAPH_URL
+        self.session = session or graph_api.session
+        self.max_batch_size = max_batch_size
+        self.usage_tracker = usage_tracker
+
+    def _relative_url(self, object_id: str, **args) -> str:
+        url = f"{self.graph_api.version}/{object_id}"
+        if args:
+            url += "?" + urlencode(args)
+        return url
+
+    def _post_batch(self, sub_requests: List[dict]) -> List[Union[dict, None]]:
+        response = self.session.post(self.graph_url,
+                                     data={"access_token": self.graph_api.access_token,
+                                           "batch": json.dumps(sub_requests),
+                                           "include_headers": "false"},
+                                     timeout=self.graph_api.timeout)
+        if self.usage_tracker is not None:
+            self.usage_tracker.update(response.headers)
+        result = response.json()
+        if isinstance(result, dict) and "error" in result:
+            raise GraphAPIError(result)
+        return result
+
+    def batch(self, sub_requests: List[dict]) -> List[BatchResult]:
+        """
+        Executes the given sub-requests, splitting them in as many batch calls as needed.
+        :param sub_requests: batch sub-requests in the Graph API format, e.g. {"method": "GET", "relative_url": "..."}
+        :return: the decoded body of every sub-request, or a GraphAPIError for the failed ones
+        """
+        results = []
+        for start in range(0, len(sub_requests), self.max_batch_size):
+            chunk = sub_requests[start:start + self.max_batch_size]
+            for sub_response in self._post_batch(chunk):
+                if sub_response is None:
+                    results.append(GraphAPIError({"error": {"message": "Batch sub-request timed out."}}))
+                    continue
+                try:
+                    body = json.loads(sub_response["body"])
+                except (KeyError, TypeError, ValueError):
+                    body = {"error": {"message": f"Malformed batch response: {sub_response}"}}
+                if sub_response.get("code") != 200 or (isinstance(body, dict) and "error" in body):
+                    results.append(GraphAPIError(body))
+                else:
+                    results.append(body)
+        return results
+
+    def get_objects(self, object_ids: List[str], fields: str) -> Dict[str, BatchResult]:
+        """
+        Fetches the given fields of several objects with batched calls.
+        :return: a dict mapping each object id to its data, or to the GraphAPIError raised while fetching it
+        """
+        sub_requests = [{"method": "GET", "relative_url": self._relative_url(object_id, fields=fields)}
+                        for object_id in object_ids]
+        return dict(zip(object_ids, self.batch(sub_requests)))
+
+    def get_post_reaction_counts(self, post_ids: List[str],
+                                 reaction_names: List[str]) -> Dict[str, Union[Dict[str, int], GraphAPIError]]:
+        """
+        Fetches the reaction counts of every given post. For each post the page story id is resolved and all the
+        reaction summaries are read in the same batch, using a dependent sub-request with a single fields expansion.
+        :param post_ids: ids of the photo posts
+        :param reaction_names: names of the reactions to count
+        :return: a dict mapping each post id to a dict of reaction name -> count, or to the GraphAPIError raised
+        """
+        # Dependent sub-requests must share the batch with the request they depend on
+        if self.max_batch_size % 2 != 0:
+            raise ValueError("max_batch_size must be even to fetch reaction counts.")
+        fields = reaction_summary_fields(reaction_names)
+        sub_requests = []
+        for idx, post_id in enumerate(post_ids):
+            story_request = f"story{idx}"
+            sub_requests.append({"method": "GET", "name": story_request, "omit_response_on_success": False,
+                                 "relative_url": self._relative_url(post_id, fields="page_story_id")})
+            sub_requests.append({"method": "GET",
+                                 "relative_url": self._relative_url(f"{{result={story_request}:$.page_story_id}}",
+                                                                    fields=fields)})
+        results = self.batch(sub_requests)
+        counts = dict()
+        for idx, post_id in enumerate(post_ids):
+            story_result, reactions_result = results[idx * 2], results[idx * 2 + 1]
+            if isinstance(story_result, GraphAPIError):
+                counts[post_id] = story_result
+            elif isinstance(reactions_result, GraphAPIError):
+                counts[post_id] = reactions_result
+            else:
+                try:
+                    counts[post_id] = parse_reaction_counts(reactions_result, reaction_names)
+                except (KeyError, TypeError):
+                    counts[post_id] = GraphAPIError(
+                        {"error": {"message": f"Missing reaction summaries in response: {reactions_result}"}})
+        return counts
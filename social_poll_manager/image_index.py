@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from os import path
+from pathlib import Path
+from typing import Dict, List, Set, Union
+
+from PIL import Image
+
+from social_poll_manager import utils
+from social_poll_manager.utils import auto_str_and_repr
+
+logger = utils.get_logger(__name__)
+
+HASH_BITS = 64
+
+
+@auto_str_and_repr
+class ImageIndexEntry(object):
+
+    def __init__(self, image_id: str, image_path: str, width: int, height: int, file_size: int, mtime_ns: int,
+                 phash: int):
+        self.image_id = image_id
+        self.image_path = image_path
+        self.width = width
+        self.height = height
+        self.file_size = file_size
+        self.mtime_ns = mtime_ns
+        self.phash = phash
+
+
+def difference_hash(image: Image.Image) -> int:
+    """
+    Computes a 64 bit perceptual hash of the image, comparing the brightness of adjacent pixels of a 9x8 thumbnail.
+    Similar images have hashes with a small hamming distance.
+    """
+    pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    phash = 0
+    for row in range(8):
+        for col in range(8):
+            phash = (phash << 1) | (pixels[row * 9 + col] < pixels[row * 9 + col + 1])
+    return phash
+
+
+def probe_image(image_path: str) -> ImageIndexEntry:
+    stat = os.stat(image_path)
+    with Image.open(image_path) as image:
+        width, height = image.size
+        # The hash only needs a tiny thumbnail, so the image can be decoded at the lowest scale
+        image.draft("L", (64, 64))
+        phash = difference_hash(image)
+    return ImageIndexEntry(image_id=Path(image_path).stem, image_path=image_path, width=width, height=height,
+                           file_size=stat.st_size, mtime_ns=stat.st_mtime_ns, phash=phash)
+
+
+def hamming_distance(first: int, second: int) -> int:
+    return bin(first ^ second).count("1")
+
+
+class ImageIndex(object):
+    """
+    Persisted catalogue of the images of the poll, with their dimensions, file size, mtime and perceptual hash.
+    It also records which album photos were already downloaded, so that the album collection can resume per photo.
+    """
+
+    def __init__(self, index_file: str):
+        self.index_file = index_file
+        self.entries: Dict[str, ImageIndexEntry] = dict()
+        # Album photo id -> image id, for every photo downloaded from the source albums
+        self.sources: Dict[str, str] = dict()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.index_file, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        self.entries = {entry["image_id"]: ImageIndexEntry(**entry) for entry in data["entries"]}
+        self.sources = data["sources"]
+
+    def save(self) -> None:
+        with self._lock:
+            data = {"entries": [vars(entry) for entry in self.entries.values()], "sources": dict(self.sources)}
+        utils.safe_write(self.index_file, json.dumps(data, separators=(",", ":")))
+
+    def add_source(self, source_id: str, image_id: str) -> None:
+        with self._lock:
+            self.sources[source_id] = image_id
+
+    def has_source(self, source_id: str) -> bool:
+        with self._lock:
+            return source_id in self.sources
+
+    def update(self, pics_dir: str, workers: int = None) -> None:
+        """
+        Brings the index up to date with the images in pics_dir: new or modified files (by size and mtime) are probed
+        in parallel, deleted ones are dropped.
+        """
+        to_probe = []
+        present = set()
+        for image_path in glob(path.join(pics_dir, "*.jpg")):
+            image_id = Path(image_path).stem
+            present.add(image_id)
+            entry = self.entries.get(image_id)
+            stat = os.stat(image_path)
+            if entry is None or entry.mtime_ns != stat.st_mtime_ns or entry.file_size != stat.st_size \
+                    or entry.image_path != image_path:
+                to_probe.append(image_path)
+        removed = [image_id for image_id in self.entries if image_id not in present]
+        for image_id in removed:
+            del self.entries[image_id]
+        failed = 0
+        if to_probe:
+            logger.info(f"Indexing {len(to_probe)} images...")
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for image_path, result in zip(to_probe, pool.map(_safe_probe_image, to_probe, chunksize=16)):
+                    if result is None:
+                        failed += 1
+                        logger.warning(f"Unable to index image {image_path}.")
+                    else:
+                        self.entries[result.image_id] = result
+        logger.info(f"Image index updated. Indexed:{len(to_probe) - failed}\nRemoved:{len(removed)}\n"
+                    f"Failed:{failed}\nTotal:{len(self.entries)}")
+        if to_probe or removed:
+            self.save()
+
+    def find_duplicates(self, max_distance: int = 0) -> Set[str]:
+        """
+        Finds the images which are duplicates or near-duplicates of another one, i.e. whose perceptual hashes differ
+        by at most max_distance bits. Of every group of duplicates, the image with the highest resolution is kept.
+        Hashes are split in max_distance + 1 bands: two hashes within max_distance bits always share at least one
+        band, so only images sharing a band are compared.
+        :return: the ids of the images to be dropped
+        """
+        bands = max_distance + 1
+        band_bits = -(-HASH_BITS // bands)
+        buckets: Dict[tuple, List[ImageIndexEntry]] = dict()
+        for entry in self.entries.values():
+            for band in range(bands):
+                band_value = (entry.phash >> (band * band_bits)) & ((1 << band_bits) - 1)
+                buckets.setdefault((band, band_value), []).append(entry)
+
+        parents = {image_id: image_id for image_id in self.entries}
+
+        def find(image_id: str) -> str:
+            while parents[image_id] != image_id:
+                parents[image_id] = parents[parents[image_id]]
+                image_id = parents[image_id]
+            return image_id
+
+        for bucket in buckets.values():
+            for i in range(len(bucket)):
+                for j in range(i + 1, len(bucket)):
+                    if hamming_distance(bucket[i].phash, bucket[j].phash) <= max_distance:
+                        parents[find(bucket[i].image_id)] = find(bucket[j].image_id)
+
+        groups: Dict[str, List[ImageIndexEntry]] = dict()
+        for entry in self.entries.values():
+            groups.setdefault(find(entry.image_id), []).append(entry)
+        duplicates = set()
+        for group in groups.values():
+            if len(group) > 1:
+                kept = max(group, key=lambda entry: (entry.width * entry.height, entry.file_size, entry.image_id))
+                logger.info(f"Found duplicate images {[entry.image_id for entry in group]}. Keeping {kept.image_id}.")
+                duplicates.update(entry.image_id for entry in group if entry is not kept)
+        return duplicates
+
+
+def _safe_probe_image(image_path: str) -> Union[ImageIndexEntry, None]:
+    try:
+        return probe_image(image_path)
+    except Exception:
+        return None
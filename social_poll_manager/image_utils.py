@@ -1,5 +1,9 @@
 import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
 from typing import List, Tuple
 from os import path
 
@@ -8,30 +12,133 @@ from PIL import Image
 from facebook import GraphAPI
 
 from social_poll_manager import utils
+from social_poll_manager.graph_batch import GraphBatcher
+from social_poll_manager.image_index import ImageIndex
 
 logger = utils.get_logger(__name__)
 
 
-def compose(images: List[Image.Image], layout: Tuple[int]):
-    bigger_image = max(images, key=lambda img: img.width * img.height)
-    width = bigger_image.width
-    height = bigger_image.height
-    result = Image.new("RGB", (width * layout[0], height * layout[1]))
+def fit_cell_size(sizes: List[Tuple[int, int]], layout: Tuple[int], max_dimension: int = None) -> Tuple[int, int]:
+    """
+    Computes the size of a single cell of a collage: the size of the biggest image, scaled down so that the whole
+    collage fits within max_dimension.
+    """
+    width, height = max(sizes, key=lambda size: size[0] * size[1])
+    if max_dimension:
+        factor = min(1.0, max_dimension / (width * layout[0]), max_dimension / (height * layout[1]))
+        width, height = max(1, int(width * factor)), max(1, int(height * factor))
+    return width, height
+
+
+def fitted_size(size: Tuple[int, int], cell_size: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    :return: the biggest size with the same aspect ratio as size which fits within cell_size
+    """
+    factor = min(cell_size[0] / size[0], cell_size[1] / size[1])
+    return max(1, round(size[0] * factor)), max(1, round(size[1] * factor))
+
+
+def open_image(image_path: str, target_size: Tuple[int, int] = None) -> Image.Image:
+    """
+    Opens an image. If target_size is given, JPEG images are decoded at the smallest reduced scale which is still
+    bigger than target_size, which saves most of the decoding time and memory for big images.
+    """
+    image = Image.open(image_path)
+    if target_size is not None:
+        image.draft("RGB", target_size)
+    return image
+
+
+def fit_image(image: Image.Image, cell_size: Tuple[int, int]) -> Image.Image:
+    """
+    Scales the image, preserving its aspect ratio, to the biggest size fitting within cell_size.
+    """
+    size = fitted_size(image.size, cell_size)
+    if image.size != size:
+        image = image.resize(size, Image.LANCZOS)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
+
+
+def compose(images: List[Image.Image], layout: Tuple[int], max_dimension: int = None) -> Image.Image:
+    """
+    Composes the images in a collage with the given (columns, rows) layout. Every image is fitted in a cell as big as
+    the biggest image, preserving its aspect ratio and centering it, while the whole collage is kept within
+    max_dimension.
+    """
+    cell_width, cell_height = fit_cell_size([image.size for image in images], layout, max_dimension)
+    result = Image.new("RGB", (cell_width * layout[0], cell_height * layout[1]))
     for i in range(layout[0]):
         for j in range(layout[1]):
             idx = (i * layout[1]) + j
             if idx == len(images):
                 return result
-            image = images[idx]
-            # assuming width > height for now
-            if image.height < bigger_image.height:
-                factor = bigger_image.height / image.height
-                image = image.resize((int(image.width * factor), int(image.height * factor)))
-            result.paste(image, (i * width, j * height))
+            image = fit_image(images[idx], (cell_width, cell_height))
+            result.paste(image, (i * cell_width + (cell_width - image.width) // 2,
+                                 j * cell_height + (cell_height - image.height) // 2))
     return result
 
 
-def collect_images_from_albums(album_ids: list[str], graph_api: GraphAPI, target_directory: str) -> None:
+class _CollectionStats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.downloaded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start_time = time.monotonic()
+
+    def add(self, downloaded: int = 0, skipped: int = 0, failed: int = 0, size: int = 0):
+        with self._lock:
+            self.downloaded += downloaded
+            self.skipped += skipped
+            self.failed += failed
+            self.bytes += size
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self.start_time, 1e-6)
+        return f"Downloaded:{self.downloaded}\nSkipped:{self.skipped}\nFailed:{self.failed}\n" \
+               f"Elapsed:{elapsed:.1f}s\nThroughput:{self.downloaded / elapsed:.2f} images/s, " \
+               f"{self.bytes / elapsed / 1024 / 1024:.2f} MB/s"
+
+
+def download_to_file(session: requests.Session, url: str, target_path: str, chunk_size: int = 64 * 1024) -> int:
+    """
+    Streams the body of the given url to disk in chunks. Data is written to a temporary file which is moved to the
+    target path only once the download is complete, so that an interrupted download never leaves a truncated image.
+    :param session: the http session used for the request
+    :param url: the url to download
+    :param target_path: the path where the downloaded file has to be saved
+    :param chunk_size: size of the chunks read from the response body
+    :return: the number of bytes written
+    """
+    part_path = target_path + ".part"
+    size = 0
+    with session.get(url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        with open(part_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                size += len(chunk)
+    os.replace(part_path, target_path)
+    return size
+
+
+def collect_images_from_albums(album_ids: list[str], graph_api: GraphAPI, target_directory: str, workers: int = 8,
+                               session: requests.Session = None, image_index: ImageIndex = None) -> None:
+    """
+    Downloads all the photos contained in the given albums. Every album is paged by its own producer thread, image urls
+    are resolved with batched Graph API calls and a bounded pool of workers downloads the files.
+    :param album_ids: ids of the albums to scrape
+    :param graph_api: the Graph API client
+    :param target_directory: the directory where the images have to be saved
+    :param workers: number of concurrent download workers
+    :param session: the http session shared by the workers. If missing, a pooled session is created
+    :param image_index: if given, the downloaded photos are recorded in the index and the collection resumes from the
+    photos which are still missing. Otherwise the whole collection is skipped once it completes without failures
+    """
     def extract_original_post_id(post_message: str) -> str:
         fb_id_pattern = r"facebook\.com/(\d*)"
         try:
@@ -41,42 +148,115 @@ def collect_images_from_albums(album_ids: list[str], graph_api: GraphAPI, target
 
     done_file = path.join(target_directory, ".done")
 
-    if path.exists(done_file):
+    if image_index is None and path.exists(done_file):
         logger.info("Photos already downloaded. Skipping collection.")
-    else:
-        logger.info("Starting fb image collection...")
+        return
 
-        os.makedirs(target_directory, exist_ok=True)
+    logger.info(f"Starting fb image collection with {workers} workers...")
 
-        downloaded = 0
-        skipped = 0
-        failed = 0
+    os.makedirs(target_directory, exist_ok=True)
+    if session is None:
+        session = utils.create_http_session(pool_size=workers)
 
-        for album_id in album_ids:
-            logger.info(f"Scraping album with id {album_id}...")
+    batcher = GraphBatcher(graph_api)
+    stats = _CollectionStats()
+    pending = Queue(maxsize=batcher.max_batch_size * 2)
+    downloads = Queue(maxsize=workers * 4)
+    seen_ids = set()
+    seen_lock = threading.Lock()
+
+    def produce(album_id: str):
+        logger.info(f"Scraping album with id {album_id}...")
+        try:
             for image_connection in graph_api.get_all_connections(album_id, connection_name="photos"):
+                if image_index is not None and image_index.has_source(image_connection["id"]):
+                    stats.add(skipped=1)
+                    continue
                 if "name" in image_connection and "Original post" in image_connection["name"]:
                     image_id = extract_original_post_id(image_connection["name"])
                 else:
                     image_id = image_connection["id"]
+                with seen_lock:
+                    if image_id in seen_ids:
+                        continue
+                    seen_ids.add(image_id)
                 image_path = path.join(target_directory, f"{image_id}.jpg")
-                if not path.exists(image_path):
-                    image_data = graph_api.get_object(id=image_id, fields="images")
-                    best_image_link = max(image_data["images"], key=lambda im: im["height"])["source"]
-                    logger.info(f"Downloading image with id {image_id} from url {best_image_link}.")
-                    try:
-                        with open(image_path, "wb") as im_file:
-                            im_file.write(requests.get(best_image_link).content)
-                        downloaded += 1
-                    except:
-                        failed += 1
-                        logger.warning(f"Unable to download and save image with connection data: {image_connection}",
-                                       exc_info=True)
-                else:
-                    skipped += 1
-                    logger.info(f"Image f{image_path} already present in directory. Skipping download.")
+                if path.exists(image_path):
+                    stats.add(skipped=1)
+                    if image_index is not None:
+                        image_index.add_source(image_connection["id"], image_id)
+                    logger.info(f"Image {image_path} already present in directory. Skipping download.")
+                    continue
+                pending.put((image_id, image_path, image_connection))
+        except Exception:
+            stats.add(failed=1)
+            logger.warning(f"Unable to scrape album with id {album_id}.", exc_info=True)
+
+    def resolve_batch(batch: list):
+        try:
+            image_datas = batcher.get_objects([image_id for (image_id, _, _) in batch], fields="images")
+        except Exception as e:
+            image_datas = {image_id: e for (image_id, _, _) in batch}
+        for image_id, image_path, image_connection in batch:
+            try:
+                image_data = image_datas[image_id]
+                if isinstance(image_data, Exception):
+                    raise image_data
+                best_image_link = max(image_data["images"], key=lambda im: im["height"])["source"]
+            except Exception:
+                stats.add(failed=1)
+                logger.warning(f"Unable to resolve image with connection data: {image_connection}", exc_info=True)
+                continue
+            downloads.put((image_id, image_path, image_connection, best_image_link))
+
+    def resolve():
+        batch = []
+        while True:
+            try:
+                item = pending.get(block=len(batch) == 0)
+            except Empty:
+                # Nothing else queued right now: flush what we have instead of waiting for a full batch
+                resolve_batch(batch)
+                batch = []
+                continue
+            if item is None:
+                if batch:
+                    resolve_batch(batch)
+                for _ in range(workers):
+                    downloads.put(None)
+                return
+            batch.append(item)
+            if len(batch) == batcher.max_batch_size:
+                resolve_batch(batch)
+                batch = []
+
+    def download():
+        while True:
+            item = downloads.get()
+            if item is None:
+                return
+            image_id, image_path, image_connection, image_link = item
+            logger.info(f"Downloading image with id {image_id} from url {image_link}.")
+            try:
+                stats.add(downloaded=1, size=download_to_file(session, image_link, image_path))
+                if image_index is not None:
+                    image_index.add_source(image_connection["id"], image_id)
+            except Exception:
+                stats.add(failed=1)
+                logger.warning(f"Unable to download and save image with connection data: {image_connection}",
+                               exc_info=True)
+
+    with ThreadPoolExecutor(max_workers=workers + 1, thread_name_prefix="image-download") as download_pool:
+        download_pool.submit(resolve)
+        for _ in range(workers):
+            download_pool.submit(download)
+        with ThreadPoolExecutor(max_workers=len(album_ids) or 1, thread_name_prefix="album-scrape") as album_pool:
+            list(album_pool.map(produce, album_ids))
+        pending.put(None)
 
-        logger.info(f"Finished collecting images.\nDownloaded:{downloaded}\nSkipped:{skipped}\nFailed:{failed}")
-        if failed == 0:
-            with open(done_file, "w") as f:
-                pass
+    logger.info(f"Finished collecting images.\n{stats.summary()}")
+    if image_index is not None:
+        image_index.save()
+    if stats.failed == 0:
+        with open(done_file, "w") as f:
+            pass
@@ -0,0 +1,167 @@
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+from typing import Dict, Iterable, List, Tuple, Union
+
+from PIL import Image, ImageOps
+
+from social_poll_manager import utils
+from social_poll_manager.poll_data import ImageData
+from social_poll_manager.utils import auto_str_and_repr
+
+logger = utils.get_logger(__name__)
+
+
+@auto_str_and_repr
+class IngestEntry(object):
+
+    def __init__(self, image_id: str, source_size: int, source_mtime_ns: int, width: int, height: int):
+        self.image_id = image_id
+        # Size and mtime of the original when it was ingested
+        self.source_size = source_size
+        self.source_mtime_ns = source_mtime_ns
+        # Size of the working copy
+        self.width = width
+        self.height = height
+
+
+def _save_jpeg(image: Image.Image, target_path: str, quality: int) -> None:
+    temp_path = f"{target_path}.{os.getpid()}.tmp"
+    image.save(temp_path, "JPEG", quality=quality, optimize=True)
+    os.replace(temp_path, target_path)
+
+
+def ingest_image(image_path: str, working_path: str, preview_path: str, max_dimension: int,
+                 preview_dimension: int, quality: int) -> Tuple[int, int]:
+    """
+    Writes the working copy of an image, upright, in RGB and within max_dimension, and its preview within
+    preview_dimension.
+    :return: the size of the working copy
+    """
+    with Image.open(image_path) as image:
+        # JPEG images are decoded at the smallest reduced scale which is still bigger than the working copy
+        image.draft("RGB", (max_dimension, max_dimension))
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        _save_jpeg(image, working_path, quality)
+        working_size = image.size
+        image.thumbnail((preview_dimension, preview_dimension), Image.LANCZOS)
+        _save_jpeg(image, preview_path, quality)
+    return working_size
+
+
+def _safe_ingest_image(task: tuple) -> Union[Tuple[int, int], None]:
+    try:
+        return ingest_image(*task)
+    except Exception:
+        return None
+
+
+class ImageIngester(object):
+    """
+    Normalizes the source images of the poll once, so that the match images are rendered from small files which need
+    no conversion: every image gets a working copy with its EXIF orientation applied, in RGB and scaled down to
+    max_dimension, and a preview. Images are ingested in parallel by a pool of processes, and only again when the
+    original changes. A manifest in working_dir keeps track of the ingested images and of the settings used.
+    """
+
+    def __init__(self, working_dir: str, max_dimension: int = 2048, preview_dimension: int = 320, quality: int = 90,
+                 workers: int = None):
+        self.working_dir = working_dir
+        self.max_dimension = max_dimension
+        self.preview_dimension = preview_dimension
+        self.quality = quality
+        self.workers = workers
+        self.manifest_file = path.join(working_dir, ".ingest.json")
+        self.entries: Dict[str, IngestEntry] = dict()
+        self._lock = threading.Lock()
+        os.makedirs(path.join(working_dir, "previews"), exist_ok=True)
+        self._load()
+
+    @property
+    def settings(self) -> dict:
+        return {"max_dimension": self.max_dimension, "preview_dimension": self.preview_dimension,
+                "quality": self.quality}
+
+    def _load(self) -> None:
+        try:
+            with open(self.manifest_file, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        if data["settings"] != self.settings:
+            logger.info(f"Ingest settings changed from {data['settings']}: every image will be ingested again.")
+            return
+        self.entries = {entry["image_id"]: IngestEntry(**entry) for entry in data["entries"]}
+
+    def save(self) -> None:
+        with self._lock:
+            data = {"settings": self.settings, "entries": [vars(entry) for entry in self.entries.values()]}
+        utils.safe_write(self.manifest_file, json.dumps(data, separators=(",", ":")))
+
+    def working_path(self, image_id: str) -> str:
+        return path.join(self.working_dir, f"{image_id}.jpg")
+
+    def preview_path(self, image_id: str) -> str:
+        return path.join(self.working_dir, "previews", f"{image_id}.jpg")
+
+    def working_size(self, image_id: str) -> Union[Tuple[int, int], None]:
+        entry = self.entries.get(image_id)
+        return (entry.width, entry.height) if entry is not None else None
+
+    def _is_current(self, image: ImageData, stat: os.stat_result) -> bool:
+        entry = self.entries.get(image.image_id)
+        return entry is not None and entry.source_size == stat.st_size and \
+            entry.source_mtime_ns == stat.st_mtime_ns and path.exists(self.working_path(image.image_id))
+
+    def ingest(self, images: Iterable[ImageData]) -> None:
+        """
+        Ingests the given images which weren't already, and points them at their working copy and preview. Images
+        which can't be ingested keep being rendered from their original.
+        """
+        to_ingest: List[Tuple[ImageData, os.stat_result]] = []
+        for image in images:
+            try:
+                stat = os.stat(image.image_path)
+            except FileNotFoundError:
+                # The working copy is still usable if the original was removed after being ingested
+                if image.image_id in self.entries and path.exists(self.working_path(image.image_id)):
+                    self._link(image)
+                continue
+            if self._is_current(image, stat):
+                self._link(image)
+            else:
+                to_ingest.append((image, stat))
+        failed = 0
+        if to_ingest:
+            logger.info(f"Ingesting {len(to_ingest)} images...")
+            tasks = [(image.image_path, self.working_path(image.image_id), self.preview_path(image.image_id),
+                      self.max_dimension, self.preview_dimension, self.quality) for (image, _) in to_ingest]
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                for (image, stat), size in zip(to_ingest, pool.map(_safe_ingest_image, tasks, chunksize=16)):
+                    if size is None:
+                        failed += 1
+                        logger.warning(f"Unable to ingest image {image.image_path}.")
+                        with self._lock:
+                            self.entries.pop(image.image_id, None)
+                        if image.working_path is not None:
+                            image.working_path = None
+                            image.preview_path = None
+                        continue
+                    with self._lock:
+                        self.entries[image.image_id] = IngestEntry(image.image_id, stat.st_size, stat.st_mtime_ns,
+                                                                   *size)
+                    self._link(image)
+            self.save()
+        logger.info(f"Images ingested. Ingested:{len(to_ingest) - failed}\nFailed:{failed}\n"
+                    f"Total:{len(self.entries)}")
+
+    def _link(self, image: ImageData) -> None:
+        working_path = self.working_path(image.image_id)
+        if image.working_path != working_path:
+            image.working_path = working_path
+            image.preview_path = self.preview_path(image.image_id)
@@ -0,0 +1,172 @@
+import time
+from io import BytesIO
+from typing import Dict, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from social_poll_manager import utils
+
+# Pillow's values of the subsampling option
+SUBSAMPLING_444 = 0
+SUBSAMPLING_420 = 2
+
+# Fraction of the budget aimed at, since the size estimated at reduced scale is never exact
+_BUDGET_MARGIN = 0.97
+# Outputs filling less than this fraction of the budget are encoded again, as a higher quality probably fits
+_BUDGET_FILL = 0.85
+
+
+def psnr(reference: Image.Image, encoded: Image.Image) -> float:
+    """
+    :return: the peak signal-to-noise ratio of encoded against reference, in dB
+    """
+    difference = np.asarray(reference, dtype=np.float32) - np.asarray(encoded, dtype=np.float32)
+    mse = float(np.mean(difference * difference))
+    return float("inf") if mse == 0 else 10 * np.log10(255 * 255 / mse)
+
+
+@utils.auto_str_and_repr
+class EncodeResult(object):
+    """
+    Outcome of the encoding of an image.
+    """
+
+    def __init__(self, data: bytes, quality: int, subsampling: int, seconds: float, passes: int):
+        self.data = data
+        self.quality = quality
+        self.subsampling = subsampling
+        self.seconds = seconds
+        # Full-size encodings done to find the settings
+        self.passes = passes
+
+    _repr_fields = ("size", "quality", "subsampling", "seconds", "passes")
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+
+class JpegEncoder(object):
+    """
+    Encodes the rendered images as JPEG. With neither max_bytes nor min_psnr, images are saved at the given quality.
+    Otherwise, the settings are searched on a copy of the image reduced by probe_scale, which is much cheaper to encode
+    than the image itself:
+    - max_bytes: the highest quality, down to min_quality, whose output fits within max_bytes
+    - min_psnr: the lowest quality, up to quality, whose output is at least min_psnr dB away from the noise
+    When both are given the budget wins. The reduced scale only gives an estimation of the full size: the search is
+    calibrated with the size of the full encoding and repeated while the output is over budget or far below it, up to
+    max_passes full encodings.
+    """
+
+    def __init__(self, quality: int = 80, max_bytes: int = None, min_psnr: float = None, min_quality: int = 30,
+                 optimize: bool = True, progressive: bool = False, probe_scale: float = 0.5, max_passes: int = 3):
+        if not 1 <= min_quality <= quality <= 95:
+            raise ValueError(f"Invalid JPEG qualities: min_quality={min_quality}, quality={quality}")
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.min_psnr = min_psnr
+        self.min_quality = min_quality
+        self.optimize = optimize
+        self.progressive = progressive
+        self.probe_scale = probe_scale
+        self.max_passes = max_passes
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Identifies the settings changing the output of the encoder.
+        """
+        return (f"q{self.quality}|b{self.max_bytes}|p{self.min_psnr}|m{self.min_quality}|o{int(self.optimize)}|"
+                f"r{int(self.progressive)}|s{self.probe_scale}")
+
+    def _save(self, image: Image.Image, quality: int, subsampling: int) -> bytes:
+        output = BytesIO()
+        image.save(output, "JPEG", quality=quality, subsampling=subsampling, optimize=self.optimize,
+                   progressive=self.progressive)
+        return output.getvalue()
+
+    @staticmethod
+    def _subsampling(quality: int) -> int:
+        # Chroma subsampling costs little at low qualities, where it saves the most, and is visible at high ones
+        return SUBSAMPLING_444 if quality >= 90 else SUBSAMPLING_420
+
+    def _search(self, probe: Image.Image, budget: Union[float, None], sizes: Dict[int, Tuple[int, float]]) -> int:
+        """
+        Binary searches the quality on the reduced image.
+        :param budget: the maximum size of the encoded probe, if any
+        :param sizes: size and PSNR of the probe encodings by quality, shared between the searches
+        :return: the quality to use
+        """
+        def measure(quality: int) -> Tuple[int, float]:
+            if quality not in sizes:
+                data = self._save(probe, quality, self._subsampling(quality))
+                score = psnr(probe, Image.open(BytesIO(data))) if self.min_psnr is not None else 0
+                sizes[quality] = (len(data), score)
+            return sizes[quality]
+
+        def fits(quality: int) -> bool:
+            return budget is None or measure(quality)[0] <= budget
+
+        low, high = self.min_quality, self.quality
+        if not fits(low):
+            return low
+        # Highest quality within the budget
+        while low < high:
+            middle = (low + high + 1) // 2
+            if fits(middle):
+                low = middle
+            else:
+                high = middle - 1
+        if self.min_psnr is None:
+            return low
+        # Lowest quality, below the budget one, reaching the target PSNR
+        best, low = low, self.min_quality
+        while low < best:
+            middle = (low + best) // 2
+            if measure(middle)[1] >= self.min_psnr:
+                best = middle
+            else:
+                low = middle + 1
+        return best
+
+    def encode(self, image: Image.Image) -> EncodeResult:
+        started = time.perf_counter()
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if self.max_bytes is None and self.min_psnr is None:
+            quality = self.quality
+            data = self._save(image, quality, self._subsampling(quality))
+            return EncodeResult(data, quality, self._subsampling(quality), time.perf_counter() - started, 1)
+
+        probe_size = (max(8, round(image.width * self.probe_scale)), max(8, round(image.height * self.probe_scale)))
+        probe = image.resize(probe_size, Image.BILINEAR) if probe_size != image.size else image
+        sizes: Dict[int, Tuple[int, float]] = dict()
+        # Bytes of the full image per byte of the probe, first estimated from the areas then measured
+        ratio = image.width * image.height / (probe.width * probe.height)
+        tried: Dict[int, bytes] = dict()
+        quality, data, passes = self.quality, b"", 0
+        while passes < self.max_passes:
+            budget = self.max_bytes * _BUDGET_MARGIN / ratio if self.max_bytes is not None else None
+            quality = self._search(probe, budget, sizes)
+            if quality in tried:
+                data = tried[quality]
+                break
+            data = self._save(image, quality, self._subsampling(quality))
+            tried[quality] = data
+            passes += 1
+            if self.max_bytes is None:
+                break
+            if len(data) > self.max_bytes:
+                if quality == self.min_quality:
+                    break
+            elif len(data) >= self.max_bytes * _BUDGET_FILL or quality == self.quality:
+                break
+            ratio = len(data) / sizes[quality][0]
+        if self.max_bytes is not None:
+            # The best full encoding within the budget, if any
+            fitting = [q for (q, encoded) in tried.items() if len(encoded) <= self.max_bytes]
+            if fitting:
+                quality = max(fitting)
+                data = tried[quality]
+        return EncodeResult(data, quality, self._subsampling(quality), time.perf_counter() - started, passes)
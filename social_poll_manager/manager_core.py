@@ -1,104 +1,40 @@
-import math
-import random
+import hashlib
+import secrets
 import time
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import timedelta, datetime
-from enum import Enum
 
 from glob import glob
 from io import BytesIO
 from pathlib import Path
-from typing import List, Dict, Tuple, Union
+from typing import List, Dict, Tuple, Union, Callable
 from os import path
 
-import jsonpickle
-from PIL import Image
-from facebook import GraphAPI
-
-from social_poll_manager import utils
-from social_poll_manager.image_utils import compose
-from social_poll_manager.utils import auto_str_and_repr
-
-
-@auto_str_and_repr
-class Reaction(object):
-    def __init__(self, name: str, image: Image.Image, emoji: str):
-        self.name = name
-        self.image = image.convert("RGBA")
-        self.emoji = emoji
-
-    def super_impose(self, image: Image):
-        lower_size = min(image.width, image.height)
-        padding = int(lower_size * 0.05)
-        reaction_size = int(lower_size / 5)
-        resized_reaction_image = self.image.resize((reaction_size, reaction_size))
-        image.paste(resized_reaction_image, (padding, padding), resized_reaction_image)
-
-
-@auto_str_and_repr
-class ImageData(object):
-
-    def __init__(self, image_id: str, image_path: str, fb_url: str = None):
-        self.image_id = image_id
-        self.image_path = image_path
-        self.fb_url = fb_url
-
-
-class MatchStatus(Enum):
-    # Match just generated
-    GENERATED = "generated"
-    # Match posted to facebook
-    POSTED = "posted"
-    # Match over, reactions registered
-    OVER = "over"
-
-
-class PhaseStatus(Enum):
-    # Phase just created
-    CREATED = "created"
-    # Matches generated, phase running, some matches could already be posted but not all
-    GENERATED = "generated"
-    # ALl matches are posted
-    POSTED = "posted"
-    # All matches are over, so is the pase
-    OVER = "over"
-
-
-@auto_str_and_repr
-class MatchParticipantData:
-
-    def __init__(self, image_data: ImageData, assigned_reaction: str):
-        self.image_data = image_data
-        self.assigned_reaction = assigned_reaction
-        self.reactions = 0
-
-
-@auto_str_and_repr
-class MatchData(object):
-
-    def __init__(self, participants: list[MatchParticipantData], match_number: int):
-        self.match_status = MatchStatus.GENERATED
-        self.participants = participants
-        self.post_id: Union[str, None] = None
-        self.match_number = match_number
-        self.posted_time: Union[datetime, None] = None
-
-
-@auto_str_and_repr
-class PhaseData(object):
-
-    def __init__(self, participants: List[ImageData], phase_number: int):
-        self.participants = participants
-        self.matches: List[MatchData] = []
-        self.phase_number = phase_number
-        self.status = PhaseStatus.CREATED
-
-
-@auto_str_and_repr
-class PollData(object):
-
-    def __init__(self, images: Dict[str, ImageData]):
-        self.images = images
-        self.phases: List[PhaseData] = []
+from facebook import GraphAPI, GraphAPIError
+
+from social_poll_manager import utils, metrics
+from social_poll_manager.bracket import BracketPlanner
+from social_poll_manager.graph_batch import GraphBatcher
+from social_poll_manager.image_index import ImageIndex
+from social_poll_manager.image_utils import fit_cell_size, fitted_size
+from social_poll_manager.ingest import ImageIngester
+from social_poll_manager.jpeg_encoder import JpegEncoder
+from social_poll_manager.poll_store import create_poll_store
+from social_poll_manager.profiling import StageProfiler, profiled
+from social_poll_manager.reaction import Reaction
+from social_poll_manager.render_cache import RenderCache
+from social_poll_manager.results import ResultsExporter
+from social_poll_manager.scheduler import Scheduler
+from social_poll_manager.upload_queue import UsageTracker, GraphUploader, UploadQueue
+from social_poll_manager.vote_tracker import VoteTracker
+from social_poll_manager.poll_data import MatchStatus, PhaseStatus, MatchParticipantData, MatchData, PhaseData, \
+    PollData, ImageTable
+
+
+class ReactionsUnavailableError(Exception):
+    """
+    The reactions of some matches could not be collected, even after retrying.
+    """
 
 
 class PollManager:
@@ -107,18 +43,29 @@ class PollManager:
                  max_posts_per_time: int, poll_name: str, post_message: str, page_id: str,
                  max_participants_per_match: int, winner_message: Union[str, None] = None,
                  voting_duration: timedelta = timedelta(hours=6), post_interval: timedelta = timedelta(hours=1),
-                 poll_data_file: str = "poll_data.json", winner_album_id: str = None,
+                 poll_data_file: str = "poll_data.json", poll_data_backend: str = "JSON", winner_album_id: str = None,
                  album_id: str = None, pics_dir: str = "./pics",
-                 interactive_mode: bool = False, original_urls_enabled: bool = False):
+                 interactive_mode: bool = False, original_urls_enabled: bool = False,
+                 reaction_workers: int = 4, graph_calls_per_second: float = 5, reaction_retries: int = 3,
+                 render_cache_dir: str = "render_cache", render_workers: int = None, max_image_dimension: int = None,
+                 image_index: ImageIndex = None, dedup_max_distance: int = None, upload_max_attempts: int = 8,
+                 seed: int = None, vote_tracking_interval: timedelta = None,
+                 vote_tracking_max_interval: timedelta = timedelta(minutes=30), tie_extension: timedelta = None,
+                 max_tie_extensions: int = 1, time_scale: float = 1, jpeg_encoder: JpegEncoder = None,
+                 image_ingester: ImageIngester = None, results_exporter: ResultsExporter = None,
+                 profiler: StageProfiler = None):
 
         self.logger = utils.get_logger(__class__.__name__)
 
         self.graph_api = graph_api
+        self.usage_tracker = UsageTracker()
+        self.graph_batcher = GraphBatcher(graph_api, usage_tracker=self.usage_tracker)
         self.reactions = dict()
         for reaction in reactions:
             self.reactions[reaction.name] = reaction
         self.layout = layout
         self.max_participants_per_match = max_participants_per_match
+        self.bracket_planner = BracketPlanner(layout, max_participants_per_match, len(self.reactions))
         self.max_posts_per_time = max_posts_per_time
         self.voting_duration = voting_duration
         self.post_interval = post_interval
@@ -132,82 +79,169 @@ class PollManager:
         self.post_message = post_message.replace("\\n", "\n")
         self.winner_message = winner_message
         self.poll_data_file = poll_data_file
+        self.poll_data_backend = poll_data_backend
+        self.image_index = image_index
+        self.image_ingester = image_ingester
+        self.results_exporter = results_exporter
+        self.profiler = profiler
+        self.dedup_max_distance = dedup_max_distance
+        self.max_image_dimension = max_image_dimension
+        self.poll_store = create_poll_store(poll_data_backend, poll_data_file)
+        self.upload_queue = UploadQueue(f"{poll_data_file}.uploads.json", GraphUploader(graph_api, self.usage_tracker),
+                                        max_attempts=upload_max_attempts, time_scale=time_scale)
+        self.render_cache = RenderCache(render_cache_dir, self.reactions, workers=render_workers,
+                                        encoder=jpeg_encoder, max_dimension=max_image_dimension)
+        self.reaction_workers = reaction_workers
+        self.reaction_retries = reaction_retries
+        self.rate_limiter = utils.RateLimiter(graph_calls_per_second, burst=reaction_workers)
+        # Internal delays are divided by time_scale in dry runs, like the configured durations
+        self.time_scale = time_scale
+        # Collections still failing after the retries of _get_reactions are tried again later, with backoff, before
+        # the poll is stopped
+        self.reactions_retry_delay = timedelta(minutes=5) / time_scale
+        self.reactions_max_delayed_retries = 5
+        self._reactions_retry_attempt = 0
+        self._reactions_retry_pending = False
+        self.tie_extension = tie_extension
+        self.max_tie_extensions = max_tie_extensions
+        self.vote_tracker: Union[VoteTracker, None] = None
+        if vote_tracking_interval is not None:
+            self.vote_tracker = VoteTracker(self._fetch_reaction_counts, min_interval=vote_tracking_interval,
+                                            max_interval=vote_tracking_max_interval,
+                                            tie_window=max(tie_extension or timedelta(0),
+                                                           timedelta(hours=1) / time_scale),
+                                            on_tie=self._on_tie)
+        self.scheduler: Union[Scheduler, None] = None
         self.poll_data = self._init_poll_data()
-        self.logger.info("Done initializing.")
+        images_revision = self.poll_data.images.revision
+        self._ingest_images()
+        if getattr(self.poll_data, "seed", None) is None:
+            # Polls started before the seed was introduced get one for their next phases
+            self.poll_data.seed = seed if seed is not None else secrets.randbits(63)
+            self._save_poll_data()
+        elif self.poll_data.images.revision != images_revision:
+            self._save_poll_data()
+        self.logger.info(f"Done initializing. Poll seed is {self.poll_data.seed}.")
 
-    def _save_poll_data(self):
-        utils.safe_json_dump(self.poll_data_file, self.poll_data)
+    @profiled("ingest")
+    def _ingest_images(self):
+        if self.image_ingester is not None:
+            self.image_ingester.ingest(self.poll_data.images.values())
+
+    @profiled("save_poll_data")
+    def _save_poll_data(self, *matches: MatchData):
+        """
+        Persists the poll data.
+        :param matches: the matches of the current phase changed since the last save. If none is given, everything
+        that could have changed is saved
+        """
+        with metrics.SERIALIZATION_SECONDS.time(operation="save", backend=self.poll_data_backend):
+            self.poll_store.save(self.poll_data, matches or None)
 
+    @profiled("load_poll_data")
     def _init_poll_data(self) -> PollData:
-        try:
-            with open(self.poll_data_file) as f:
-                data = jsonpickle.decode(f.read())
-                self.logger.info(f"Successfully loaded poll data.")
-                return data
-        except FileNotFoundError:
+        with metrics.SERIALIZATION_SECONDS.time(operation="load", backend=self.poll_data_backend):
+            data = self.poll_store.load()
+        if data is not None:
+            self.logger.info(f"Successfully loaded poll data.")
+            return data
+        else:
             self.logger.warning("File containing poll data not found. Starting fresh.", exc_info=False)
-            images = dict()
-            image_paths = glob(path.join(self.pics_dir, "*.jpg"))
+            images = ImageTable()
+            if self.image_index is not None:
+                duplicates = set()
+                if self.dedup_max_distance is not None:
+                    duplicates = self.image_index.find_duplicates(self.dedup_max_distance)
+                    self.logger.info(f"Dropping {len(duplicates)} duplicate images from the poll.")
+                image_paths = [entry.image_path for (image_id, entry) in sorted(self.image_index.entries.items())
+                               if image_id not in duplicates]
+            else:
+                image_paths = glob(path.join(self.pics_dir, "*.jpg"))
             for image_path in image_paths:
                 im_id = Path(image_path).stem
-                images[im_id] = ImageData(image_id=im_id,
-                                          image_path=image_path,
-                                          fb_url=f"https://facebook.com/{im_id}" if self.original_urls_enabled else None)
+                images.add(image_id=im_id, image_path=image_path,
+                           fb_url=f"https://facebook.com/{im_id}" if self.original_urls_enabled else None)
             poll_data = PollData(images)
-            first_phase = PhaseData(list(images.values()), 1)
+            first_phase = PhaseData(images.values(), 1)
             poll_data.phases.append(first_phase)
             return poll_data
 
-    def upload_photo(self, image: Union[str, BytesIO], message: str, album: str = None) -> str:
+    def upload_photo(self, image: Union[str, BytesIO], message: str, album: str = None, key: str = None) -> str:
         """
-        Uploads a photo to a specific album, or to the news feed if no album id is specified.
+        Uploads a photo to a specific album, or to the news feed if no album id is specified. The upload goes through
+        the upload queue, which paces it according to the Graph API usage and retries it on failure.
         :param image: The image to be posted. Could be a path to an image file or a BytesIO object containing the image
         data
         :param message: The message used as image description
         :param album: The album where to post the image
+        :param key: identifies the upload across restarts, so that it is never posted twice. Defaults to a digest of
+        the message
         :return the resulting post id
+        :raise UploadError: if the photo could not be uploaded even after several retries
         """
+        return self._submit_upload(image, message, album, key).result()
+
+    def _submit_upload(self, image: Union[str, BytesIO], message: str, album: str = None,
+                       key: str = None) -> Future:
         if album is None or album == "":
             album = self.page_id
-        uploaded = False
-        retry_count = 0
-        while not uploaded:
-            try:
-                if type(image) == str:
-                    with open(image, "rb") as im:
-                        page_post_id = \
-                            self.graph_api.put_photo(image=im, message=message, album_path=album + "/photos")[
-                                'id']
-                else:
-                    page_post_id = \
-                        self.graph_api.put_photo(image=image.getvalue(), message=message, album_path=album + "/photos")[
-                            'id']
-                uploaded = True
-            except Exception as e:
-                self.logger.warning("Exception occurred during photo upload.", exc_info=True)
-                if retry_count < 5:
-                    self.logger.warning("Retrying photo upload...")
-                    time.sleep(60 * 30 if "spam" in str(e) else 180)
-                else:
-                    self.logger.error("Unable to post even after several retries. Check what's happening. Bot is"
-                                      " shutting down.")
-                    exit()
-                retry_count += 1
-        return page_post_id
-
-    def _generate_match_image(self, participants: List[MatchParticipantData], layout: Tuple[int]) -> BytesIO:
+        if key is None:
+            key = hashlib.sha1(f"{album}/{message}".encode("utf-8")).hexdigest()
+        return self.upload_queue.submit(key, image, message, album)
+
+    def _generate_match_image(self, participants: List[MatchParticipantData], layout: Tuple[int]) -> str:
+        """
+        :return: the path of the rendered match image. Matches are usually rendered ahead of time by the render cache,
+        otherwise the rendering happens now
+        """
         if (layout[0] * layout[1]) != len(participants):
             raise ValueError(f"Called _generate_match_image() with inconsistent layout and participant list length:"
                              f"{len(participants)} & {layout}")
-        images = []
-        for participant in participants:
-            image = Image.open(participant.image_data.image_path)
-            self.reactions[participant.assigned_reaction].super_impose(image)
-            images.append(image)
-        composed = compose(images, layout)
-        jpeg_bytes = BytesIO()
-        composed.save(jpeg_bytes, "JPEG", quality=80)
-        return jpeg_bytes
+        return self.render_cache.get(participants, layout)
+
+    def _render_size(self, image_id: str) -> Union[Tuple[int, int], None]:
+        """
+        :return: the size of the image the matches are rendered from, if known without opening it
+        """
+        if self.image_ingester is not None:
+            size = self.image_ingester.working_size(image_id)
+            if size is not None:
+                return size
+        entry = self.image_index.entries.get(image_id) if self.image_index is not None else None
+        return (entry.width, entry.height) if entry is not None else None
+
+    def _fitted_image_sizes(self, matches: List[MatchData]) -> List[Tuple[int, int]]:
+        """
+        :return: the sizes the images of the given matches will have once fitted in their collage, computed from the
+        ingest manifest or the image index without opening the files
+        """
+        sizes = []
+        for match in matches:
+            image_sizes = [self._render_size(participant.image_data.image_id) for participant in match.participants]
+            if None in image_sizes:
+                continue
+            cell_size = fit_cell_size(image_sizes, self.layout[len(match.participants)], self.max_image_dimension)
+            sizes += [fitted_size(image_size, cell_size) for image_size in image_sizes]
+        return sizes
+
+    @profiled("prerender")
+    def _prerender_matches(self):
+        matches = self._get_current_phase().matches
+        to_render = [match for match in matches if match.match_status == MatchStatus.GENERATED]
+        # The images of the posted matches aren't needed anymore, and their sources may be gone
+        self.render_cache.prune(to_render, self.layout)
+        if self.image_index is not None or self.image_ingester is not None:
+            self.render_cache.precompute_overlays(self._fitted_image_sizes(to_render))
+        self.render_cache.prerender(to_render, self.layout)
+
+    def _wait_for_enter(self, message: str):
+        self.logger.info(message)
+        if self.profiler is None:
+            input()
+            return
+        # The time spent waiting doesn't belong to the profiled stage
+        with self.profiler.paused():
+            input()
 
     def _get_current_phase(self) -> PhaseData:
         return self.poll_data.phases[-1]
@@ -219,41 +253,47 @@ class PollManager:
         return len(current_phase.matches) == 1
 
     def _is_playoff_phase(self) -> bool:
+        if len(self.poll_data.phases) < 2:
+            return False
         previous_phase = self.poll_data.phases[-2]
         return len(previous_phase.matches) == 1
 
+    def _log_plan(self):
+        current_phase = self._get_current_phase()
+        plan = self.bracket_planner.plan(len(current_phase.participants), current_phase.phase_number)
+        self.logger.info(f"Planned {len(plan)} phases and {sum(len(phase.match_sizes) for phase in plan)} posts "
+                         f"until the end of the poll (ties can add more).")
+        for phase in plan:
+            self.logger.info(f"Phase {phase.phase_number}: {phase.participants} participants in "
+                             f"{len(phase.match_sizes)} matches.")
+
+    @profiled("generate_matches")
     def _generate_matches(self):
         current_phase_data = self._get_current_phase()
-        participants = current_phase_data.participants
-        random.shuffle(participants)
-        match_number = int(math.ceil(len(participants) / self.max_participants_per_match))
-        participant_idx = 0
-        for i in range(match_number):
-            match_participants: List[MatchParticipantData] = []
-            match_participants_num = self.max_participants_per_match
-            if i == match_number - 2:
-                remaining_participants = len(participants) - participant_idx
-                # avoid auto win on last match
-                if remaining_participants == self.max_participants_per_match + 1:
-                    match_participants_num -= 1
-            elif i == match_number - 1:
-                match_participants_num = len(participants) - participant_idx
-            reactions = list(self.reactions.values())
-            random.shuffle(reactions)
-            for j in range(match_participants_num):
-                match_participant = MatchParticipantData(participants[participant_idx], reactions[j].name)
-                match_participants.append(match_participant)
-                participant_idx += 1
-            current_phase_data.matches.append(MatchData(match_participants, i + 1))
+        image_rows = current_phase_data.participants.rows
+        assignment = self.bracket_planner.assign(len(image_rows), self.poll_data.seed,
+                                                 current_phase_data.phase_number)
+        # Matches are appended to the phase table in bulk, without building the matches nor their participants
+        table = current_phase_data.matches.table
+        match_rows, match_reactions = assignment.columns(image_rows, [table.reaction_code(name)
+                                                                      for name in self.reactions])
+        table.extend(assignment.match_sizes.tolist(), match_rows, match_reactions)
         current_phase_data.status = PhaseStatus.GENERATED
         self._save_poll_data()
 
-    def _post_match(self, match: MatchData):
+    def _match_upload_key(self, match: MatchData) -> str:
+        return f"phase{self._get_current_phase().phase_number}-match{match.match_number}"
+
+    def _submit_match(self, match: MatchData) -> Future:
+        """
+        Renders the match image, if needed, and queues its upload.
+        :return: a future resolving to the post id
+        """
         current_phase = self._get_current_phase()
         if current_phase.status != PhaseStatus.GENERATED:
-            raise RuntimeError(f"Invoked _post_match() while phase is not in the generated status!")
+            raise RuntimeError(f"Invoked _submit_match() while phase is not in the generated status!")
         if match.match_status != MatchStatus.GENERATED:
-            raise RuntimeError(f"Invoked _post_match() while match is not in the generated status!")
+            raise RuntimeError(f"Invoked _submit_match() while match is not in the generated status!")
         message = self.post_message \
             .replace("$POLL_NAME$", self.poll_name) \
             .replace("$PHASE_NUMBER$", str(current_phase.phase_number)) \
@@ -263,10 +303,15 @@ class PollManager:
             message += "\nFINAL MATCH"
         elif self._is_playoff_phase():
             message += "\nPLAYOFF MATCH"
-        match.post_id = self.upload_photo(
-            self._generate_match_image(match.participants, self.layout[len(match.participants)]),
-            message,
-            self.album_id)
+        return self._submit_upload(self._generate_match_image(match.participants, self.layout[len(match.participants)]),
+                                   message, self.album_id, key=self._match_upload_key(match))
+
+    @metrics.traced("post_match", lambda self, match, upload: {"poll": self.poll_name, "match": match.match_number})
+    def _post_match(self, match: MatchData, upload: Future):
+        """
+        Waits for the upload of the match image and marks the match as posted.
+        """
+        match.post_id = upload.result()
         match.match_status = MatchStatus.POSTED
         match.posted_time = datetime.now()
         if self.original_urls_enabled:
@@ -274,84 +319,283 @@ class PollManager:
                                  f"{participant.image_data.fb_url}"
                                  for participant in match.participants]
             comment_message = "\n".join(participants_urls)
-            self.graph_api.put_comment(match.post_id, comment_message)
-        self._save_poll_data()
-
-    def _post_loop(self):
+            try:
+                self.graph_api.put_comment(match.post_id, comment_message)
+            except GraphAPIError:
+                # The match is posted anyway, the links are a courtesy
+                self.logger.warning(f"Unable to comment the original urls of match {match.match_number}.",
+                                    exc_info=True)
+        self._save_poll_data(match)
+        # The post id is in the poll data now, the upload queue doesn't need to remember it anymore
+        self.upload_queue.forget(self._match_upload_key(match))
+        self._track_votes(match)
+
+    def _track_votes(self, match: MatchData):
+        if self.vote_tracker is not None:
+            self.vote_tracker.track(match.match_number, match.post_id,
+                                    [participant.assigned_reaction for participant in match.participants],
+                                    self._match_deadline(match))
+
+    def _on_tie(self, match_number: int, standings: List[Tuple[str, int]]):
+        if self.tie_extension is not None:
+            self.logger.warning(f"{self.poll_name}: match {match_number} is tied ({standings}). It will be extended "
+                                f"by {self.tie_extension} if it is still tied at its deadline.")
+        else:
+            self.logger.warning(f"{self.poll_name}: match {match_number} is tied ({standings}). If it is still tied at "
+                                f"its deadline every tied participant advances, unless it is extended with "
+                                f"extend_match().")
+
+    def extend_match(self, match_number: int, extension: timedelta):
+        """
+        Grants more voting time to a posted match of the current phase, e.g. to break a tie. Safe to call from any
+        thread: the extension is applied by a job of the poll.
+        """
+        self._schedule(datetime.now(), f"extend match {match_number}",
+                       lambda: self._extend_match(match_number, extension))
+
+    def _extend_match(self, match_number: int, extension: timedelta):
+        match = next((match for match in self._get_current_phase().matches if match.match_number == match_number),
+                     None)
+        if match is None or match.match_status != MatchStatus.POSTED:
+            self.logger.warning(f"Unable to extend match {match_number}: it is not open.")
+            return
+        match.extension = getattr(match, "extension", timedelta(0)) + extension
+        self._save_poll_data(match)
+        self.logger.info(f"Match {match_number} extended by {extension}. It now closes at "
+                         f"{self._match_deadline(match)}.")
+        self._track_votes(match)
+        self._schedule(self._match_deadline(match), f"close match {match_number}", self._close_matches)
+
+    def _match_deadline(self, match: MatchData) -> datetime:
+        return match.posted_time + self.voting_duration + getattr(match, "extension", timedelta(0))
+
+    def _next_batch_time(self) -> datetime:
+        """
+        :return: when the next batch of matches of the current phase can be posted
+        """
+        posted_matches = [match for match in self._get_current_phase().matches
+                          if match.match_status != MatchStatus.GENERATED]
+        # An interrupted batch is completed right away
+        if not posted_matches or len(posted_matches) % self.max_posts_per_time != 0:
+            return datetime.now()
+        return max(match.posted_time for match in posted_matches) + self.post_interval
+
+    @metrics.traced("post_batch", lambda self: {"poll": self.poll_name})
+    @profiled("post_batch")
+    def _post_batch(self):
         phase_data = self._get_current_phase()
         if phase_data.status != PhaseStatus.GENERATED:
-            raise RuntimeError(f"Invoked _post_loop() while phase is not in the running status!")
-        posted = 0
-        for match in self._get_current_phase().matches:
-            if match.match_status == MatchStatus.POSTED:
-                continue
+            raise RuntimeError(f"Invoked _post_batch() while phase is not in the running status!")
+        to_post = [match for match in phase_data.matches if match.match_status == MatchStatus.GENERATED]
+        # Uploads run in the background, so the image of a match is rendered while the previous one is uploading
+        uploads = []
+        for match in to_post[:self.max_posts_per_time]:
             self.logger.info(f"Posting match {match}...")
-            self._post_match(match)
-            self._save_poll_data()
-            posted += 1
-            if (posted % self.max_posts_per_time) == 0:
-                self.logger.info(f"Reached max posts per time limit of {self.max_posts_per_time}.")
-                if self.interactive_mode:
-                    self.logger.info("Press enter to post the next batch.")
-                    input()
-                else:
-                    self.logger.info(f"Next batch will be posted after {self.post_interval}.")
-                    time.sleep(self.post_interval.seconds)
+            uploads.append((match, self._submit_match(match)))
+        for match, upload in uploads:
+            self._post_match(match, upload)
+            self._schedule(self._match_deadline(match), f"close match {match.match_number}", self._close_matches)
+        if len(to_post) > self.max_posts_per_time:
+            self.logger.info(f"Reached max posts per time limit of {self.max_posts_per_time}.")
+            if self.interactive_mode:
+                self._wait_for_enter("Press enter to post the next batch.")
+            else:
+                self.logger.info(f"Next batch will be posted after {self.post_interval}.")
+            self._schedule(self._next_batch_time() if not self.interactive_mode else datetime.now(), "post batch",
+                           self._post_batch)
+            return
         phase_data.status = PhaseStatus.POSTED
         self._save_poll_data()
+        # Every match is rendered: release the render workers until the next phase
+        self.render_cache.close()
+        self.logger.info(f"All the matches for phase {phase_data.phase_number} have been posted. Now waiting for "
+                         f"completion.")
+        self._check_phase_end()
 
-    def _get_reactions(self, match: MatchData):
-        self.logger.info(f"Getting reactions for match {match.match_number}...")
-        page_story_id = self.graph_api.get_object(match.post_id, fields="page_story_id")["page_story_id"]
-        for participant in match.participants:
-            reacts = self.graph_api.get_object(
-                id=page_story_id,
-                fields=f"reactions.limit(0).type({participant.assigned_reaction.upper()}).summary(total_count)"
-            )["reactions"]["summary"]["total_count"]
-            self.logger.info(f"Participant {participant.image_data.image_id} got {reacts} reactions.")
-            participant.reactions = reacts
-
-    def _collect_reactions(self):
-        matches = self._get_current_phase().matches
-        for match in matches:
-            if match.match_status == MatchStatus.GENERATED:
-                raise RuntimeError(f"Invoked _collect_reactions() while some match was not posted yet!")
-            if match.match_status == MatchStatus.OVER:
+    def _fetch_reaction_counts(self, post_ids: List[str]) -> Dict[str, Union[Dict[str, int], Exception]]:
+        """
+        Looks up the reaction counts of the given posts in a single batch call, paced by the rate limiter.
+        :return: the counts of every post, or the exception raised looking it up
+        """
+        self.rate_limiter.acquire()
+        try:
+            return self.graph_batcher.get_post_reaction_counts(post_ids, list(self.reactions.keys()))
+        except Exception as e:
+            return {post_id: e for post_id in post_ids}
+
+    def _get_reactions(self, matches: List[MatchData]) -> Dict[int, Dict[str, int]]:
+        """
+        Fetches the reaction counts of the given matches concurrently, with batched calls paced by the rate limiter.
+        Matches whose lookup failed are retried a few times with an increasing delay.
+        :return: a dict mapping the number of each match to its reaction counts. Matches that could not be read even
+        after retrying are missing from the result
+        """
+        matches_per_call = self.graph_batcher.max_batch_size // 2
+        results = dict()
+
+        def fetch(chunk: List[MatchData]) -> Dict[str, Union[Dict[str, int], Exception]]:
+            return self._fetch_reaction_counts([match.post_id for match in chunk])
+
+        remaining = matches
+        for attempt in range(self.reaction_retries + 1):
+            if attempt > 0:
+                metrics.RETRIES.inc(len(remaining), operation="reactions")
+                self.logger.warning(f"Unable to get reactions for {len(remaining)} matches. Retrying "
+                                    f"(attempt {attempt} of {self.reaction_retries})...")
+                time.sleep(2 ** attempt / self.time_scale)
+            chunks = [remaining[i:i + matches_per_call] for i in range(0, len(remaining), matches_per_call)]
+            failed = []
+            with ThreadPoolExecutor(max_workers=self.reaction_workers, thread_name_prefix="reactions") as pool:
+                for chunk, chunk_counts in zip(chunks, pool.map(fetch, chunks)):
+                    for match in chunk:
+                        counts = chunk_counts[match.post_id]
+                        if isinstance(counts, Exception):
+                            self.logger.warning(f"Unable to get reactions for match {match.match_number}: {counts}")
+                            failed.append(match)
+                        else:
+                            results[match.match_number] = counts
+            remaining = failed
+            if not remaining:
+                break
+        return results
+
+    def _should_extend(self, match: MatchData, counts: Dict[str, int]) -> bool:
+        """
+        :return: whether the match is tied at the top and can still be extended automatically
+        """
+        if self.tie_extension is None or len(match.participants) < 2:
+            return False
+        if getattr(match, "extension", timedelta(0)) >= self.tie_extension * self.max_tie_extensions:
+            return False
+        top = sorted((counts[participant.assigned_reaction] for participant in match.participants), reverse=True)
+        return top[0] == top[1]
+
+    @metrics.traced("collect_reactions", lambda self, to_collect: {"poll": self.poll_name, "matches": len(to_collect)})
+    def _collect_reactions(self, to_collect: List[MatchData]):
+        for match in to_collect:
+            if match.match_status != MatchStatus.POSTED:
+                raise RuntimeError(f"Invoked _collect_reactions() on match {match.match_number} which is not in the "
+                                   f"posted status!")
+            if self._match_deadline(match) > datetime.now():
+                raise RuntimeError(f"Invoked _collect_reactions() while match {match.match_number} was not over yet!")
+        self.logger.info(f"Getting reactions for {len(to_collect)} matches...")
+        reaction_counts = self._get_reactions(to_collect)
+        for match in to_collect:
+            if match.match_number not in reaction_counts:
+                continue
+            counts = reaction_counts[match.match_number]
+            if self._should_extend(match, counts):
+                match.extension = getattr(match, "extension", timedelta(0)) + self.tie_extension
+                self.logger.info(f"Match {match.match_number} is tied. Extending it by {self.tie_extension}, until "
+                                 f"{self._match_deadline(match)}.")
+                self._track_votes(match)
+                self._schedule(self._match_deadline(match), f"close match {match.match_number}",
+                               self._close_matches)
                 continue
-            if (match.posted_time + self.voting_duration) > datetime.now():
-                raise RuntimeError(f"Invoked _collect_reactions() while some match was not over yet!")
-            self._get_reactions(match)
+            for participant in match.participants:
+                participant.reactions = counts[participant.assigned_reaction]
+                self.logger.info(f"Match {match.match_number}: participant {participant.image_data.image_id} got "
+                                 f"{participant.reactions} reactions.")
             match.match_status = MatchStatus.OVER
-            self._save_poll_data()
-
-    def _wait_for_phase_end(self):
+            if self.vote_tracker is not None:
+                self.vote_tracker.untrack(match.match_number)
+        # Successful lookups are committed all together, failed ones are left for the next attempt
+        self._save_poll_data(*to_collect)
+        missing = len(to_collect) - len(reaction_counts)
+        if missing > 0:
+            raise ReactionsUnavailableError(f"Unable to get reactions for {missing} matches even after several "
+                                            f"retries.")
+
+    @profiled("collect_reactions")
+    def _close_matches(self, retry: bool = False):
+        """
+        Collects the reactions of every posted match whose voting window is over.
+        :param retry: whether this is the delayed retry of a failed collection. While one is pending, it collects
+        every due match in place of the other jobs
+        """
+        if retry:
+            self._reactions_retry_pending = False
+        elif self._reactions_retry_pending:
+            return
+        now = datetime.now()
+        due = [match for match in self._get_current_phase().matches
+               if match.match_status == MatchStatus.POSTED and self._match_deadline(match) <= now]
+        if not due:
+            return
+        try:
+            self._collect_reactions(due)
+        except ReactionsUnavailableError:
+            if self._reactions_retry_attempt >= self.reactions_max_delayed_retries:
+                self.logger.error(f"Reactions still missing after {self._reactions_retry_attempt} delayed retries. "
+                                  f"Stopping the poll.")
+                raise
+            delay = self.reactions_retry_delay * 2 ** self._reactions_retry_attempt
+            self._reactions_retry_attempt += 1
+            self.logger.warning(f"Some reactions could not be collected. Retrying in {delay} (delayed retry "
+                                f"{self._reactions_retry_attempt} of {self.reactions_max_delayed_retries}).",
+                                exc_info=True)
+            self._reactions_retry_pending = True
+            self._schedule(now + delay, "close matches", lambda: self._close_matches(retry=True))
+            return
+        self._reactions_retry_attempt = 0
+        self._check_phase_end()
+
+    def _schedule(self, when: datetime, name: str, job: Callable[[], None]):
+        # Jobs of the same poll are keyed by its state file, so that they never run concurrently
+        self.scheduler.schedule(when, f"{self.poll_name}: {name}", job, key=self.poll_data_file)
+
+    def _check_phase_end(self):
         phase_data = self._get_current_phase()
-        if phase_data.status != PhaseStatus.POSTED:
-            raise ValueError("Called _wait_for_phase_end() while phase status is not POSTED!")
-        latest_post_time = max(phase_data.matches, key=lambda match: match.posted_time).posted_time
-        latest_post_time_expire = latest_post_time + self.voting_duration
-        if latest_post_time_expire > datetime.now():
-            wait_timedelta = latest_post_time_expire - datetime.now()
-            self.logger.info(f"Phase {phase_data.phase_number} will end in {wait_timedelta}. Sleeping until then.")
-            time.sleep(wait_timedelta.seconds)
-        self.logger.info(f"Phase {phase_data.phase_number} is over. Collecting data...")
-        self._collect_reactions()
+        if phase_data.status != PhaseStatus.POSTED or \
+                any(match.match_status != MatchStatus.OVER for match in phase_data.matches):
+            return
+        self.logger.info(f"Phase {phase_data.phase_number} is over.")
         phase_data.status = PhaseStatus.OVER
         self._save_poll_data()
+        self._export_results()
+        self._schedule(datetime.now(), "next phase", self._advance_phase)
 
-    def _handle_current_phase(self):
+    @metrics.traced("open_phase", lambda self: {"poll": self.poll_name,
+                                                "phase": self._get_current_phase().phase_number})
+    def _open_phase(self):
+        """
+        Schedules the jobs needed to bring forward the current phase, based on its persisted state.
+        """
         phase_data = self._get_current_phase()
         phase_number = phase_data.phase_number
+        if phase_data.status == PhaseStatus.CREATED and len(phase_data.participants) <= 1:
+            self._handle_poll_end()
+            return
         if phase_data.status == PhaseStatus.CREATED:
             self.logger.info(f"Generating matches for phase {phase_number}...")
+            self._log_plan()
             self._generate_matches()
         if phase_data.status == PhaseStatus.GENERATED:
+            self.logger.info(f"Rendering match images for phase {phase_number}...")
+            self._prerender_matches()
             self.logger.info(f"Starting post loop for phase {phase_number}...")
-            self._post_loop()
+            self._schedule(self._next_batch_time(), "post batch", self._post_batch)
+        if phase_data.status in (PhaseStatus.GENERATED, PhaseStatus.POSTED):
+            for match in phase_data.matches:
+                if match.match_status == MatchStatus.POSTED:
+                    self._track_votes(match)
+                    self._schedule(self._match_deadline(match), f"close match {match.match_number}",
+                                   self._close_matches)
         if phase_data.status == PhaseStatus.POSTED:
-            self.logger.info(f"All the matches for phase {phase_number} have been posted. Now waiting for "
-                             f"completion.")
-            self._wait_for_phase_end()
+            # Also ends the phase, scheduling the next one, if its last match was saved over just before a restart
+            self._check_phase_end()
+        elif phase_data.status == PhaseStatus.OVER:
+            self._schedule(datetime.now(), "next phase", self._advance_phase)
+
+    @metrics.traced("phase_transition", lambda self: {"poll": self.poll_name,
+                                                      "phase": self._get_current_phase().phase_number})
+    @profiled("phase_transition")
+    def _advance_phase(self):
+        if self.interactive_mode:
+            self._wait_for_enter(f"Phase {self._get_current_phase().phase_number} is over. Press enter to proceed "
+                                 f"with next phase.")
+        self._generate_next_phase()
+        self._schedule(datetime.now(), "open phase", self._open_phase)
 
     def _generate_next_phase(self):
         previous_phase_data = self._get_current_phase()
@@ -370,21 +614,64 @@ class PollManager:
         self.poll_data.phases.append(new_phase_data)
         self._save_poll_data()
 
+    def _export_results(self):
+        if self.results_exporter is None:
+            return
+        try:
+            with metrics.SERIALIZATION_SECONDS.time(operation="export", backend=self.results_exporter.file_format):
+                results = self.results_exporter.export(self.poll_data)
+        except Exception:
+            # The results can be exported again from the poll data, so this must not stop the poll
+            self.logger.exception(f"Unable to export the results to {self.results_exporter.target_dir}.")
+            return
+        phases = results.phases
+        if len(phases["phase_number"]):
+            self.logger.info(f"Results exported to {self.results_exporter.target_dir}. Phase "
+                             f"{phases['phase_number'][-1]}: {phases['total_votes'][-1]} votes, average margin "
+                             f"{phases['mean_margin'][-1]}.")
+
+    @profiled("poll_end")
     def _handle_poll_end(self):
         winner = self.poll_data.phases[-1].participants[0]
         self.logger.info(f"Poll finished! Winner is {winner}")
+        self._export_results()
         if self.winner_album_id is not None:
             winner_message = self.winner_message.replace("$POLL_NAME$", self.poll_name)
             if self.original_urls_enabled:
                 winner_message += f"\n\nOriginal post: {winner.fb_url}"
-            self.upload_photo(winner.image_path, message=winner_message, album=self.winner_album_id)
+            self.upload_photo(winner.image_path, message=winner_message, album=self.winner_album_id, key="winner")
+
+    def schedule(self, scheduler: Scheduler):
+        """
+        Registers the poll on the given scheduler, resuming from the persisted state.
+        """
+        self.scheduler = scheduler
+        metrics.QUEUE_DEPTH.set_function(scheduler.pending, queue="scheduler")
+        metrics.QUEUE_DEPTH.set_function(self.upload_queue.pending, queue="uploads", poll=self.poll_name)
+        metrics.QUEUE_DEPTH.set_function(self.render_cache.pending, queue="renders", poll=self.poll_name)
+        if self.vote_tracker is not None:
+            self.vote_tracker.start()
+        self._schedule(datetime.now(), "open phase", self._open_phase)
+
+    def close(self):
+        """
+        Releases the resources held by the poll manager.
+        """
+        metrics.QUEUE_DEPTH.remove(queue="uploads", poll=self.poll_name)
+        metrics.QUEUE_DEPTH.remove(queue="renders", poll=self.poll_name)
+        if self.vote_tracker is not None:
+            self.vote_tracker.stop()
+        self.upload_queue.close()
+        self.render_cache.close()
 
     def start(self):
-        while len(self._get_current_phase().participants) > 1:
-            self._handle_current_phase()
-            if self.interactive_mode:
-                self.logger.info(f"Phase {self._get_current_phase().phase_number} is over. Press enter to "
-                                 f"proceed with next phase.")
-                input()
-            self._generate_next_phase()
-        self._handle_poll_end()
+        scheduler = Scheduler()
+        self.schedule(scheduler)
+        try:
+            scheduler.run()
+        finally:
+            self.close()
+        # The scheduler only stops the jobs of a failed poll, a poll run on its own fails as a whole
+        error = scheduler.failures.get(self.poll_data_file)
+        if error is not None:
+            raise error
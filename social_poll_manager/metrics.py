@@ -0,0 +1,380 @@
+import functools
+import itertools
+import json
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Dict, Iterator, List, Tuple, Union, TYPE_CHECKING
+from urllib.parse import urlparse
+
+if TYPE_CHECKING:
+    import requests
+
+from social_poll_manager import utils
+
+logger = utils.get_logger(__name__)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(kb * 1024 for kb in (64, 128, 256, 512, 1024, 2048, 4096, 8192))
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((name, str(value)) for (name, value) in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for (_, value) in labels)
+    return "{" + ",".join(f"{name}=\"{value}\"" for ((name, _), value) in zip(labels, escaped)) + "}"
+
+
+class Metric(object):
+    type_name = "untyped"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        raise NotImplementedError
+
+    def to_dict(self) -> dict:
+        return {"type": self.type_name, "description": self.description,
+                "samples": [{"name": name, "labels": dict(labels), "value": value}
+                            for (name, labels, value) in self.samples()]}
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self._values: Dict[Labels, float] = dict()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(_labels(labels), 0)
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        with self._lock:
+            return [(f"{self.name}_total", labels, value) for (labels, value) in self._values.items()]
+
+
+class Gauge(Metric):
+    """
+    A value which can go up and down. Values can also be given as functions, read at every export, e.g. for the depth
+    of a queue.
+    """
+    type_name = "gauge"
+
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self._values: Dict[Labels, Union[float, Callable[[], float]]] = dict()
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[_labels(labels)] = value
+
+    def set_function(self, function: Callable[[], float], **labels) -> None:
+        with self._lock:
+            self._values[_labels(labels)] = function
+
+    def remove(self, **labels) -> None:
+        with self._lock:
+            self._values.pop(_labels(labels), None)
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        with self._lock:
+            values = list(self._values.items())
+        samples = []
+        for labels, value in values:
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    logger.warning(f"Unable to read gauge {self.name}{_format_labels(labels)}.", exc_info=True)
+                    continue
+            samples.append((self.name, labels, value))
+        return samples
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+        # Labels -> (count per bucket, with a last one for +Inf, sum)
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = dict()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels(labels)
+        bucket = next((idx for (idx, bound) in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bucket] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        samples = []
+        with self._lock:
+            values = [(labels, list(counts), total[0]) for (labels, (counts, total)) in self._values.items()]
+        for labels, counts, total in values:
+            cumulative = list(itertools.accumulate(counts))
+            for bound, count in zip(self.buckets, cumulative):
+                samples.append((f"{self.name}_bucket", labels + (("le", repr(float(bound))),), count))
+            samples.append((f"{self.name}_bucket", labels + (("le", "+Inf"),), cumulative[-1]))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, cumulative[-1]))
+        return samples
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = dict()
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self._register(Counter(name, description))
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        return self._register(Gauge(name, description))
+
+    def histogram(self, name: str, description: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, description, buckets))
+
+    def to_prometheus(self) -> str:
+        """
+        :return: every metric in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.to_dict() for metric in metrics}
+
+
+class Span(object):
+
+    def __init__(self, name: str, span_id: int, parent_id: Union[int, None], attributes: Dict[str, object]):
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration: Union[float, None] = None
+        self.error: Union[str, None] = None
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "id": self.span_id, "parent_id": self.parent_id, "start": self.start,
+                "duration": self.duration, "attributes": self.attributes, "error": self.error,
+                "thread": threading.current_thread().name}
+
+
+class Tracer(object):
+    """
+    Records the duration of named spans of work, nested per thread. Disabled by default, in which case span() costs
+    almost nothing. The most recent spans are kept in memory for the exporters.
+    """
+
+    def __init__(self, max_spans: int = 10000):
+        self.enabled = False
+        self._spans = deque(maxlen=max_spans)
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Union[Span, None]]:
+        if not self.enabled:
+            yield None
+            return
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        span = Span(name, next(self._ids), stack[-1].span_id if stack else None,
+                    {key: str(value) for (key, value) in attributes.items()})
+        stack.append(span)
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            stack.pop()
+            with self._lock:
+                self._spans.append(span.to_dict())
+            SPAN_SECONDS.observe(span.duration, span=name)
+
+    def recent_spans(self) -> List[dict]:
+        with self._lock:
+            return list(self._spans)
+
+
+registry = MetricsRegistry()
+tracer = Tracer()
+
+
+def traced(name: str, attributes: Callable[..., Dict[str, object]] = None):
+    """
+    Decorator running every call of the function in a span.
+    :param attributes: computes the attributes of the span from the arguments of the call
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            with tracer.span(name, **(attributes(*args, **kwargs) if attributes is not None else {})):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+GRAPH_REQUEST_SECONDS = registry.histogram("graph_request_seconds", "Latency of the Graph API requests by endpoint.")
+GRAPH_ERRORS = registry.counter("graph_errors", "Graph API requests that failed, by endpoint and error code.")
+RETRIES = registry.counter("retries", "Operations retried after a failure.")
+UPLOADED_BYTES = registry.counter("uploaded_bytes", "Bytes of the photos uploaded.")
+RENDER_SECONDS = registry.histogram("render_seconds", "Time spent rendering a match image in a render worker.")
+ENCODED_BYTES = registry.histogram("encoded_bytes", "Size of the encoded match images.", SIZE_BUCKETS)
+ENCODE_SECONDS = registry.histogram("encode_seconds", "Time spent encoding a match image, searching its settings "
+                                                      "included.")
+SERIALIZATION_SECONDS = registry.histogram("serialization_seconds", "Time spent saving or loading the poll data.")
+QUEUE_DEPTH = registry.gauge("queue_depth", "Items waiting in the queues of the polls.")
+SPAN_SECONDS = registry.histogram("span_seconds", "Duration of the traced spans.")
+
+_object_id_pattern = re.compile(r"^\d+(_\d+)?$")
+
+
+def graph_endpoint(url: str) -> str:
+    """
+    :return: the path of a Graph API url, with the version and the object ids replaced by placeholders, e.g.
+    /{id}/photos
+    """
+    parts = [part for part in urlparse(url).path.split("/") if part]
+    if parts and re.match(r"^v\d+\.\d+$", parts[0]):
+        parts = parts[1:]
+    if not parts:
+        return "/batch"
+    return "/" + "/".join("{id}" if _object_id_pattern.match(part) else part for part in parts)
+
+
+def graph_response_hook(response: "requests.Response", *args, **kwargs) -> None:
+    """
+    requests response hook recording the latency and the errors of every Graph API call made with the session.
+    """
+    endpoint = graph_endpoint(response.request.url if response.request is not None else response.url)
+    GRAPH_REQUEST_SECONDS.observe(response.elapsed.total_seconds(), endpoint=endpoint,
+                                  method=response.request.method if response.request is not None else "")
+    if response.status_code >= 400:
+        code = response.status_code
+        try:
+            code = response.json()["error"]["code"]
+        except (ValueError, KeyError, TypeError):
+            pass
+        GRAPH_ERRORS.inc(endpoint=endpoint, code=code)
+
+
+def instrument_session(session: "requests.Session") -> None:
+    if graph_response_hook not in session.hooks["response"]:
+        session.hooks["response"].append(graph_response_hook)
+
+
+def export_json(fpath: str) -> None:
+    utils.safe_write(fpath, json.dumps({"timestamp": time.time(), "metrics": registry.to_dict(),
+                                        "spans": tracer.recent_spans()}))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = registry.to_prometheus().encode("utf-8"), "text/plain; version=0.0.4"
+        elif self.path == "/spans":
+            body, content_type = json.dumps(tracer.recent_spans()).encode("utf-8"), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsExporter(object):
+    """
+    Exposes the metrics in the Prometheus text format on http://<host>:<port>/metrics (and the recent spans on
+    /spans), and/or writes them with the recent spans to a JSON file every interval seconds.
+    """
+
+    def __init__(self, port: int = None, json_file: str = None, interval: float = 60, host: str = "0.0.0.0"):
+        self.json_file = json_file
+        self.interval = interval
+        self._server: Union[ThreadingHTTPServer, None] = None
+        self._stopped = threading.Event()
+        self._threads: List[threading.Thread] = []
+        if port is not None:
+            self._server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            self._server.daemon_threads = True
+            self._threads.append(threading.Thread(target=self._server.serve_forever, name="metrics-http",
+                                                  daemon=True))
+            logger.info(f"Serving metrics on http://{host}:{self._server.server_port}/metrics")
+        if json_file is not None:
+            self._threads.append(threading.Thread(target=self._write_json, name="metrics-json", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _write_json(self) -> None:
+        while not self._stopped.wait(self.interval):
+            export_json(self.json_file)
+
+    def close(self) -> None:
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        if self.json_file is not None:
+            export_json(self.json_file)
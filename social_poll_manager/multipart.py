@@ -0,0 +1,72 @@
+import mimetypes
+import mmap
+import os
+import uuid
+from pathlib import Path
+from typing import Dict, List
+
+
+class MultipartFile(object):
+    """
+    A multipart/form-data body made of some text fields and one file, streamed from a memory mapping of the file.
+    Only the chunk being sent is copied, so the memory used by an upload doesn't grow with the size of the file.
+    It is a file-like object with a known length, which requests sends with a Content-Length header.
+    """
+
+    def __init__(self, fields: Dict[str, str], file_field: str, file_path: str, boundary: str = None):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        head = b"".join(self._field_part(name, value) for (name, value) in fields.items())
+        file_name = Path(file_path).name
+        file_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+        head += (f"--{self.boundary}\r\n"
+                 f"Content-Disposition: form-data; name=\"{file_field}\"; filename=\"{file_name}\"\r\n"
+                 f"Content-Type: {file_type}\r\n\r\n").encode("utf-8")
+        tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        self._file = open(file_path, "rb")
+        self._mmap = None
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            content = memoryview(self._mmap)
+        else:
+            content = memoryview(b"")
+        self._parts: List[memoryview] = [memoryview(head), content, memoryview(tail)]
+        self._length = sum(len(part) for part in self._parts)
+        self._part = 0
+        self._offset = 0
+
+    def _field_part(self, name: str, value: str) -> bytes:
+        return (f"--{self.boundary}\r\n"
+                f"Content-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+                f"{value}\r\n").encode("utf-8")
+
+    def __len__(self) -> int:
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while self._part < len(self._parts) and size != 0:
+            part = self._parts[self._part]
+            end = len(part) if size < 0 else min(len(part), self._offset + size)
+            chunks.append(part[self._offset:end].tobytes())
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+            if self._offset == len(part):
+                self._part += 1
+                self._offset = 0
+        return b"".join(chunks)
+
+    def close(self) -> None:
+        # The memoryviews must be released before the mapping can be closed
+        for part in self._parts:
+            part.release()
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> "MultipartFile":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,624 @@
+import itertools
+import sys
+from array import array
+from collections.abc import Mapping, MutableSequence, Sequence
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import List, Dict, Union, Iterable, Iterator, Tuple
+
+from social_poll_manager.utils import auto_str_and_repr
+
+# The poll data is stored by column in typed arrays, which take a few bytes per image, participant and match instead
+# of a few hundred for a Python object. ImageData, MatchParticipantData and MatchData are lightweight views on a row
+# of those tables, built on access. They can still be created on their own, e.g. to build a match before adding it
+# to its phase: the data is then copied into the tables of the phase, and the object becomes a view on it.
+
+_EPOCH = datetime(1970, 1, 1)
+_NO_TIME = -2 ** 63
+_MICROSECOND = timedelta(microseconds=1)
+# Stands for a value which follows the format of its column, e.g. pics/<image_id>.jpg
+_FORMATTED = object()
+
+
+def _to_micros(value: Union[datetime, timedelta, None]) -> int:
+    if value is None:
+        return _NO_TIME
+    if isinstance(value, datetime):
+        value = value - _EPOCH
+    return value // _MICROSECOND
+
+
+def _column_format(value: Union[str, None], image_id: str) -> Union[str, None]:
+    """
+    :return: the format string which builds the given value from the image id, if the value contains it
+    """
+    if value is None or value.count(image_id) != 1:
+        return None
+    return value.replace("{", "{{").replace("}", "}}").replace(image_id, "{0}")
+
+
+@auto_str_and_repr
+class ImageData(object):
+    """
+    An image of the poll, as a view on a row of an ImageTable. Besides the original image, it points at its
+    normalized working copy and preview once ingested.
+    """
+    __slots__ = ("_table", "_row")
+    _repr_fields = ("image_id", "image_path", "fb_url", "working_path", "preview_path")
+
+    def __init__(self, image_id: str, image_path: str, fb_url: str = None, working_path: str = None,
+                 preview_path: str = None):
+        self._table = ImageTable()
+        self._row = self._table.add(image_id, image_path, fb_url, working_path, preview_path)
+
+    @classmethod
+    def view(cls, table: "ImageTable", row: int) -> "ImageData":
+        image = cls.__new__(cls)
+        image._table = table
+        image._row = row
+        return image
+
+    @property
+    def image_id(self) -> str:
+        return self._table.ids[self._row]
+
+    @property
+    def image_path(self) -> str:
+        return self._table.value("image_path", self._row)
+
+    @image_path.setter
+    def image_path(self, value: str):
+        self._table.set("image_path", self._row, value)
+
+    @property
+    def fb_url(self) -> Union[str, None]:
+        return self._table.value("fb_url", self._row)
+
+    @fb_url.setter
+    def fb_url(self, value: Union[str, None]):
+        self._table.set("fb_url", self._row, value)
+
+    @property
+    def working_path(self) -> Union[str, None]:
+        return self._table.value("working_path", self._row)
+
+    @working_path.setter
+    def working_path(self, value: Union[str, None]):
+        self._table.set("working_path", self._row, value)
+
+    @property
+    def preview_path(self) -> Union[str, None]:
+        return self._table.value("preview_path", self._row)
+
+    @preview_path.setter
+    def preview_path(self, value: Union[str, None]):
+        self._table.set("preview_path", self._row, value)
+
+    @property
+    def render_path(self) -> str:
+        """
+        The file the match images are rendered from: the working copy if any, the original otherwise.
+        """
+        return self.working_path or self.image_path
+
+    def _fields(self) -> tuple:
+        return self.image_id, self.image_path, self.fb_url, self.working_path, self.preview_path
+
+    def __eq__(self, other):
+        if not isinstance(other, ImageData):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __hash__(self):
+        return hash(self.image_id)
+
+
+class ImageTable(Mapping):
+    """
+    Interned table of images, by image id. Every image is stored once, in columns, and phases and matches refer to
+    it by its row number. Values built from the image id with the same format as the first value of their column, e.g.
+    pics/<image_id>.jpg, are not stored at all. revision changes whenever an image is added or modified.
+    """
+    COLUMNS = ("image_path", "fb_url", "working_path", "preview_path")
+
+    def __init__(self, images: Iterable[ImageData] = ()):
+        self.ids: List[str] = []
+        self.columns: Dict[str, List[Union[str, None, object]]] = {name: [] for name in self.COLUMNS}
+        self.revision = 0
+        self._rows: Dict[str, int] = dict()
+        # Format of every column, None if its values don't follow one. Missing until the first value is known
+        self._formats: Dict[str, Union[str, None]] = dict()
+        for image in images:
+            self.add(*image._fields())
+
+    def _encode(self, name: str, image_id: str, value: Union[str, None]) -> Union[str, None, object]:
+        if value is None:
+            return None
+        if name not in self._formats:
+            self._formats[name] = _column_format(value, image_id)
+        value_format = self._formats[name]
+        return _FORMATTED if value_format is not None and value == value_format.format(image_id) else value
+
+    def add(self, image_id: str, image_path: str, fb_url: str = None, working_path: str = None,
+            preview_path: str = None) -> int:
+        """
+        Adds an image, unless an image with the same id is already present.
+        :return: the row of the image
+        """
+        row = self._rows.get(image_id)
+        if row is not None:
+            return row
+        image_id = sys.intern(image_id)
+        row = len(self.ids)
+        self.ids.append(image_id)
+        for name, value in zip(self.COLUMNS, (image_path, fb_url, working_path, preview_path)):
+            self.columns[name].append(self._encode(name, image_id, value))
+        self._rows[image_id] = row
+        self.revision += 1
+        return row
+
+    def row(self, image_id: str) -> int:
+        return self._rows[image_id]
+
+    def value(self, name: str, row: int) -> Union[str, None]:
+        value = self.columns[name][row]
+        return self._formats[name].format(self.ids[row]) if value is _FORMATTED else value
+
+    def set(self, name: str, row: int, value: Union[str, None]) -> None:
+        self.columns[name][row] = self._encode(name, self.ids[row], value)
+        self.revision += 1
+
+    def __getitem__(self, image_id: str) -> ImageData:
+        return ImageData.view(self, self._rows[image_id])
+
+    def __contains__(self, image_id) -> bool:
+        return image_id in self._rows
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def values(self) -> "ImageList":
+        return ImageList(self, array("I", range(len(self.ids))))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({len(self)} images)"
+
+
+def _image_rows(images: Iterable[ImageData], table: ImageTable = None) -> Tuple[ImageTable, array]:
+    """
+    :return: the table of the given images and their rows in it. Images which are not in the given table, or in the
+    table shared by all of them, are copied to a new one
+    """
+    if isinstance(images, ImageList) and (table is None or images.table is table):
+        return images.table, array("I", images.rows)
+    images = list(images)
+    if table is None and images and all(image._table is images[0]._table for image in images):
+        table = images[0]._table
+    if table is None or not isinstance(table, ImageTable):
+        table = ImageTable()
+    rows = array("I", (image._row if image._table is table else table.add(*image._fields()) for image in images))
+    return table, rows
+
+
+class ImageList(Sequence):
+    """
+    Read-only list of images, stored as rows of an image table.
+    """
+
+    def __init__(self, table: ImageTable, rows: array):
+        self.table = table
+        self.rows = rows
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [ImageData.view(self.table, row) for row in self.rows[idx]]
+        return ImageData.view(self.table, self.rows[idx])
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def image_ids(self) -> List[str]:
+        ids = self.table.ids
+        return [ids[row] for row in self.rows]
+
+    def __repr__(self):
+        return f"{type(self).__name__}({len(self)} images)"
+
+
+class MatchStatus(Enum):
+    # Match just generated
+    GENERATED = "generated"
+    # Match posted to facebook
+    POSTED = "posted"
+    # Match over, reactions registered
+    OVER = "over"
+
+
+_MATCH_STATUSES = list(MatchStatus)
+_MATCH_STATUS_CODES = {status: code for (code, status) in enumerate(_MATCH_STATUSES)}
+
+
+class PhaseStatus(Enum):
+    # Phase just created
+    CREATED = "created"
+    # Matches generated, phase running, some matches could already be posted but not all
+    GENERATED = "generated"
+    # ALl matches are posted
+    POSTED = "posted"
+    # All matches are over, so is the pase
+    OVER = "over"
+
+
+class MatchTable(object):
+    """
+    The matches of a phase, stored by column. The participants of all the matches are stored back to back: the ones of
+    the match in row i are the participant rows from offsets[i] to offsets[i + 1]. Images are rows of the image table
+    of the phase, and reactions small codes into reaction_names.
+    """
+
+    def __init__(self, images: ImageTable):
+        self.images = images
+        self.match_numbers = array("I")
+        self.statuses = array("B")
+        self.post_ids: List[Union[str, None]] = []
+        self.posted_times = array("q")
+        self.extensions = array("q")
+        self.offsets = array("I", [0])
+        self.image_rows = array("I")
+        self.reaction_codes = array("B")
+        self.votes = array("I")
+        self.reaction_names: List[str] = []
+        self._reaction_codes: Dict[str, int] = dict()
+
+    def __len__(self) -> int:
+        return len(self.match_numbers)
+
+    def reaction_code(self, reaction_name: str) -> int:
+        code = self._reaction_codes.get(reaction_name)
+        if code is None:
+            code = len(self.reaction_names)
+            self.reaction_names.append(sys.intern(reaction_name))
+            self._reaction_codes[reaction_name] = code
+        return code
+
+    def add(self, match_number: int, image_rows: Iterable[int], reactions: Iterable[str], votes: Iterable[int] = None,
+            status: MatchStatus = MatchStatus.GENERATED, post_id: str = None, posted_time: datetime = None,
+            extension: timedelta = timedelta(0)) -> int:
+        """
+        :param image_rows: the rows of the participant images in the image table
+        :param reactions: the names of the reactions assigned to the participants
+        :param votes: the reactions got by the participants, zero if missing
+        :return: the row of the match
+        """
+        image_rows = array("I", image_rows)
+        reaction_codes = array("B", (self.reaction_code(reaction) for reaction in reactions))
+        if len(reaction_codes) != len(image_rows):
+            raise ValueError(f"Match {match_number} has {len(image_rows)} participants and {len(reaction_codes)} "
+                             f"reactions.")
+        row = len(self.match_numbers)
+        self.image_rows.extend(image_rows)
+        self.reaction_codes.extend(reaction_codes)
+        if votes is None:
+            self.votes.frombytes(bytes(self.votes.itemsize * len(image_rows)))
+        else:
+            self.votes.extend(votes)
+        self.offsets.append(len(self.image_rows))
+        self.match_numbers.append(match_number)
+        self.statuses.append(_MATCH_STATUS_CODES[status])
+        self.post_ids.append(post_id)
+        self.posted_times.append(_to_micros(posted_time))
+        self.extensions.append(_to_micros(extension))
+        return row
+
+    def extend(self, match_sizes: Sequence[int], image_rows: array, reaction_codes: array,
+               first_match_number: int = 1) -> range:
+        """
+        Appends many generated matches at once, numbered from first_match_number, without votes.
+        :param match_sizes: the number of participants of every match
+        :param image_rows: the rows of the participant images of all the matches, back to back, as an "I" array
+        :param reaction_codes: the codes of the reactions assigned to the participants, as a "B" array
+        :return: the rows of the matches
+        """
+        if not len(image_rows) == len(reaction_codes) == sum(match_sizes):
+            raise ValueError(f"{len(match_sizes)} matches of {sum(match_sizes)} participants can't have "
+                             f"{len(image_rows)} images and {len(reaction_codes)} reactions.")
+        if reaction_codes and max(reaction_codes) >= len(self.reaction_names):
+            raise ValueError(f"Unknown reaction code {max(reaction_codes)}.")
+        count = len(match_sizes)
+        first_row = len(self.match_numbers)
+        self.offsets.extend(itertools.accumulate(match_sizes, initial=len(self.image_rows)))
+        # accumulate() repeats the initial offset, which is already the last one
+        self.offsets.pop(first_row)
+        self.image_rows.extend(image_rows)
+        self.reaction_codes.extend(reaction_codes)
+        self.votes.frombytes(bytes(self.votes.itemsize * len(image_rows)))
+        self.match_numbers.extend(range(first_match_number, first_match_number + count))
+        self.statuses.extend(array("B", [_MATCH_STATUS_CODES[MatchStatus.GENERATED]]) * count)
+        self.post_ids.extend([None] * count)
+        self.posted_times.extend(array("q", [_to_micros(None)]) * count)
+        self.extensions.extend(array("q", [0]) * count)
+        return range(first_row, first_row + count)
+
+    def clear(self) -> None:
+        self.__init__(self.images)
+
+
+@auto_str_and_repr
+class MatchParticipantData(object):
+    """
+    A participant of a match, as a view on a participant row of a MatchTable.
+    """
+    __slots__ = ("_match", "_position", "_image_data", "_assigned_reaction", "_reactions")
+    _repr_fields = ("image_data", "assigned_reaction", "reactions")
+
+    def __init__(self, image_data: ImageData, assigned_reaction: str):
+        # Not bound to a match yet
+        self._match: Union[MatchData, None] = None
+        self._position = 0
+        self._image_data = image_data
+        self._assigned_reaction = assigned_reaction
+        self._reactions = 0
+
+    @classmethod
+    def view(cls, match: "MatchData", position: int) -> "MatchParticipantData":
+        participant = cls.__new__(cls)
+        participant._match = match
+        participant._position = position
+        return participant
+
+    def _location(self) -> Tuple[MatchTable, int]:
+        table = self._match._table
+        return table, table.offsets[self._match._row] + self._position
+
+    @property
+    def image_data(self) -> ImageData:
+        if self._match is None:
+            return self._image_data
+        table, row = self._location()
+        return ImageData.view(table.images, table.image_rows[row])
+
+    @property
+    def assigned_reaction(self) -> str:
+        if self._match is None:
+            return self._assigned_reaction
+        table, row = self._location()
+        return table.reaction_names[table.reaction_codes[row]]
+
+    @assigned_reaction.setter
+    def assigned_reaction(self, value: str):
+        if self._match is None:
+            self._assigned_reaction = value
+        else:
+            table, row = self._location()
+            table.reaction_codes[row] = table.reaction_code(value)
+
+    @property
+    def reactions(self) -> int:
+        if self._match is None:
+            return self._reactions
+        table, row = self._location()
+        return table.votes[row]
+
+    @reactions.setter
+    def reactions(self, value: int):
+        if self._match is None:
+            self._reactions = value
+        else:
+            table, row = self._location()
+            table.votes[row] = value
+
+
+class ParticipantList(Sequence):
+    """
+    Read-only list of the participants of a match.
+    """
+
+    def __init__(self, match: "MatchData"):
+        self.match = match
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        size = len(self)
+        if idx < 0:
+            idx += size
+        if not 0 <= idx < size:
+            raise IndexError("participant index out of range")
+        return MatchParticipantData.view(self.match, idx)
+
+    def __len__(self) -> int:
+        offsets = self.match._table.offsets
+        return offsets[self.match._row + 1] - offsets[self.match._row]
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+@auto_str_and_repr
+class MatchData(object):
+    """
+    A match, as a view on a row of the MatchTable of its phase. Matches built on their own get a table of their own
+    until they are added to a phase.
+    """
+    __slots__ = ("_table", "_row")
+    _repr_fields = ("match_status", "participants", "post_id", "match_number", "posted_time", "extension")
+
+    def __init__(self, participants: List[MatchParticipantData], match_number: int):
+        images, image_rows = _image_rows([participant.image_data for participant in participants])
+        self._table = MatchTable(images)
+        self._row = self._table.add(match_number, image_rows,
+                                    [participant.assigned_reaction for participant in participants],
+                                    [participant.reactions for participant in participants])
+        # The participants become views on the match
+        for position, participant in enumerate(participants):
+            participant._match = self
+            participant._position = position
+
+    @classmethod
+    def view(cls, table: MatchTable, row: int) -> "MatchData":
+        match = cls.__new__(cls)
+        match._table = table
+        match._row = row
+        return match
+
+    @property
+    def participants(self) -> ParticipantList:
+        return ParticipantList(self)
+
+    @property
+    def match_number(self) -> int:
+        return self._table.match_numbers[self._row]
+
+    @match_number.setter
+    def match_number(self, value: int):
+        self._table.match_numbers[self._row] = value
+
+    @property
+    def match_status(self) -> MatchStatus:
+        return _MATCH_STATUSES[self._table.statuses[self._row]]
+
+    @match_status.setter
+    def match_status(self, value: MatchStatus):
+        self._table.statuses[self._row] = _MATCH_STATUS_CODES[value]
+
+    @property
+    def post_id(self) -> Union[str, None]:
+        return self._table.post_ids[self._row]
+
+    @post_id.setter
+    def post_id(self, value: Union[str, None]):
+        self._table.post_ids[self._row] = value
+
+    @property
+    def posted_time(self) -> Union[datetime, None]:
+        micros = self._table.posted_times[self._row]
+        return None if micros == _NO_TIME else _EPOCH + micros * _MICROSECOND
+
+    @posted_time.setter
+    def posted_time(self, value: Union[datetime, None]):
+        self._table.posted_times[self._row] = _to_micros(value)
+
+    @property
+    def extension(self) -> timedelta:
+        """
+        Extra voting time granted to the match, e.g. to break a tie
+        """
+        return self._table.extensions[self._row] * _MICROSECOND
+
+    @extension.setter
+    def extension(self, value: timedelta):
+        self._table.extensions[self._row] = _to_micros(value)
+
+
+class MatchList(MutableSequence):
+    """
+    The matches of a phase, stored in its MatchTable. Matches can only be appended, and become views on the table.
+    """
+
+    def __init__(self, table: MatchTable):
+        self.table = table
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        size = len(self.table)
+        if idx < 0:
+            idx += size
+        if not 0 <= idx < size:
+            raise IndexError("match index out of range")
+        return MatchData.view(self.table, idx)
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def __setitem__(self, idx, match: MatchData):
+        raise TypeError("Matches can't be replaced.")
+
+    def __delitem__(self, idx):
+        raise TypeError("Matches can't be removed.")
+
+    def insert(self, idx: int, match: MatchData) -> None:
+        if idx < len(self):
+            raise TypeError("Matches can only be appended.")
+        source, source_row = match._table, match._row
+        start, end = source.offsets[source_row], source.offsets[source_row + 1]
+        if source.images is self.table.images:
+            image_rows = source.image_rows[start:end]
+        else:
+            _, image_rows = _image_rows([ImageData.view(source.images, row) for row in source.image_rows[start:end]],
+                                        self.table.images)
+        row = self.table.add(match.match_number, image_rows,
+                             [source.reaction_names[code] for code in source.reaction_codes[start:end]],
+                             source.votes[start:end], match.match_status, match.post_id, match.posted_time,
+                             match.extension)
+        match._table, match._row = self.table, row
+
+    def add(self, match_number: int, image_rows: Iterable[int], reactions: Iterable[str],
+            votes: Iterable[int] = None) -> MatchData:
+        """
+        Appends a new match, without building its participants.
+        :param image_rows: the rows of the participant images in the image table of the phase
+        :param reactions: the names of the reactions assigned to the participants
+        :param votes: the reactions got by the participants, zero if missing
+        """
+        return MatchData.view(self.table, self.table.add(match_number, image_rows, reactions, votes))
+
+    def clear(self) -> None:
+        self.table.clear()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({len(self)} matches)"
+
+
+class PhaseData(object):
+    """
+    A phase of the poll. Its participants are stored as rows of an image table, usually the one of the poll, and its
+    matches in a MatchTable sharing the same image table.
+    """
+    __slots__ = ("phase_number", "status", "_participants", "_matches")
+
+    def __init__(self, participants: Iterable[ImageData], phase_number: int):
+        self._participants = ImageList(*_image_rows(participants))
+        self._matches = MatchList(MatchTable(self._participants.table))
+        self.phase_number = phase_number
+        self.status = PhaseStatus.CREATED
+
+    @property
+    def participants(self) -> ImageList:
+        return self._participants
+
+    @participants.setter
+    def participants(self, participants: Iterable[ImageData]):
+        self._participants = ImageList(*_image_rows(participants, self._participants.table))
+
+    @property
+    def matches(self) -> MatchList:
+        return self._matches
+
+    @matches.setter
+    def matches(self, matches: Iterable[MatchData]):
+        self._matches.clear()
+        self._matches.extend(matches)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(phase_number={self.phase_number}, status={self.status}, " \
+               f"participants={len(self._participants)}, matches={len(self._matches)})"
+
+    __str__ = __repr__
+
+
+class PollData(object):
+
+    def __init__(self, images: Union[ImageTable, Dict[str, ImageData]]):
+        self.images = images if isinstance(images, ImageTable) else ImageTable(images.values())
+        self.phases: List[PhaseData] = []
+        # Seed of the random draws of the matches, so that every phase can be reproduced
+        self.seed: Union[int, None] = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}(images={len(self.images)}, phases={len(self.phases)}, seed={self.seed})"
+
+    __str__ = __repr__
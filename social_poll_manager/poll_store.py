@@ -0,0 +1,294 @@
+import argparse
+import json
+import sqlite3
+import threading
+from array import array
+from pathlib import Path
+from typing import Iterable, Union, Dict, Tuple
+
+from social_poll_manager import utils
+from social_poll_manager.poll_data import PollData, PhaseData, MatchData, PhaseStatus, MatchStatus, ImageTable, \
+    ImageList
+from social_poll_manager.serialization import FORMAT_NAME, FORMAT_VERSION, encode_header, encode_image, \
+    decode_images, encode_phase, encode_match, decode_match, dumps, is_legacy_content, phases_from_lines, \
+    LazyPhaseList, loaded_phases, decode_legacy
+
+
+class PollStore(object):
+    """
+    Persistence backend for the poll state.
+    """
+
+    def __init__(self, fpath: str):
+        self.fpath = fpath
+
+    def load(self) -> Union[PollData, None]:
+        """
+        :return: the stored poll data, or None if nothing was saved yet
+        """
+        raise NotImplementedError()
+
+    def save(self, poll_data: PollData, matches: Iterable[MatchData] = None) -> None:
+        """
+        Persists the poll data.
+        :param poll_data: the poll data to be saved
+        :param matches: the matches of the current phase changed since the last save. If missing, all the data that
+        could have changed is saved
+        """
+        raise NotImplementedError()
+
+
+class JsonPollStore(PollStore):
+    """
+    Stores the poll data in a json lines file: a small header summarising the current phase, the images, then one
+    line per phase. Historical phases are only decoded when accessed, and since they can't change anymore their
+    encoded lines are reused as they are at every save. Files written by the older jsonpickle format are still
+    loaded, and are converted at the next save.
+    """
+
+    def __init__(self, fpath: str):
+        super().__init__(fpath)
+        self._images_line: Union[str, None] = None
+        # Image table and revision of the encoded images line
+        self._images_revision: Tuple[Union[ImageTable, None], int] = (None, -1)
+        # Encoded lines of the historical phases, by phase index
+        self._phase_lines: Dict[int, str] = dict()
+
+    def load(self) -> Union[PollData, None]:
+        try:
+            with open(self.fpath, encoding="utf-8") as f:
+                first_line = f.readline()
+                if is_legacy_content(first_line):
+                    return decode_legacy(first_line + f.read())
+                header = json.loads(first_line)
+                if header.get("format") != FORMAT_NAME or header.get("version") != FORMAT_VERSION:
+                    raise ValueError(f"Unsupported poll data format: {header}")
+                images_line = f.readline().rstrip("\n")
+                phase_lines = [line.rstrip("\n") for line in f if line.strip()]
+        except FileNotFoundError:
+            return None
+        images = decode_images(json.loads(images_line))
+        poll_data = PollData(images)
+        poll_data.seed = header.get("seed")
+        poll_data.phases = phases_from_lines(phase_lines, images)
+        self._images_line = images_line
+        self._images_revision = (images, images.revision)
+        self._phase_lines = dict(enumerate(phase_lines[:-1]))
+        return poll_data
+
+    def save(self, poll_data: PollData, matches: Iterable[MatchData] = None) -> None:
+        images = poll_data.images
+        if self._images_revision[0] is not images or self._images_revision[1] != images.revision:
+            self._images_line = dumps([encode_image(image) for image in images.values()])
+            self._images_revision = (images, images.revision)
+        lines = [dumps(encode_header(poll_data)), self._images_line]
+        last_idx = len(poll_data.phases) - 1
+        for idx in range(last_idx + 1):
+            if idx < last_idx and idx in self._phase_lines:
+                lines.append(self._phase_lines[idx])
+                continue
+            phase = poll_data.phases[idx]
+            line = dumps(encode_phase(phase))
+            if idx < last_idx and phase.status == PhaseStatus.OVER:
+                self._phase_lines[idx] = line
+            lines.append(line)
+        utils.safe_write(self.fpath, "\n".join(lines) + "\n")
+
+
+class SqlitePollStore(PollStore):
+    """
+    Stores the poll data in a SQLite database with one row per image, phase and match, so that every save only
+    writes the rows that changed. Images are written once, phases only when their status changes and matches only
+    when they are reported as changed. Every save is a single transaction, so an abrupt termination leaves the
+    database at the previous save. Historical phases are only read from the database when accessed.
+    """
+
+    def __init__(self, fpath: str):
+        super().__init__(fpath)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(fpath, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS images (image_id TEXT PRIMARY KEY, "
+                                     "image_path TEXT, fb_url TEXT, working_path TEXT, preview_path TEXT)")
+            image_columns = {row[1] for row in self._connection.execute("PRAGMA table_info(images)")}
+            # Databases created before the images were ingested
+            for column in ("working_path", "preview_path"):
+                if column not in image_columns:
+                    self._connection.execute(f"ALTER TABLE images ADD COLUMN {column} TEXT")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS phases (phase_number INTEGER PRIMARY KEY, "
+                                     "status TEXT, participants TEXT)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS matches (phase_number INTEGER, "
+                                     "match_number INTEGER, data TEXT, PRIMARY KEY (phase_number, match_number))")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)")
+        self._saved_images_revision: Tuple[Union[ImageTable, None], int] = (None, -1)
+        self._saved_seed: Union[int, None] = None
+        self._saved_phase_statuses: Dict[int, PhaseStatus] = dict()
+
+    def _load_phase(self, phase_number: int, status: str, participants: str, images: ImageTable) -> PhaseData:
+        phase = PhaseData(ImageList(images, array("I", map(images.row, json.loads(participants)))), phase_number)
+        phase.status = PhaseStatus(status)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT data FROM matches WHERE phase_number = ? ORDER BY match_number", (phase_number,)).fetchall()
+        for (data,) in rows:
+            decode_match(json.loads(data), phase.matches)
+        return phase
+
+    def load(self) -> Union[PollData, None]:
+        with self._lock:
+            images = ImageTable()
+            for image_row in self._connection.execute(
+                    "SELECT image_id, image_path, fb_url, working_path, preview_path FROM images ORDER BY rowid"):
+                images.add(*image_row)
+            phase_rows = self._connection.execute(
+                "SELECT phase_number, status, participants FROM phases ORDER BY phase_number").fetchall()
+            seed_row = self._connection.execute("SELECT value FROM settings WHERE name = 'seed'").fetchone()
+        if not phase_rows:
+            return None
+
+        def loader(phase_row: tuple):
+            return lambda: self._load_phase(*phase_row, images)
+
+        poll_data = PollData(images)
+        poll_data.seed = int(seed_row[0]) if seed_row is not None else None
+        self._saved_seed = poll_data.seed
+        poll_data.phases = LazyPhaseList([loader(phase_row) for phase_row in phase_rows[:-1]])
+        poll_data.phases.append(self._load_phase(*phase_rows[-1], images))
+        self._saved_images_revision = (images, images.revision)
+        self._saved_phase_statuses = {phase_number: PhaseStatus(status) for (phase_number, status, _) in phase_rows}
+        return poll_data
+
+    def _save_matches(self, phase_number: int, matches: Iterable[MatchData]) -> None:
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO matches (phase_number, match_number, data) VALUES (?, ?, ?)",
+            ((phase_number, match.match_number, dumps(encode_match(match))) for match in matches))
+
+    def save(self, poll_data: PollData, matches: Iterable[MatchData] = None) -> None:
+        current_phase = poll_data.phases[-1]
+        # Phases which were never accessed since the load can't have changed
+        phases = list(loaded_phases(poll_data.phases))
+        with self._lock:
+            with self._connection:
+                images = poll_data.images
+                if self._saved_images_revision[0] is not images or self._saved_images_revision[1] != images.revision:
+                    self._connection.executemany(
+                        "INSERT INTO images (image_id, image_path, fb_url, working_path, preview_path) "
+                        "VALUES (?, ?, ?, ?, ?) ON CONFLICT (image_id) DO UPDATE SET image_path = excluded.image_path, "
+                        "fb_url = excluded.fb_url, working_path = excluded.working_path, "
+                        "preview_path = excluded.preview_path",
+                        ((image.image_id, image.image_path, image.fb_url, image.working_path, image.preview_path)
+                         for image in images.values()))
+                seed = getattr(poll_data, "seed", None)
+                if seed is not None and seed != self._saved_seed:
+                    self._connection.execute("INSERT OR REPLACE INTO settings (name, value) VALUES ('seed', ?)",
+                                             (str(seed),))
+                for phase in phases:
+                    if self._saved_phase_statuses.get(phase.phase_number) != phase.status:
+                        self._connection.execute(
+                            "INSERT OR REPLACE INTO phases (phase_number, status, participants) VALUES (?, ?, ?)",
+                            (phase.phase_number, phase.status.value,
+                             dumps(phase.participants.image_ids())))
+                        self._save_matches(phase.phase_number, phase.matches)
+                    elif phase is current_phase:
+                        self._save_matches(phase.phase_number, phase.matches if matches is None else matches)
+            # Only update the bookkeeping once the transaction has been committed
+            self._saved_images_revision = (images, images.revision)
+            self._saved_seed = seed
+            for phase in phases:
+                self._saved_phase_statuses[phase.phase_number] = phase.status
+
+
+def create_poll_store(backend: str, fpath: str) -> PollStore:
+    """
+    :param backend: JSON or SQLITE
+    :param fpath: path of the file holding the poll data
+    """
+    if backend == "JSON":
+        return JsonPollStore(fpath)
+    if backend == "SQLITE":
+        return SqlitePollStore(fpath)
+    raise ValueError(f"Unknown poll data backend: {backend}")
+
+
+def read_poll_status(backend: str, fpath: str) -> Union[dict, None]:
+    """
+    Reads the summary of the poll and of its current phase without loading the poll data: only the header line of a
+    json file, and a few aggregate queries on a SQLite database, opened read-only. Files written by the older
+    jsonpickle format have no header, so they are fully decoded.
+    :param backend: JSON or SQLITE
+    :param fpath: path of the file holding the poll data
+    :return: the summary, as in the header of the json files, or None if nothing was saved yet
+    """
+    if backend == "JSON":
+        try:
+            with open(fpath, encoding="utf-8") as f:
+                first_line = f.readline()
+                if is_legacy_content(first_line):
+                    return encode_header(decode_legacy(first_line + f.read()))
+        except FileNotFoundError:
+            return None
+        header = json.loads(first_line)
+        if header.get("format") != FORMAT_NAME or header.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported poll data format: {header}")
+        return header
+    if backend != "SQLITE":
+        raise ValueError(f"Unknown poll data backend: {backend}")
+    if not Path(fpath).exists():
+        return None
+    connection = sqlite3.connect(f"{Path(fpath).resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        phase_row = connection.execute("SELECT phase_number, status, json_array_length(participants) FROM phases "
+                                       "ORDER BY phase_number DESC LIMIT 1").fetchone()
+        if phase_row is None:
+            return None
+        phase_number, status, participants = phase_row
+        matches, matches_posted, matches_over = connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(json_extract(data, '$.status') != ?), 0), "
+            "COALESCE(SUM(json_extract(data, '$.status') = ?), 0) FROM matches WHERE phase_number = ?",
+            (MatchStatus.GENERATED.value, MatchStatus.OVER.value, phase_number)).fetchone()
+        images, = connection.execute("SELECT COUNT(*) FROM images").fetchone()
+        phases, = connection.execute("SELECT COUNT(*) FROM phases").fetchone()
+        seed_row = connection.execute("SELECT value FROM settings WHERE name = 'seed'").fetchone()
+    finally:
+        connection.close()
+    return {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "images": images,
+        "phases": phases,
+        "seed": int(seed_row[0]) if seed_row is not None else None,
+        "current_phase": {
+            "phase_number": phase_number,
+            "status": status,
+            "participants": participants,
+            "matches": matches,
+            "matches_posted": matches_posted,
+            "matches_over": matches_over
+        }
+    }
+
+
+def convert_poll_data(source_file: str, target_file: str, backend: str = "JSON") -> None:
+    """
+    Converts a poll data file, including the ones written with the older jsonpickle format, to the given backend.
+    :param source_file: the poll data file to be converted
+    :param target_file: the path of the converted poll data
+    :param backend: JSON or SQLITE
+    """
+    poll_data = JsonPollStore(source_file).load()
+    if poll_data is None:
+        raise FileNotFoundError(f"Poll data file {source_file} not found.")
+    # Make sure every phase gets written to the new file
+    poll_data.phases = list(poll_data.phases)
+    create_poll_store(backend, target_file).save(poll_data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts a poll data file to the current format.")
+    parser.add_argument("source_file")
+    parser.add_argument("target_file")
+    parser.add_argument("--backend", choices=["JSON", "SQLITE"], default="JSON")
+    args = parser.parse_args()
+    convert_poll_data(args.source_file, args.target_file, args.backend)
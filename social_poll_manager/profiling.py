@@ -0,0 +1,127 @@
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from os import path
+from typing import Dict, Iterator
+
+from social_poll_manager import utils
+
+logger = utils.get_logger(__name__)
+
+
+class StageProfiler(object):
+    """
+    Profiles the stages of a poll with cProfile and, if memory is set, tracemalloc. Only the outermost stage running
+    in a thread is profiled: the stages it calls show up in its profile. For every stage, output_dir gets:
+    - <stage>.prof: the cProfile statistics of all its runs, for pstats or any profile viewer
+    - <stage>.txt: the functions taking the most cumulative time
+    - <stage>.snapshot and <stage>.memory.txt: the tracemalloc snapshot at the end of its last run, and the lines
+      holding the most memory in it
+    and stages.jsonl a line per run, with its wall time, CPU time and memory peak. tracemalloc traces the whole
+    process, so the memory of the stages running concurrently adds up.
+    """
+
+    def __init__(self, output_dir: str, memory: bool = False, memory_frames: int = 10, top: int = 40):
+        self.output_dir = output_dir
+        self.memory = memory
+        self.top = top
+        self._stats: Dict[str, pstats.Stats] = dict()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        os.makedirs(output_dir, exist_ok=True)
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start(memory_frames)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if getattr(self._local, "profile", None) is not None:
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Since Python 3.12 a single profiler can run at a time in the process
+            logger.debug(f"Another stage is being profiled. Not profiling {name}.")
+            yield
+            return
+        self._local.profile = profile
+        self._local.paused = 0.0
+        if self.memory:
+            tracemalloc.reset_peak()
+        started, started_cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.profile = None
+            self._record(name, profile, time.perf_counter() - started - self._local.paused,
+                         time.thread_time() - started_cpu)
+
+    @contextmanager
+    def paused(self) -> Iterator[None]:
+        """
+        Leaves the enclosed code out of the profile of the current stage, e.g. waiting for a user input.
+        """
+        profile = getattr(self._local, "profile", None)
+        if profile is None:
+            yield
+            return
+        profile.disable()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._local.paused += time.perf_counter() - started
+            profile.enable()
+
+    def _record(self, name: str, profile: cProfile.Profile, seconds: float, cpu_seconds: float) -> None:
+        entry = {"stage": name, "time": time.time(), "seconds": round(seconds, 6),
+                 "cpu_seconds": round(cpu_seconds, 6)}
+        snapshot = None
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            entry.update(memory_bytes=current, memory_peak_bytes=peak)
+            # Leave out the memory held by the profiler itself
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, pstats.__file__),
+                                                                  tracemalloc.Filter(False, tracemalloc.__file__)])
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            stats.dump_stats(path.join(self.output_dir, f"{name}.prof"))
+            summary = io.StringIO()
+            stats.stream = summary
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+            utils.safe_write(path.join(self.output_dir, f"{name}.txt"), summary.getvalue())
+            if snapshot is not None:
+                snapshot.dump(path.join(self.output_dir, f"{name}.snapshot"))
+                lines = [str(statistic) for statistic in snapshot.statistics("lineno")[:self.top]]
+                utils.safe_write(path.join(self.output_dir, f"{name}.memory.txt"), "\n".join(lines) + "\n")
+            with open(path.join(self.output_dir, "stages.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+
+
+def profiled(name: str):
+    """
+    Decorator running every call of the method as a stage of the profiler of the instance, if any.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            profiler = getattr(self, "profiler", None)
+            if profiler is None:
+                return method(self, *args, **kwargs)
+            with profiler.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,97 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Tuple, Iterable, Union
+
+from PIL import Image
+
+from social_poll_manager.utils import auto_str_and_repr
+
+
+def overlay_geometry(image_size: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    :return: the side of the reaction overlay and its padding from the top left corner, for an image of the given size
+    """
+    lower_size = min(image_size)
+    return int(lower_size / 5), int(lower_size * 0.05)
+
+
+@auto_str_and_repr
+class Reaction(object):
+    _repr_fields = ("name", "emoji", "image_path")
+
+    def __init__(self, name: str, image: Union[Image.Image, str], emoji: str, cache_size: int = 64):
+        """
+        :param image: the reaction image, or its path. A path is only decoded when the reaction is first drawn or
+        fingerprinted, so that building the reactions doesn't slow down the start of the poll
+        """
+        self.name = name
+        self.image_path = image if isinstance(image, str) else None
+        self._image = image.convert("RGBA") if isinstance(image, Image.Image) else None
+        self.emoji = emoji
+        self._fingerprint = None
+        self.cache_size = cache_size
+        # Resized overlays by side, as (RGB image, alpha mask), in least recently used order
+        self._overlays = OrderedDict()
+        self._overlays_lock = threading.Lock()
+
+    @property
+    def image(self) -> Image.Image:
+        if self._image is None:
+            with self._overlays_lock:
+                if self._image is None:
+                    with Image.open(self.image_path) as image:
+                        self._image = image.convert("RGBA")
+        return self._image
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Digest of the overlay, used to invalidate the rendered matches when the reaction image changes.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.sha1(self.image.tobytes()).hexdigest()
+        return self._fingerprint
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_overlays_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._overlays_lock = threading.Lock()
+
+    def _get_overlay(self, size: int) -> Tuple[Image.Image, Image.Image]:
+        with self._overlays_lock:
+            overlay = self._overlays.get(size)
+            if overlay is not None:
+                self._overlays.move_to_end(size)
+                return overlay
+        resized = self.image.resize((size, size), Image.LANCZOS)
+        overlay = (resized.convert("RGB"), resized.getchannel("A"))
+        with self._overlays_lock:
+            self._overlays[size] = overlay
+            while len(self._overlays) > self.cache_size:
+                self._overlays.popitem(last=False)
+        return overlay
+
+    def precompute(self, sizes: Iterable[int]) -> None:
+        """
+        Resizes the overlay in advance for the given sides, e.g. for all the image sizes of a phase.
+        """
+        for size in sizes:
+            self._get_overlay(size)
+
+    def super_impose(self, image: Image.Image) -> Image.Image:
+        """
+        Pastes the reaction on the top left corner of the image. Images which are not RGB are converted first.
+        :return: the image with the reaction, which is the given image itself if it was already RGB
+        """
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        reaction_size, padding = overlay_geometry(image.size)
+        if reaction_size > 0:
+            overlay, mask = self._get_overlay(reaction_size)
+            image.paste(overlay, (padding, padding), mask)
+        return image
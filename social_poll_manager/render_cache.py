@@ -0,0 +1,177 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, Future
+from os import path
+from typing import List, Tuple, Dict, Union, Iterable
+
+from PIL import Image
+
+from social_poll_manager import utils, metrics
+from social_poll_manager.image_utils import compose, fit_cell_size, fitted_size, fit_image
+from social_poll_manager.jpeg_encoder import JpegEncoder
+from social_poll_manager.poll_data import MatchParticipantData, MatchData
+from social_poll_manager.reaction import Reaction, overlay_geometry
+
+logger = utils.get_logger(__name__)
+
+# Bump when the rendering logic changes, so that previously cached images are not reused
+RENDER_VERSION = 4
+
+_worker_reactions: Dict[str, Reaction] = dict()
+
+
+def _init_worker(reactions: Dict[str, Reaction]) -> None:
+    global _worker_reactions
+    _worker_reactions = reactions
+
+
+def render_match_image(image_paths: List[str], assigned_reactions: List[str], reactions: Dict[str, Reaction],
+                       layout: Tuple[int], max_dimension: int = None) -> Image.Image:
+    # Only the headers are read here, so the cell size is known before decoding the images at reduced scale
+    images = [Image.open(image_path) for image_path in image_paths]
+    cell_size = fit_cell_size([image.size for image in images], layout, max_dimension)
+    fitted_images = []
+    for image, assigned_reaction in zip(images, assigned_reactions):
+        image.draft("RGB", fitted_size(image.size, cell_size))
+        fitted_images.append(reactions[assigned_reaction].super_impose(fit_image(image, cell_size)))
+    return compose(fitted_images, layout, max_dimension)
+
+
+def _render_to_file(image_paths: List[str], assigned_reactions: List[str], layout: Tuple[int], encoder: JpegEncoder,
+                    max_dimension: Union[int, None], target_path: str) -> Tuple[str, float, int, int, float]:
+    """
+    :return: the path of the rendered image, the seconds spent rendering it, then the size, quality and seconds of its
+    encoding
+    """
+    started = time.perf_counter()
+    composed = render_match_image(image_paths, assigned_reactions, _worker_reactions, layout, max_dimension)
+    encoded = encoder.encode(composed)
+    temp_path = f"{target_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(encoded.data)
+    os.replace(temp_path, target_path)
+    return target_path, time.perf_counter() - started, encoded.size, encoded.quality, encoded.seconds
+
+
+class RenderCache(object):
+    """
+    Content-addressed on-disk cache of the rendered match images. The key of every match is derived from the source
+    images, the assigned reactions and the layout, so any change to them results in a new render. Matches are
+    rendered ahead of time by a pool of worker processes.
+    """
+
+    def __init__(self, cache_dir: str, reactions: Dict[str, Reaction], workers: int = None,
+                 encoder: JpegEncoder = None, max_dimension: int = None):
+        self.cache_dir = cache_dir
+        self.reactions = reactions
+        self.workers = workers
+        self.encoder = encoder or JpegEncoder()
+        self.max_dimension = max_dimension
+        self._pool: Union[ProcessPoolExecutor, None] = None
+        self._pending: Dict[str, Future] = dict()
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def match_key(self, participants: List[MatchParticipantData], layout: Tuple[int]) -> str:
+        digest = hashlib.sha256(f"v{RENDER_VERSION}|{self.encoder.fingerprint}|d{self.max_dimension}|"
+                                f"{layout[0]}x{layout[1]}".encode())
+        for participant in participants:
+            image_path = participant.image_data.render_path
+            stat = os.stat(image_path)
+            reaction = self.reactions[participant.assigned_reaction]
+            digest.update(f"|{image_path}:{stat.st_size}:{stat.st_mtime_ns}:{reaction.name}:"
+                          f"{reaction.fingerprint}".encode())
+        return digest.hexdigest()
+
+    def path_for(self, key: str) -> str:
+        return path.join(self.cache_dir, f"{key}.jpg")
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                             initargs=(self.reactions,))
+        return self._pool
+
+    def precompute_overlays(self, image_sizes: Iterable[Tuple[int, int]]) -> None:
+        """
+        Resizes the reaction overlays in advance for every given fitted image size. Must be called before the first
+        render, as the worker processes get a copy of the reactions when they start.
+        """
+        sides = {overlay_geometry(image_size)[0] for image_size in image_sizes}
+        for reaction in self.reactions.values():
+            reaction.precompute(side for side in sides if side > 0)
+
+    def _record_render(self, future: Future) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+        target_path, seconds, size, quality, encode_seconds = future.result()
+        metrics.RENDER_SECONDS.observe(seconds)
+        metrics.ENCODED_BYTES.observe(size)
+        metrics.ENCODE_SECONDS.observe(encode_seconds)
+        logger.info(f"Rendered {path.basename(target_path)}: {size / 1024:.0f}KB at quality {quality}, encoded in "
+                    f"{encode_seconds:.2f}s.")
+        if self.encoder.max_bytes is not None and size > self.encoder.max_bytes:
+            logger.warning(f"{path.basename(target_path)} is over the {self.encoder.max_bytes / 1024:.0f}KB budget "
+                           f"even at the minimum quality.")
+
+    def _submit(self, key: str, participants: List[MatchParticipantData], layout: Tuple[int]) -> Future:
+        future = self._get_pool().submit(_render_to_file,
+                                         [participant.image_data.render_path for participant in participants],
+                                         [participant.assigned_reaction for participant in participants],
+                                         layout, self.encoder, self.max_dimension, self.path_for(key))
+        future.add_done_callback(self._record_render)
+        self._pending[key] = future
+        return future
+
+    def prerender(self, matches: Iterable[MatchData], layouts: Dict[int, Tuple]) -> None:
+        """
+        Schedules the rendering of the given matches in background, skipping the ones already in the cache.
+        """
+        scheduled = 0
+        with self._lock:
+            for match in matches:
+                key = self.match_key(match.participants, layouts[len(match.participants)])
+                if key in self._pending or path.exists(self.path_for(key)):
+                    continue
+                self._submit(key, match.participants, layouts[len(match.participants)])
+                scheduled += 1
+        logger.info(f"Scheduled rendering of {scheduled} match images.")
+
+    def get(self, participants: List[MatchParticipantData], layout: Tuple[int]) -> str:
+        """
+        :return: the path of the rendered image of the given match. If the match wasn't rendered ahead of time, waits
+        for its rendering to complete
+        """
+        key = self.match_key(participants, layout)
+        target_path = self.path_for(key)
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                if path.exists(target_path):
+                    return target_path
+                future = self._submit(key, participants, layout)
+        try:
+            return future.result()[0]
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def prune(self, matches: Iterable[MatchData], layouts: Dict[int, Tuple]) -> None:
+        """
+        Deletes every cached image which doesn't belong to one of the given matches.
+        """
+        keep = {f"{self.match_key(match.participants, layouts[len(match.participants)])}.jpg" for match in matches}
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(".jpg") and file_name not in keep:
+                os.remove(path.join(self.cache_dir, file_name))
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
@@ -0,0 +1,268 @@
+import argparse
+import csv
+import os
+from array import array
+from os import path
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from social_poll_manager import utils
+from social_poll_manager.poll_data import PollData, PhaseData, ImageTable, PhaseStatus, MatchStatus
+from social_poll_manager.poll_store import create_poll_store
+
+logger = utils.get_logger(__name__)
+
+# A table is a dict of equally long numpy columns
+Table = Dict[str, np.ndarray]
+
+# Same codes as in the match tables
+_MATCH_STATUS_VALUES = np.array([status.value for status in MatchStatus], dtype=object)
+_OVER_CODE = list(MatchStatus).index(MatchStatus.OVER)
+_NO_TIME = -2 ** 63
+
+
+def _column(values: array, dtype=np.int64) -> np.ndarray:
+    # Copied, so that the typed array can still grow
+    return np.frombuffer(values, dtype=values.typecode).astype(dtype) if len(values) else np.zeros(0, dtype)
+
+
+def _poll_rows(table: ImageTable, rows: array, images: ImageTable) -> np.ndarray:
+    """
+    :return: the rows of the poll image table of the given rows of table
+    """
+    if table is images:
+        return _column(rows)
+    return np.array([images.row(table.ids[row]) for row in rows], dtype=np.int64)
+
+
+def _concat(tables: List[Table]) -> Table:
+    if not tables:
+        return dict()
+    return {name: np.concatenate([table[name] for table in tables]) for name in tables[0]}
+
+
+def flatten_images(images: ImageTable) -> Table:
+    return {
+        "image_id": np.array(images.ids, dtype=object),
+        "image_path": np.array([images.value("image_path", row) for row in range(len(images))], dtype=object),
+        "fb_url": np.array([images.value("fb_url", row) for row in range(len(images))], dtype=object),
+    }
+
+
+def flatten_phase(phase: PhaseData, images: ImageTable) -> Dict[str, Table]:
+    """
+    Flattens a phase into its matches and participants tables, plus its participant image rows.
+    """
+    table = phase.matches.table
+    match_count = len(table)
+    offsets = _column(table.offsets)
+    counts = np.diff(offsets)
+    match_numbers = _column(table.match_numbers)
+    statuses = _column(table.statuses)
+    votes = _column(table.votes)
+    # Match of every participant, by index in the phase
+    match_index = np.repeat(np.arange(match_count), counts)
+
+    totals = np.bincount(match_index, weights=votes, minlength=match_count).astype(np.int64)
+    # The participants of every match by decreasing votes. Since match_index is sorted, every match keeps its offsets
+    order = np.lexsort((-votes, match_index))
+    sorted_votes = votes[order]
+    starts = offsets[:-1]
+    padded_votes = np.append(sorted_votes, 0)
+    top = np.where(counts > 0, padded_votes[starts], 0)
+    second = np.where(counts > 1, padded_votes[np.minimum(starts + 1, len(votes))], 0)
+    over = statuses == _OVER_CODE
+    winner = over[match_index] & (votes == top[match_index])
+    winner_counts = np.bincount(match_index, weights=winner, minlength=match_count).astype(np.int64)
+
+    # Rank 1 is the most voted of the match, ties share the same rank
+    positions = np.arange(len(votes))
+    new_value = np.ones(len(votes), dtype=bool)
+    if len(votes):
+        new_value[1:] = (match_index[order][1:] != match_index[order][:-1]) | (sorted_votes[1:] != sorted_votes[:-1])
+    ranks = np.empty(len(votes), dtype=np.int64)
+    ranks[order] = np.maximum.accumulate(np.where(new_value, positions, 0)) - starts[match_index[order]] + 1
+    shares = np.divide(votes, totals[match_index], out=np.zeros(len(votes)), where=totals[match_index] > 0)
+
+    posted_times = _column(table.posted_times)
+    phase_numbers = np.full(match_count, phase.phase_number, dtype=np.int64)
+    matches = {
+        "phase_number": phase_numbers,
+        "match_number": match_numbers,
+        "status": _MATCH_STATUS_VALUES[statuses],
+        "post_id": np.array(table.post_ids, dtype=object),
+        "posted_time": np.where(posted_times == _NO_TIME, "",
+                                np.datetime_as_string(posted_times.astype("datetime64[us]"))).astype(object),
+        "extension_seconds": _column(table.extensions) / 1e6,
+        "participants": counts,
+        "total_votes": totals,
+        "top_votes": top.astype(np.int64),
+        "margin": (top - second).astype(np.int64),
+        "winners": winner_counts,
+    }
+    participants = {
+        "phase_number": np.full(len(votes), phase.phase_number, dtype=np.int64),
+        "match_number": match_numbers[match_index],
+        "image_row": _poll_rows(table.images, table.image_rows, images),
+        "reaction": np.array(table.reaction_names, dtype=object)[_column(table.reaction_codes)]
+        if table.reaction_names else np.zeros(0, dtype=object),
+        "votes": votes,
+        "share": np.round(shares, 4),
+        "rank": ranks,
+        "winner": winner,
+    }
+    phase_participants = {
+        "image_row": _poll_rows(phase.participants.table, phase.participants.rows, images),
+    }
+    return {"matches": matches, "participants": participants, "phase_participants": phase_participants}
+
+
+class PollResults(object):
+    """
+    Columnar tables of the results of a poll, flattened from its PollData:
+    - images: image_id, image_path, fb_url
+    - matches: one row per match, with its total votes, the votes of its most voted participant and its margin over
+      the second one
+    - participants: one row per participant of a match, with its votes, share and rank in the match
+    - standings: one row per image, from the furthest in the poll and the most voted, with the votes of every phase
+    - phases: one row per phase, with the distribution of the votes and of the margins of its matches
+    """
+
+    def __init__(self, poll_data: PollData, images: Table, phase_tables: List[Dict[str, Table]]):
+        """
+        :param images: the flattened images of the poll
+        :param phase_tables: the flattened phases of the poll
+        """
+        self.images = images
+        self.matches = _concat([tables["matches"] for tables in phase_tables])
+        participants = _concat([tables["participants"] for tables in phase_tables])
+        image_ids = self.images["image_id"]
+        self.participants: Table = {("image_id" if name == "image_row" else name):
+                                    (image_ids[column] if name == "image_row" else column)
+                                    for (name, column) in participants.items()}
+        self.standings = self._standings(len(poll_data.images), participants, phase_tables,
+                                         [phase.phase_number for phase in poll_data.phases])
+        self.phases = self._phases(poll_data, phase_tables)
+
+    def _standings(self, image_count: int, participants: Table, phase_tables: List[Dict[str, Table]],
+                   phase_numbers: List[int]) -> Table:
+        last_phase = np.zeros(image_count, dtype=np.int64)
+        phase_votes = dict()
+        for phase_number, tables in zip(phase_numbers, phase_tables):
+            last_phase[tables["phase_participants"]["image_row"]] = phase_number
+            phase_votes[f"votes_phase_{phase_number}"] = np.bincount(
+                tables["participants"]["image_row"], weights=tables["participants"]["votes"],
+                minlength=image_count).astype(np.int64)
+        rows = participants.get("image_row", np.zeros(0, dtype=np.int64))
+        total_votes = np.bincount(rows, weights=participants.get("votes"), minlength=image_count).astype(np.int64)
+        matches = np.bincount(rows, minlength=image_count)
+        wins = np.bincount(rows, weights=participants.get("winner"), minlength=image_count).astype(np.int64)
+        order = np.lexsort((self.images["image_id"], -total_votes, -last_phase))
+        standings = {"position": np.arange(1, image_count + 1), "image_id": self.images["image_id"],
+                     "last_phase": last_phase, "total_votes": total_votes, "matches": matches, "wins": wins,
+                     **phase_votes}
+        return {name: (column if name == "position" else column[order]) for (name, column) in standings.items()}
+
+    @staticmethod
+    def _phases(poll_data: PollData, phase_tables: List[Dict[str, Table]]) -> Table:
+        columns: Dict[str, list] = {name: [] for name in (
+            "phase_number", "status", "participants", "matches", "matches_over", "total_votes", "mean_votes",
+            "median_votes", "p90_votes", "max_votes", "mean_margin", "median_margin", "tied_matches")}
+        for phase, tables in zip(poll_data.phases, phase_tables):
+            votes = tables["participants"]["votes"]
+            matches = tables["matches"]
+            over = matches["status"] == MatchStatus.OVER.value
+            margins = matches["margin"][over]
+            columns["phase_number"].append(phase.phase_number)
+            columns["status"].append(phase.status.value)
+            columns["participants"].append(len(tables["phase_participants"]["image_row"]))
+            columns["matches"].append(len(matches["match_number"]))
+            columns["matches_over"].append(int(over.sum()))
+            columns["total_votes"].append(int(votes.sum()))
+            columns["mean_votes"].append(round(float(votes.mean()), 2) if len(votes) else 0.0)
+            columns["median_votes"].append(float(np.median(votes)) if len(votes) else 0.0)
+            columns["p90_votes"].append(round(float(np.percentile(votes, 90)), 2) if len(votes) else 0.0)
+            columns["max_votes"].append(int(votes.max()) if len(votes) else 0)
+            columns["mean_margin"].append(round(float(margins.mean()), 2) if len(margins) else 0.0)
+            columns["median_margin"].append(float(np.median(margins)) if len(margins) else 0.0)
+            columns["tied_matches"].append(int((matches["winners"][over] > 1).sum()))
+        return {name: np.array(values) for (name, values) in columns.items()}
+
+    def tables(self) -> Dict[str, Table]:
+        return {"images": self.images, "matches": self.matches, "participants": self.participants,
+                "standings": self.standings, "phases": self.phases}
+
+
+def write_csv(table: Table, fpath: str) -> None:
+    temp_path = f"{fpath}.tmp"
+    with open(temp_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(table.keys())
+        writer.writerows(zip(*(column.tolist() for column in table.values())))
+    os.replace(temp_path, fpath)
+
+
+def write_parquet(table: Table, fpath: str) -> None:
+    import pyarrow
+    import pyarrow.parquet
+    temp_path = f"{fpath}.tmp"
+    pyarrow.parquet.write_table(pyarrow.table({name: column.tolist() if column.dtype == object else column
+                                               for (name, column) in table.items()}), temp_path)
+    os.replace(temp_path, fpath)
+
+
+class ResultsExporter(object):
+    """
+    Exports the results of a poll as CSV or Parquet files, one per table of PollResults, in target_dir. Phases over
+    can't change anymore, so they are only flattened once.
+    """
+
+    def __init__(self, target_dir: str, file_format: str = "CSV"):
+        if file_format not in ("CSV", "PARQUET"):
+            raise ValueError(f"Unknown results format: {file_format}")
+        if file_format == "PARQUET":
+            try:
+                import pyarrow.parquet  # noqa: F401
+            except ImportError:
+                raise ImportError("The PARQUET results format needs pyarrow to be installed.")
+        self.target_dir = target_dir
+        self.file_format = file_format
+        self._phase_tables: Dict[int, Dict[str, Table]] = dict()
+        self._images: Tuple[Union[ImageTable, None], int, Table] = (None, -1, dict())
+        os.makedirs(target_dir, exist_ok=True)
+
+    def results(self, poll_data: PollData) -> PollResults:
+        images, revision, image_table = self._images
+        if images is not poll_data.images or revision != poll_data.images.revision:
+            image_table = flatten_images(poll_data.images)
+            self._images = (poll_data.images, poll_data.images.revision, image_table)
+        phase_tables = []
+        for phase in poll_data.phases:
+            tables = self._phase_tables.get(phase.phase_number)
+            if tables is None:
+                tables = flatten_phase(phase, poll_data.images)
+                if phase.status == PhaseStatus.OVER:
+                    self._phase_tables[phase.phase_number] = tables
+            phase_tables.append(tables)
+        return PollResults(poll_data, image_table, phase_tables)
+
+    def export(self, poll_data: PollData) -> PollResults:
+        results = self.results(poll_data)
+        extension, write = (".csv", write_csv) if self.file_format == "CSV" else (".parquet", write_parquet)
+        for name, table in results.tables().items():
+            write(table, path.join(self.target_dir, name + extension))
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports the results of a poll as columnar tables.")
+    parser.add_argument("poll_data_file")
+    parser.add_argument("target_dir")
+    parser.add_argument("--backend", choices=["JSON", "SQLITE"], default="JSON")
+    parser.add_argument("--format", choices=["CSV", "PARQUET"], default="CSV")
+    args = parser.parse_args()
+    poll_data = create_poll_store(args.backend, args.poll_data_file).load()
+    if poll_data is None:
+        raise FileNotFoundError(f"Poll data file {args.poll_data_file} not found.")
+    ResultsExporter(args.target_dir, args.format).export(poll_data)
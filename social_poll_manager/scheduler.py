@@ -0,0 +1,117 @@
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple, Union, Set
+
+from social_poll_manager import utils
+
+logger = utils.get_logger(__name__)
+
+Job = Tuple[datetime, int, str, Union[str, None], Callable[[], None]]
+
+
+class Scheduler(object):
+    """
+    Runs timed jobs in deadline order. The scheduler sleeps until the next deadline, and wakes up early if a job with
+    an earlier deadline is scheduled in the meantime. run() returns once there are no jobs left.
+    With more than one worker, jobs run concurrently on a thread pool, but jobs sharing the same key (e.g. the jobs
+    of the same poll) never run at the same time. With a single worker, jobs run in the calling thread. Either way, a
+    failing job cancels the other jobs of its key only, and its exception is kept in failures.
+    """
+
+    def __init__(self, workers: int = 1):
+        self.workers = workers
+        self._jobs: List[Job] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._running_keys: Set[str] = set()
+        self._running = 0
+        self._stopped = False
+        # Exception of the failed job of every key
+        self.failures: Dict[Union[str, None], Exception] = dict()
+
+    def schedule(self, when: datetime, name: str, job: Callable[[], None], key: str = None) -> None:
+        """
+        :param when: the time at which the job has to run. Times in the past mean as soon as possible
+        :param name: a description of the job, used for logging
+        :param job: the function to be called
+        :param key: jobs with the same key never run concurrently
+        """
+        with self._condition:
+            heapq.heappush(self._jobs, (when, next(self._sequence), name, key, job))
+            self._condition.notify_all()
+
+    def schedule_now(self, name: str, job: Callable[[], None], key: str = None) -> None:
+        self.schedule(datetime.now(), name, job, key)
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._jobs)
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def _next_job(self) -> Union[Job, None]:
+        with self._condition:
+            while not self._stopped:
+                if not self._jobs and self._running == 0:
+                    return None
+                # Jobs whose key is busy are skipped, they will be picked up when the running one completes
+                candidate = None
+                if self._running < self.workers:
+                    candidate = min((job for job in self._jobs if job[3] is None or job[3] not in self._running_keys),
+                                    default=None)
+                if candidate is not None:
+                    when, _, name, _, _ = candidate
+                    wait_seconds = (when - datetime.now()).total_seconds()
+                    if wait_seconds <= 0:
+                        self._jobs.remove(candidate)
+                        heapq.heapify(self._jobs)
+                        self._running += 1
+                        if candidate[3] is not None:
+                            self._running_keys.add(candidate[3])
+                        return candidate
+                    logger.info(f"Next job '{name}' at {when}. Sleeping for {when - datetime.now()}.")
+                    self._condition.wait(timeout=wait_seconds)
+                else:
+                    self._condition.wait()
+            return None
+
+    def _finish(self, key: Union[str, None]) -> None:
+        with self._condition:
+            self._running -= 1
+            self._running_keys.discard(key)
+            self._condition.notify_all()
+
+    def _run_job(self, job: Job) -> None:
+        _, _, name, key, function = job
+        try:
+            function()
+        except Exception as e:
+            logger.exception(f"Job '{name}' failed. No further jobs will be run for {key}.")
+            with self._condition:
+                self.failures[key] = e
+                self._jobs = [queued for queued in self._jobs if key is None or queued[3] != key]
+                heapq.heapify(self._jobs)
+        finally:
+            self._finish(key)
+
+    def run(self) -> None:
+        if self.workers == 1:
+            while True:
+                job = self._next_job()
+                if job is None:
+                    return
+                logger.info(f"Running job '{job[2]}'...")
+                self._run_job(job)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="scheduler") as pool:
+            while True:
+                job = self._next_job()
+                if job is None:
+                    return
+                logger.info(f"Running job '{job[2]}'...")
+                pool.submit(self._run_job, job)
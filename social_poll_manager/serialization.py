@@ -0,0 +1,261 @@
+import json
+from array import array
+from collections.abc import MutableSequence
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import List, Union, Callable, Iterable
+
+from social_poll_manager.poll_data import ImageData, MatchData, PhaseData, PollData, MatchStatus, PhaseStatus, \
+    ImageTable, ImageList, MatchList
+
+FORMAT_NAME = "poll_data"
+FORMAT_VERSION = 1
+
+# Schema of the encoded objects. Images are stored once and every other object refers to them by image_id.
+#
+# image:       {"image_id": str, "image_path": str, "fb_url": str | null, "working_path": str | null,
+#               "preview_path": str | null}
+# participant: {"image_id": str, "reaction": str, "reactions": int}
+# match:       {"match_number": int, "status": MatchStatus value, "post_id": str | null,
+#               "posted_time": ISO 8601 str | null, "extension": seconds, "participants": [participant]}
+# phase:       {"phase_number": int, "status": PhaseStatus value, "participants": [image_id], "matches": [match]}
+
+
+def encode_image(image: ImageData) -> dict:
+    return {"image_id": image.image_id, "image_path": image.image_path, "fb_url": image.fb_url,
+            "working_path": image.working_path, "preview_path": image.preview_path}
+
+
+def decode_images(datas: Iterable[dict]) -> ImageTable:
+    images = ImageTable()
+    for data in datas:
+        images.add(data["image_id"], data["image_path"], data["fb_url"], data.get("working_path"),
+                   data.get("preview_path"))
+    return images
+
+
+def encode_match(match: MatchData) -> dict:
+    return {
+        "match_number": match.match_number,
+        "status": match.match_status.value,
+        "post_id": match.post_id,
+        "posted_time": match.posted_time.isoformat() if match.posted_time is not None else None,
+        "extension": getattr(match, "extension", timedelta(0)).total_seconds(),
+        "participants": [{"image_id": participant.image_data.image_id,
+                          "reaction": participant.assigned_reaction,
+                          "reactions": participant.reactions} for participant in match.participants]
+    }
+
+
+def decode_match(data: dict, matches: MatchList) -> MatchData:
+    """
+    Decodes a match and appends it to the matches of its phase.
+    """
+    participants = data["participants"]
+    images = matches.table.images
+    match = matches.add(data["match_number"], [images.row(participant["image_id"]) for participant in participants],
+                        [participant["reaction"] for participant in participants],
+                        [participant["reactions"] for participant in participants])
+    match.match_status = MatchStatus(data["status"])
+    match.post_id = data["post_id"]
+    match.posted_time = datetime.fromisoformat(data["posted_time"]) if data["posted_time"] is not None else None
+    match.extension = timedelta(seconds=data.get("extension", 0))
+    return match
+
+
+def encode_phase(phase: PhaseData) -> dict:
+    return {
+        "phase_number": phase.phase_number,
+        "status": phase.status.value,
+        "participants": phase.participants.image_ids(),
+        "matches": [encode_match(match) for match in phase.matches]
+    }
+
+
+def decode_phase(data: dict, images: ImageTable) -> PhaseData:
+    phase = PhaseData(ImageList(images, array("I", map(images.row, data["participants"]))), data["phase_number"])
+    phase.status = PhaseStatus(data["status"])
+    for match_data in data["matches"]:
+        decode_match(match_data, phase.matches)
+    return phase
+
+
+def encode_header(poll_data: PollData) -> dict:
+    """
+    Builds the small summary stored at the beginning of the poll data file, which can be read without decoding the
+    rest of the file.
+    """
+    current_phase = poll_data.phases[-1]
+    return {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "images": len(poll_data.images),
+        "phases": len(poll_data.phases),
+        "seed": getattr(poll_data, "seed", None),
+        "current_phase": {
+            "phase_number": current_phase.phase_number,
+            "status": current_phase.status.value,
+            "participants": len(current_phase.participants),
+            "matches": len(current_phase.matches),
+            "matches_posted": sum(1 for match in current_phase.matches
+                                  if match.match_status != MatchStatus.GENERATED),
+            "matches_over": sum(1 for match in current_phase.matches if match.match_status == MatchStatus.OVER)
+        }
+    }
+
+
+def dumps(data: Union[dict, list]) -> str:
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+class LazyPhaseList(MutableSequence):
+    """
+    List of phases where each phase can be given as a loader, which is only called the first time the phase is
+    accessed. Used to avoid decoding the historical phases of a poll at startup.
+    """
+
+    def __init__(self, phases: Iterable[Union[PhaseData, Callable[[], PhaseData]]] = ()):
+        self._phases = list(phases)
+
+    def is_loaded(self, idx: int) -> bool:
+        return isinstance(self._phases[idx], PhaseData)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        phase = self._phases[idx]
+        if not isinstance(phase, PhaseData):
+            phase = phase()
+            self._phases[idx] = phase
+        return phase
+
+    def __setitem__(self, idx, phase: PhaseData):
+        self._phases[idx] = phase
+
+    def __delitem__(self, idx):
+        del self._phases[idx]
+
+    def __len__(self) -> int:
+        return len(self._phases)
+
+    def insert(self, idx: int, phase: PhaseData) -> None:
+        self._phases.insert(idx, phase)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({len(self)} phases)"
+
+
+def is_legacy_content(first_line: str) -> bool:
+    """
+    :return: whether the given first line of a poll data file belongs to a file written by jsonpickle
+    """
+    return "py/object" in first_line or first_line.strip() == "{"
+
+
+class _LegacyRecord(object):
+    """
+    Plain object standing for one of the poll data classes in the files written by jsonpickle, which stored their
+    attributes as they were.
+    """
+
+
+def _legacy_classes(module: str) -> dict:
+    """
+    :return: stand-ins for the poll data classes and enums, by name, which jsonpickle reads and writes as the ones of
+    the given module
+    """
+    classes = {name: type(name, (_LegacyRecord,), {"__module__": module})
+               for name in ("ImageData", "MatchParticipantData", "MatchData", "PhaseData", "PollData")}
+    for enum in (MatchStatus, PhaseStatus):
+        classes[enum.__name__] = Enum(enum.__name__, [(member.name, member.value) for member in enum], module=module)
+    return classes
+
+
+# The classes were defined in manager_core when jsonpickle wrote the files, and moved to poll_data later. jsonpickle
+# registers classes under their module and name, so each module gets its own stand-ins
+LEGACY_CLASSES = _legacy_classes("social_poll_manager.manager_core")
+_LEGACY_CLASS_LIST = [*LEGACY_CLASSES.values(), *_legacy_classes("social_poll_manager.poll_data").values()]
+
+
+def decode_legacy(content: str) -> PollData:
+    """
+    Decodes a poll data file written by jsonpickle.
+    """
+    # Only the old files need jsonpickle
+    import jsonpickle
+    legacy = jsonpickle.decode(content, classes=_LEGACY_CLASS_LIST)
+    images = ImageTable()
+    for image in legacy.images.values():
+        images.add(image.image_id, image.image_path, getattr(image, "fb_url", None))
+    poll_data = PollData(images)
+    poll_data.seed = getattr(legacy, "seed", None)
+    for legacy_phase in legacy.phases:
+        phase = PhaseData(ImageList(images, array("I", (images.add(image.image_id, image.image_path,
+                                                                   getattr(image, "fb_url", None))
+                                                        for image in legacy_phase.participants))),
+                          legacy_phase.phase_number)
+        phase.status = PhaseStatus(legacy_phase.status.value)
+        for legacy_match in legacy_phase.matches:
+            participants = legacy_match.participants
+            match = phase.matches.add(legacy_match.match_number,
+                                      [images.row(participant.image_data.image_id) for participant in participants],
+                                      [participant.assigned_reaction for participant in participants],
+                                      [participant.reactions for participant in participants])
+            match.match_status = MatchStatus(legacy_match.match_status.value)
+            match.post_id = legacy_match.post_id
+            match.posted_time = legacy_match.posted_time
+            match.extension = getattr(legacy_match, "extension", timedelta(0))
+        poll_data.phases.append(phase)
+    return poll_data
+
+
+def encode_legacy(poll_data: PollData) -> str:
+    """
+    Encodes the poll data as jsonpickle used to, for the legacy backend of the benchmarks.
+    """
+    def record(name: str, **attributes) -> _LegacyRecord:
+        legacy = LEGACY_CLASSES[name]()
+        vars(legacy).update(attributes)
+        return legacy
+
+    import jsonpickle
+    images = {image_id: record("ImageData", image_id=image.image_id, image_path=image.image_path,
+                               fb_url=image.fb_url)
+              for (image_id, image) in poll_data.images.items()}
+    phases = []
+    for phase in poll_data.phases:
+        matches = [record("MatchData", match_status=LEGACY_CLASSES["MatchStatus"](match.match_status.value),
+                          participants=[record("MatchParticipantData",
+                                               image_data=images[participant.image_data.image_id],
+                                               assigned_reaction=participant.assigned_reaction,
+                                               reactions=participant.reactions)
+                                        for participant in match.participants],
+                          post_id=match.post_id, match_number=match.match_number, posted_time=match.posted_time,
+                          extension=match.extension)
+                   for match in phase.matches]
+        participants = [images[image_id] for image_id in phase.participants.image_ids()]
+        phases.append(record("PhaseData", participants=participants, matches=matches, phase_number=phase.phase_number,
+                             status=LEGACY_CLASSES["PhaseStatus"](phase.status.value)))
+    return jsonpickle.encode(record("PollData", images=images, phases=phases, seed=poll_data.seed), indent=4)
+
+
+def loaded_phases(phases: List[PhaseData]) -> Iterable[PhaseData]:
+    """
+    :return: the phases of the list which have already been decoded, without triggering the decoding of lazy ones
+    """
+    if isinstance(phases, LazyPhaseList):
+        return (phases[idx] for idx in range(len(phases)) if phases.is_loaded(idx))
+    return phases
+
+
+def phases_from_lines(lines: List[str], images: ImageTable) -> LazyPhaseList:
+    """
+    Builds the phase list from the encoded phase lines. Only the last (current) phase is decoded right away.
+    """
+    def loader(line: str) -> Callable[[], PhaseData]:
+        return lambda: decode_phase(json.loads(line), images)
+
+    phases: List[Union[PhaseData, Callable[[], PhaseData]]] = [loader(line) for line in lines[:-1]]
+    if lines:
+        phases.append(decode_phase(json.loads(lines[-1]), images))
+    return LazyPhaseList(phases)
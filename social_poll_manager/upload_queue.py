@@ -0,0 +1,337 @@
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+from io import BytesIO
+from os import path
+from queue import Queue
+from typing import Dict, Union, Mapping
+
+import requests
+import facebook
+from facebook import GraphAPI, GraphAPIError
+
+from social_poll_manager import utils, metrics
+from social_poll_manager.multipart import MultipartFile
+
+logger = utils.get_logger(__name__)
+
+# Graph API error codes, see https://developers.facebook.com/docs/graph-api/overview/rate-limiting
+RATE_LIMIT_ERROR_CODES = {4, 17, 32, 613} | set(range(80001, 80015))
+SPAM_ERROR_CODES = {368}
+TRANSIENT_ERROR_CODES = {1, 2}
+FATAL_ERROR_CODES = {10, 102, 190, 200}
+
+USAGE_HEADERS = ("X-App-Usage", "X-Page-Usage", "X-Ad-Account-Usage")
+BUSINESS_USAGE_HEADER = "X-Business-Use-Case-Usage"
+
+
+class UploadError(Exception):
+    pass
+
+
+class UsageTracker(object):
+    """
+    Keeps track of the Graph API usage reported in the X-App-Usage, X-Page-Usage and X-Business-Use-Case-Usage
+    response headers, and computes how long to wait before the next call to stay under the limits. Usage is reported
+    as a percentage of the limit over a rolling one hour window.
+    """
+
+    def __init__(self, soft_limit: float = 60, hard_limit: float = 95, max_delay: float = 600):
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.max_delay = max_delay
+        self.usage = 0.0
+        self.regain_access_time = 0.0
+        self._updated = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        usage = None
+        regain_minutes = 0
+        for header in USAGE_HEADERS:
+            if header in headers:
+                try:
+                    usage = max(usage or 0, *json.loads(headers[header]).values())
+                except (ValueError, TypeError):
+                    logger.warning(f"Unable to parse {header} header: {headers[header]}")
+        if BUSINESS_USAGE_HEADER in headers:
+            try:
+                for entries in json.loads(headers[BUSINESS_USAGE_HEADER]).values():
+                    for entry in entries:
+                        usage = max(usage or 0, entry.get("call_count", 0), entry.get("total_cputime", 0),
+                                    entry.get("total_time", 0))
+                        regain_minutes = max(regain_minutes, entry.get("estimated_time_to_regain_access", 0))
+            except (ValueError, TypeError, AttributeError):
+                logger.warning(f"Unable to parse {BUSINESS_USAGE_HEADER} header: {headers[BUSINESS_USAGE_HEADER]}")
+        if usage is None:
+            return
+        with self._lock:
+            self.usage = float(usage)
+            self._updated = time.time()
+            if regain_minutes:
+                self.regain_access_time = time.time() + regain_minutes * 60
+
+    def current_usage(self) -> float:
+        with self._lock:
+            # Usage is computed over the last hour, so an old reading overestimates it
+            age = time.time() - self._updated
+            return self.usage * max(0.0, 1 - age / 3600)
+
+    def pacing_delay(self) -> float:
+        """
+        :return: the seconds to wait before the next call
+        """
+        regain_delay = self.regain_access_time - time.time()
+        if regain_delay > 0:
+            return regain_delay
+        usage = self.current_usage()
+        if usage < self.soft_limit:
+            return 0
+        if usage >= self.hard_limit:
+            return self.max_delay
+        return self.max_delay * (usage - self.soft_limit) / (self.hard_limit - self.soft_limit)
+
+    def response_hook(self, response: requests.Response, *args, **kwargs) -> None:
+        self.update(response.headers)
+
+
+def backoff_delay(error: Exception, attempt: int, usage_tracker: UsageTracker = None) -> Union[float, None]:
+    """
+    Computes a jittered exponential backoff tuned to the kind of error.
+    :return: the seconds to wait before retrying, or None if the error can't be recovered by retrying
+    """
+    code = getattr(error, "code", None)
+    if code in FATAL_ERROR_CODES:
+        return None
+    if code in SPAM_ERROR_CODES or "spam" in str(error).lower():
+        base = 30 * 60
+    elif code in RATE_LIMIT_ERROR_CODES:
+        base = 15 * 60
+        if usage_tracker is not None:
+            base = max(base, usage_tracker.regain_access_time - time.time())
+    elif code in TRANSIENT_ERROR_CODES or isinstance(error, requests.RequestException):
+        base = 30
+    else:
+        base = 180
+    delay = min(base * 2 ** attempt, 2 * 60 * 60)
+    return random.uniform(delay / 2, delay)
+
+
+class GraphUploader(object):
+    """
+    Uploads photos to the Graph API, reporting the usage headers of every response to the usage tracker.
+    """
+
+    def __init__(self, graph_api: GraphAPI, usage_tracker: UsageTracker, graph_url: str = None):
+        self.graph_api = graph_api
+        self.usage_tracker = usage_tracker
+        self.graph_url = graph_url or facebook.FACEBOOK_GRAPH_URL
+
+    def put_photo(self, image_path: str, message: str, album: str) -> str:
+        """
+        :return: the id of the uploaded photo
+        """
+        # The body is streamed from the file instead of being built in memory
+        with MultipartFile({"access_token": self.graph_api.access_token, "message": message}, "source",
+                           image_path) as body:
+            response = self.graph_api.session.post(f"{self.graph_url}{self.graph_api.version}/{album}/photos",
+                                                   data=body,
+                                                   headers={"Content-Type": body.content_type,
+                                                            "Content-Length": str(len(body))},
+                                                   timeout=self.graph_api.timeout)
+            metrics.UPLOADED_BYTES.inc(len(body))
+        self.usage_tracker.update(response.headers)
+        try:
+            result = response.json()
+        except ValueError:
+            raise GraphAPIError({"error": {"message": f"Unexpected response ({response.status_code}): "
+                                                      f"{response.text[:200]}"}})
+        if "error" in result:
+            raise GraphAPIError(result)
+        return result["id"]
+
+
+class UploadQueue(object):
+    """
+    Queue of photo uploads, processed in order by a background worker that paces the posts according to the Graph API
+    usage and retries failed uploads with backoff. Every upload is identified by a key and recorded in a journal
+    file, so that after a restart completed uploads are not posted again and pending ones are resumed.
+    """
+
+    def __init__(self, journal_file: str, uploader: GraphUploader, max_attempts: int = 8, time_scale: float = 1):
+        """
+        :param time_scale: divides the pacing and backoff delays, to simulate polls faster
+        """
+        self.journal_file = journal_file
+        self.uploads_dir = journal_file + ".d"
+        self.uploader = uploader
+        self.max_attempts = max_attempts
+        self.time_scale = time_scale
+        self._entries: Dict[str, dict] = dict()
+        self._futures: Dict[str, Future] = dict()
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._worker: Union[threading.Thread, None] = None
+        self._closing = threading.Event()
+        try:
+            with open(journal_file, encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            pass
+
+    def _save(self) -> None:
+        utils.safe_write(self.journal_file, json.dumps(self._entries, ensure_ascii=False))
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._work, name="upload-queue", daemon=True)
+            self._worker.start()
+
+    def _was_posted(self, entry: dict) -> Union[str, None]:
+        """
+        Checks whether an upload interrupted by a crash actually reached the album, looking for a recent photo with
+        the same message. On a page, type=uploaded lists the photos it posted rather than the ones it is tagged in.
+        :return: the id of the photo, if found
+        """
+        photos = self.uploader.graph_api.get_connections(entry["album"], "photos", fields="id,name", limit=25,
+                                                         type="uploaded")
+        for photo in photos.get("data", []):
+            if photo.get("name") == entry["message"]:
+                return photo["id"]
+        return None
+
+    def submit(self, key: str, image: Union[str, BytesIO], message: str, album: str) -> Future:
+        """
+        Queues an upload.
+        :param key: identifies the upload. Submitting again a key which was already uploaded returns its post id
+        :param image: path of the image or its content
+        :param message: the message used as image description
+        :param album: the id of the album
+        :return: a future resolving to the post id
+        """
+        with self._lock:
+            if key in self._futures:
+                return self._futures[key]
+            future = Future()
+            self._futures[key] = future
+            entry = self._entries.get(key)
+            if entry is not None and entry["status"] == "done":
+                future.set_result(entry["post_id"])
+                return future
+        # The lookup is a network round-trip, the worker keeps going meanwhile. Submitting the key again returns the
+        # future registered above
+        if entry is not None and entry["status"] == "in_flight":
+            post_id = None
+            try:
+                post_id = self._was_posted(entry)
+            except (GraphAPIError, requests.RequestException):
+                logger.warning(f"Unable to check whether upload {key} was completed before the restart. Posting it "
+                               f"again.", exc_info=True)
+            if post_id is not None:
+                logger.info(f"Upload {key} was completed before the restart. Not posting it again.")
+                with self._lock:
+                    entry.update(status="done", post_id=post_id)
+                    self._save()
+                future.set_result(post_id)
+                return future
+        if isinstance(image, BytesIO):
+            os.makedirs(self.uploads_dir, exist_ok=True)
+            image_path = path.join(self.uploads_dir, f"{key}.jpg")
+            with open(image_path, "wb") as f:
+                f.write(image.getbuffer())
+            image = image_path
+        with self._lock:
+            self._entries[key] = {"image": image, "message": message, "album": album, "status": "queued",
+                                  "post_id": None, "attempts": 0}
+            self._save()
+            self._queue.put(key)
+            self._ensure_worker()
+        return future
+
+    def forget(self, key: str) -> None:
+        """
+        Drops a completed upload from the journal, once its post id has been persisted elsewhere.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            self._futures.pop(key, None)
+            if entry is not None and entry["image"].startswith(self.uploads_dir):
+                os.remove(entry["image"])
+            self._save()
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _work(self) -> None:
+        while True:
+            key = self._queue.get()
+            if key is None:
+                return
+            with self._lock:
+                entry = self._entries[key]
+                future = self._futures[key]
+            if self._closing.is_set():
+                # Left in the journal as queued, the upload is resumed on the next run
+                future.cancel()
+                continue
+            try:
+                future.set_result(self._upload(key, entry))
+            except Exception as e:
+                # Failed uploads can be submitted again
+                with self._lock:
+                    self._futures.pop(key, None)
+                future.set_exception(e)
+
+    def _upload(self, key: str, entry: dict) -> str:
+        while True:
+            delay = self.uploader.usage_tracker.pacing_delay()
+            if delay > 0:
+                logger.info(f"Graph API usage at {self.uploader.usage_tracker.current_usage():.0f}%. Waiting "
+                            f"{delay:.0f}s before the next upload.")
+                self._sleep(delay)
+            with self._lock:
+                entry["status"] = "in_flight"
+                self._save()
+            try:
+                post_id = self.uploader.put_photo(entry["image"], entry["message"], entry["album"])
+            except Exception as e:
+                attempt = entry["attempts"]
+                with self._lock:
+                    entry["attempts"] += 1
+                    entry["status"] = "queued"
+                    self._save()
+                retry_delay = backoff_delay(e, attempt, self.uploader.usage_tracker)
+                if retry_delay is None or entry["attempts"] >= self.max_attempts:
+                    logger.error(f"Unable to upload {key} after {entry['attempts']} attempts.", exc_info=True)
+                    raise UploadError(f"Unable to upload {key}: {e}") from e
+                logger.warning(f"Exception occurred during upload of {key}. Retrying in {retry_delay:.0f}s...",
+                               exc_info=True)
+                metrics.RETRIES.inc(operation="upload")
+                self._sleep(retry_delay)
+                continue
+            with self._lock:
+                entry.update(status="done", post_id=post_id)
+                self._save()
+            return post_id
+
+    def _sleep(self, seconds: float) -> None:
+        if self._closing.wait(seconds / self.time_scale):
+            raise UploadError("The upload queue was closed.")
+
+    def close(self) -> None:
+        """
+        Stops the worker. Uploads not completed yet stay in the journal and are resumed when submitted again.
+        """
+        if self._worker is not None and self._worker.is_alive():
+            self._closing.set()
+            self._queue.put(None)
+            self._worker.join()
+        self._worker = None
+        with self._lock:
+            self._queue = Queue()
+            self._futures = {key: future for (key, future) in self._futures.items()
+                             if future.done() and not future.cancelled()}
+        self._closing.clear()
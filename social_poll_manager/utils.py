@@ -1,9 +1,28 @@
+import json
 import logging
 import shutil
 import sys
+import threading
+import time
 from logging import Logger
+from typing import TYPE_CHECKING
 
-import jsonpickle
+# requests and jsonpickle are imported where they are used, so that importing utils stays cheap for the commands
+# which need neither, e.g. the poll status
+if TYPE_CHECKING:
+    import requests
+
+
+def safe_write(fpath: str, content: str) -> None:
+    """
+    Utility function used to avoid file corruption in case of abrupt termination of the script.
+    :param fpath: path of the file to be written
+    :param content: the content to be saved
+    """
+    safe_path = fpath + "_safe"
+    with open(safe_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    shutil.move(safe_path, fpath)
 
 
 def safe_json_dump(fpath: str, obj: object) -> None:
@@ -12,23 +31,85 @@ def safe_json_dump(fpath: str, obj: object) -> None:
     :param fpath: path where the json has to be saved
     :param obj: the content to be saved
     """
-    safe_path = fpath + "_safe"
-    with open(safe_path, "w") as f:
-        js = jsonpickle.encode(obj, indent=4)
-        f.write(js)
-    shutil.move(safe_path, fpath)
+    import jsonpickle
+    safe_write(fpath, jsonpickle.encode(obj, indent=4))
+
+
+def create_http_session(pool_size: int = 10) -> "requests.Session":
+    """
+    Creates a http session whose connection pool is big enough to be shared among pool_size concurrent workers.
+    :param pool_size: the maximum number of connections kept alive for each host
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class RateLimiter(object):
+    """
+    Thread-safe token bucket allowing on average rate calls per second, with bursts of up to burst calls.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats every record as a single line json object, for log collectors.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": self.formatTime(record), "logger": record.name, "level": record.levelname,
+                 "thread": record.threadName, "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+LOG_FORMAT = '[%(asctime)s|%(name)s|%(levelname)s] %(message)s'
+
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
 
 
 def get_logger(name: str, level: int = logging.INFO) -> Logger:
-    logger = Logger(name)
+    """
+    :return: the logger with the given name. Loggers are created once and share the same stdout handler
+    """
+    logger = logging.getLogger(name)
     logger.setLevel(level)
-    handler = logging.StreamHandler(sys.stdout)
-    formatter = logging.Formatter('[%(asctime)s|%(name)s|%(levelname)s] %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    if _log_handler not in logger.handlers:
+        logger.addHandler(_log_handler)
+        # The records are already printed by the shared handler
+        logger.propagate = False
     return logger
 
 
+def set_json_logging(enabled: bool = True) -> None:
+    _log_handler.setFormatter(JsonFormatter() if enabled else logging.Formatter(LOG_FORMAT))
+
+
 seconds_per_unit = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
 
 
@@ -37,8 +118,14 @@ def parse_duration(string_duration: str):
 
 
 def auto_str_and_repr(cls: type):
+    """
+    Adds a __repr__ and a __str__ listing the attributes of the instances, or the ones named in the _repr_fields
+    attribute of the class, if any.
+    """
     def _values(self):
-        return ", ".join([f"{key}={value}" for (key, value) in vars(self).items()])
+        fields = getattr(self, "_repr_fields", None)
+        items = vars(self).items() if fields is None else ((name, getattr(self, name)) for name in fields)
+        return ", ".join([f"{key}={value}" for (key, value) in items])
 
     def __repr__(self):
         return f"{type(self).__name__}({_values(self)})"
@@ -0,0 +1,186 @@
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Tuple, Union
+
+from social_poll_manager import utils
+
+logger = utils.get_logger(__name__)
+
+ReactionCounts = Dict[str, int]
+
+
+class VoteSeries(object):
+    """
+    Time series of the reaction counts of a match, stored in flat typed arrays: one timestamp per sample, and one
+    row of counts per sample with a column per reaction.
+    """
+
+    def __init__(self, reaction_names: List[str]):
+        self.reaction_names = reaction_names
+        self.times = array("d")
+        self.counts = array("I")
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def append(self, timestamp: float, counts: ReactionCounts) -> None:
+        self.times.append(timestamp)
+        self.counts.extend(counts.get(name, 0) for name in self.reaction_names)
+
+    def sample(self, idx: int) -> Tuple[float, List[int]]:
+        if idx < 0:
+            idx += len(self.times)
+        width = len(self.reaction_names)
+        return self.times[idx], self.counts[idx * width:(idx + 1) * width].tolist()
+
+    def latest(self) -> Union[ReactionCounts, None]:
+        if not self.times:
+            return None
+        return dict(zip(self.reaction_names, self.sample(-1)[1]))
+
+
+class TrackedMatch(object):
+
+    def __init__(self, match_number: int, post_id: str, reaction_names: List[str], deadline: datetime,
+                 interval: float):
+        self.match_number = match_number
+        self.post_id = post_id
+        self.deadline = deadline
+        self.series = VoteSeries(reaction_names)
+        self.interval = interval
+        self.next_poll = 0.0
+        self.tie_reported = False
+
+
+class VoteTracker(object):
+    """
+    Polls the reaction counts of the open matches in the background, keeping their history. Matches whose counts keep
+    changing, or which are close to their deadline, are polled every min_interval; the interval of quiet matches
+    doubles at every poll, up to max_interval. Matches tied at the top when close to their deadline are reported
+    once through on_tie, so that they can be extended before the phase ends.
+    """
+
+    def __init__(self, fetch: Callable[[List[str]], Dict[str, Union[ReactionCounts, Exception]]],
+                 min_interval: timedelta = timedelta(minutes=2), max_interval: timedelta = timedelta(minutes=30),
+                 tie_window: timedelta = timedelta(hours=1),
+                 on_tie: Callable[[int, List[Tuple[str, int]]], None] = None):
+        """
+        :param fetch: returns the reaction counts of the given post ids, or the exception raised looking them up
+        :param on_tie: called with the match number and its standings when a match close to its deadline is tied
+        """
+        self.fetch = fetch
+        self.min_interval = min_interval.total_seconds()
+        self.max_interval = max_interval.total_seconds()
+        self.tie_window = tie_window
+        self.on_tie = on_tie
+        self._matches: Dict[int, TrackedMatch] = dict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopped = False
+        self._thread: Union[threading.Thread, None] = None
+
+    def track(self, match_number: int, post_id: str, reaction_names: List[str], deadline: datetime) -> None:
+        with self._wakeup:
+            tracked = self._matches.get(match_number)
+            if tracked is not None and tracked.post_id == post_id:
+                tracked.deadline = deadline
+                tracked.tie_reported = False
+            else:
+                self._matches[match_number] = TrackedMatch(match_number, post_id, reaction_names, deadline,
+                                                           self.min_interval)
+            self._wakeup.notify_all()
+
+    def untrack(self, match_number: int) -> None:
+        with self._lock:
+            self._matches.pop(match_number, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._matches.clear()
+
+    def series(self, match_number: int) -> Union[VoteSeries, None]:
+        with self._lock:
+            tracked = self._matches.get(match_number)
+            return tracked.series if tracked is not None else None
+
+    def standings(self, match_number: int) -> List[Tuple[str, int]]:
+        """
+        :return: the latest (reaction name, count) of every participant of the match, best first
+        """
+        with self._lock:
+            tracked = self._matches.get(match_number)
+            latest = tracked.series.latest() if tracked is not None else None
+        if latest is None:
+            return []
+        return sorted(latest.items(), key=lambda item: item[1], reverse=True)
+
+    def _is_tied(self, match_number: int) -> bool:
+        standings = self.standings(match_number)
+        return len(standings) > 1 and standings[0][1] == standings[1][1]
+
+    def poll(self) -> None:
+        """
+        Fetches the counts of the matches that are due, in a single lookup.
+        """
+        now = time.time()
+        with self._lock:
+            due = [tracked for tracked in self._matches.values() if tracked.next_poll <= now]
+        if not due:
+            return
+        results = self.fetch([tracked.post_id for tracked in due])
+        for tracked in due:
+            counts = results.get(tracked.post_id)
+            if counts is None or isinstance(counts, Exception):
+                logger.warning(f"Unable to track the votes of match {tracked.match_number}: {counts}")
+                tracked.next_poll = now + tracked.interval
+                continue
+            with self._lock:
+                changed = tracked.series.latest() != counts
+                tracked.series.append(now, counts)
+                closing = tracked.deadline - datetime.now() <= self.tie_window
+                if changed or closing:
+                    tracked.interval = self.min_interval
+                else:
+                    tracked.interval = min(tracked.interval * 2, self.max_interval)
+                tracked.next_poll = now + tracked.interval
+            if closing and not tracked.tie_reported and self._is_tied(tracked.match_number):
+                tracked.tie_reported = True
+                standings = self.standings(tracked.match_number)
+                logger.warning(f"Match {tracked.match_number} is tied with {standings[0][1]} votes and closes at "
+                               f"{tracked.deadline}.")
+                if self.on_tie is not None:
+                    self.on_tie(tracked.match_number, standings)
+
+    def _run(self) -> None:
+        while True:
+            with self._wakeup:
+                if self._stopped:
+                    return
+                next_poll = min((tracked.next_poll for tracked in self._matches.values()), default=None)
+                wait_seconds = self.max_interval if next_poll is None else next_poll - time.time()
+                if wait_seconds > 0:
+                    self._wakeup.wait(timeout=wait_seconds)
+                    continue
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Unexpected error while tracking votes.")
+                with self._wakeup:
+                    self._wakeup.wait(timeout=self.min_interval)
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="vote-tracker", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
@@ -0,0 +1,150 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from os import path
+
+from PIL import Image
+
+from social_poll_manager.manager_core import PollManager, ReactionsUnavailableError
+from social_poll_manager.poll_data import ImageTable, MatchStatus, PhaseData, PhaseStatus, PollData
+from social_poll_manager.poll_store import create_poll_store
+from social_poll_manager.reaction import Reaction
+
+REACTION_NAMES = ["angry", "love", "haha", "wow"]
+REACTION_ICONS = {"angry": "angry", "love": "heart", "haha": "laugh", "wow": "wow"}
+reactions_dir = path.join(path.dirname(path.dirname(path.abspath(__file__))), "resources", "reactions_icons")
+
+
+class FakeResponse(object):
+    headers = dict()
+
+    def __init__(self, body: dict):
+        self.body = body
+
+    def json(self) -> dict:
+        return self.body
+
+
+class FakeGraphAPI(object):
+    """
+    Accepts every upload and comment, without any network call.
+    """
+    version = "v2.12"
+    access_token = "token"
+    timeout = 1
+
+    def __init__(self):
+        self.posts = 0
+        self.session = self
+
+    def post(self, url, data=None, files=None, headers=None, timeout=None) -> FakeResponse:
+        while data.read(8192):
+            pass
+        self.posts += 1
+        return FakeResponse({"id": f"post{self.posts}"})
+
+    def put_photo(self, image, message, album_path) -> dict:
+        self.posts += 1
+        return {"id": f"post{self.posts}"}
+
+    def put_comment(self, *args) -> None:
+        pass
+
+
+class FakeGraphBatcher(object):
+    """
+    Gives every reaction a distinct count, so that matches are never tied, or fails every lookup.
+    """
+    max_batch_size = 50
+
+    def __init__(self, failing: bool = False):
+        self.failing = failing
+        self.calls = 0
+
+    def get_post_reaction_counts(self, post_ids, reaction_names) -> dict:
+        self.calls += 1
+        if self.failing:
+            return {post_id: RuntimeError("post not found") for post_id in post_ids}
+        return {post_id: {name: 10 + idx for (idx, name) in enumerate(reaction_names)} for post_id in post_ids}
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.pics_dir = path.join(self.work_dir, "pics")
+        self.poll_data_file = path.join(self.work_dir, "poll_data.json")
+        images = ImageTable()
+        for idx in range(4):
+            image_path = path.join(self.work_dir, f"{idx}.jpg")
+            Image.new("RGB", (120, 80), (idx * 60, 0, 0)).save(image_path)
+            images.add(str(idx), image_path)
+        self.poll_data = PollData(images)
+        self.poll_data.seed = 1
+        self.phase = PhaseData(images.values(), 1)
+        self.poll_data.phases.append(self.phase)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _add_posted_matches(self, posted_time: datetime, match_status: MatchStatus) -> None:
+        for match_number, rows in enumerate([[0, 1], [2, 3]], 1):
+            match = self.phase.matches.add(match_number, rows, REACTION_NAMES[:2], [5, 3])
+            match.match_status = match_status
+            match.post_id = f"old{match_number}"
+            match.posted_time = posted_time
+        self.phase.status = PhaseStatus.POSTED
+        create_poll_store("JSON", self.poll_data_file).save(self.poll_data)
+
+    def _poll_manager(self, batcher: FakeGraphBatcher) -> PollManager:
+        reactions = [Reaction(name, path.join(reactions_dir, f"{REACTION_ICONS[name]}.png"), name[0])
+                     for name in REACTION_NAMES]
+        poll_manager = PollManager(graph_api=FakeGraphAPI(), reactions=reactions, layout={2: (1, 2)},
+                                   max_posts_per_time=2, poll_name="test", post_message="Match $MATCH_NUMBER$",
+                                   page_id="page", max_participants_per_match=2,
+                                   voting_duration=timedelta(seconds=0.1), post_interval=timedelta(seconds=0.05),
+                                   poll_data_file=self.poll_data_file, pics_dir=self.pics_dir,
+                                   render_cache_dir=path.join(self.work_dir, "render_cache"), render_workers=1,
+                                   reaction_retries=0)
+        poll_manager.graph_batcher = batcher
+        return poll_manager
+
+    def test_resume_posted_phase_with_every_match_over(self):
+        # Crash between saving the last match as over and saving the phase as over
+        self._add_posted_matches(datetime.now() - timedelta(hours=1), MatchStatus.OVER)
+        poll_manager = self._poll_manager(FakeGraphBatcher())
+        poll_manager.start()
+        phases = poll_manager.poll_data.phases
+        self.assertEqual([phase.phase_number for phase in phases], [1, 2, 3])
+        self.assertTrue(all(phase.status == PhaseStatus.OVER for phase in phases[:-1]))
+        self.assertEqual(len(phases[-1].participants), 1)
+
+    def test_resume_generated_phase_with_posted_image_deleted(self):
+        self._add_posted_matches(datetime.now() - timedelta(hours=1), MatchStatus.POSTED)
+        self.phase.matches[1].match_status = MatchStatus.GENERATED
+        self.phase.matches[1].post_id = None
+        self.phase.matches[1].posted_time = None
+        self.phase.status = PhaseStatus.GENERATED
+        create_poll_store("JSON", self.poll_data_file).save(self.poll_data)
+        # The image of the posted match is gone, it will never be rendered again
+        os.remove(self.poll_data.images["0"].image_path)
+        poll_manager = self._poll_manager(FakeGraphBatcher())
+        poll_manager.start()
+        self.assertEqual(len(poll_manager.poll_data.phases[-1].participants), 1)
+
+    def test_reactions_unavailable_stop_the_poll(self):
+        self._add_posted_matches(datetime.now() - timedelta(hours=1), MatchStatus.POSTED)
+        batcher = FakeGraphBatcher(failing=True)
+        poll_manager = self._poll_manager(batcher)
+        poll_manager.reactions_retry_delay = timedelta(milliseconds=1)
+        poll_manager.reactions_max_delayed_retries = 2
+        with self.assertRaises(ReactionsUnavailableError):
+            poll_manager.start()
+        # The jobs of both matches share a single chain of delayed retries
+        self.assertEqual(batcher.calls, 1 + poll_manager.reactions_max_delayed_retries)
+
+
+if __name__ == "__main__":
+    unittest.main()